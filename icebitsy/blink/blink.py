@@ -1,16 +1,20 @@
 #!/usr/bin/env python3
 
+from argparse import ArgumentParser
+
 from amaranth import *
 from amaranth_boards.icebreaker_bitsy import ICEBreakerBitsyPlatform
 
-# Import the ICEBitsyDfuWrapper
+# Import the ICEBitsyDfuWrapper and the PLL
 import sys
 import os
 if __package__:
     from ..common.dfu_helper import ICEBitsyDfuWrapper
+    from ..common.pll import PLL
 else:
     sys.path.append(os.path.dirname(__file__) + '/..')
     from common.dfu_helper import ICEBitsyDfuWrapper
+    from common.pll import PLL
 
 
 class Blinker(Elaboratable):
@@ -18,7 +22,7 @@ class Blinker(Elaboratable):
         self.maxperiod = maxperiod
 
     def elaborate(self, platform):
-        led = platform.request("led_r")
+        led = platform.request("led_r").o
 
         m = Module()
 
@@ -35,6 +39,16 @@ class Blinker(Elaboratable):
         return m
 
 
+parser = ArgumentParser()
+parser.add_argument("-f", type=float, help="Run from the PLL at this frequency in MHz (default: 12 MHz oscillator)")
+args = parser.parse_args()
+
 plat = ICEBreakerBitsyPlatform()
-blinker = Blinker(10000000)
-plat.build(ICEBitsyDfuWrapper(blinker), do_program=True)
+if args.f:
+    # Blink just as fast from the faster clock.
+    pll = PLL(freq_out=args.f * 1e6)
+    blinker = Blinker(int(10000000 * pll.freq_out / 12e6))
+else:
+    pll = None
+    blinker = Blinker(10000000)
+plat.build(ICEBitsyDfuWrapper(blinker, pll=pll), do_program=True)
@@ -1,23 +1,39 @@
 #!/usr/bin/env python3
 
+import math
+
 from amaranth import *
 from amaranth import sim
 
 
 class ICEBitsyDfuWrapper(Elaboratable):
-    def __init__(self, main):
+    """Add the DFU reboot button handling to `main`.
+
+    If a `PLL` is given it is added to the design as well, and the button
+    timing is scaled to the frequency it runs at. Construct `main` with
+    `pll.freq_out` in that case.
+    """
+
+    def __init__(self, main, pll=None):
         self.main = main
+        self.pll = pll
 
     def elaborate(self, platform):
         m = Module()
 
+        if self.pll is not None:
+            m.submodules.pll = self.pll
+            clk_freq = self.pll.freq_out
+        else:
+            clk_freq = 12e6
+
         # Hold user button until green LED
         # goes out, upon release the bitsy
         # will reboot into the DFU bootloader
-        dfu = DfuHelper()
-        dfu.btn_in = platform.request("button")
+        dfu = DfuHelper(clk_freq=clk_freq)
+        dfu.btn_in = platform.request("button").i
         m.submodules += dfu
-        ledg = platform.request("led_g")
+        ledg = platform.request("led_g").o
         m.d.comb += ledg.eq(~dfu.will_reboot)
 
         m.submodules += self.main
@@ -41,6 +57,9 @@ class DfuHelper(Elaboratable):
       `2^(sample_tw - 2)` cycles.
     * Provides a strobe `btn_press` signal when button is released before
       `2^sample_tw` cycles.
+    * `sample_tw` is given for a 12 MHz clock. Pass the real `clk_freq` when
+      running faster (e.g. from a PLL) and it is scaled up accordingly, so
+      the debounce and long press times stay the same.
 
     In application mode:
         Button release after a long press triggers reboot into bootloader image.
@@ -57,8 +76,9 @@ class DfuHelper(Elaboratable):
                  btn_invert = False,
                  bootloader_mode = False,
                  boot_img = 0b01,
-                 user_image = 0b10):
-        self.sample_tw = sample_tw
+                 user_image = 0b10,
+                 clk_freq = 12e6):
+        self.sample_tw = sample_tw + max(0, round(math.log2(clk_freq / 12e6)))
         self.long_tw = long_tw
         self.btn_use_tick = btn_use_tick
         self.btn_invert = btn_invert
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+
+from argparse import ArgumentParser
+
+from amaranth import *
+from amaranth.lib.cdc import ResetSynchronizer
+from amaranth import sim
+
+
+def pll_settings(freq_in, freq_out):
+    """Find the iCE40 PLL divider settings closest to `freq_out`.
+
+    This is the search `icepll` does for the SIMPLE feedback path:
+
+        freq_out = freq_in * (DIVF + 1) / ((DIVR + 1) * 2^DIVQ)
+
+    with the phase detector input (freq_in / (DIVR + 1)) between 10 and
+    133 MHz, the VCO between 533 and 1066 MHz and the output between 16 and
+    275 MHz.
+
+    Returns `(divr, divf, divq, filter_range, freq)` where `freq` is the
+    frequency the PLL will actually run at.
+    """
+    best = None
+    for divr in range(16):
+        freq_pfd = freq_in / (divr + 1)
+        if not 10e6 <= freq_pfd <= 133e6:
+            continue
+        for divf in range(128):
+            freq_vco = freq_pfd * (divf + 1)
+            if not 533e6 <= freq_vco <= 1066e6:
+                continue
+            for divq in range(1, 7):
+                freq = freq_vco / 2**divq
+                if not 16e6 <= freq <= 275e6:
+                    continue
+                if best is None or abs(freq - freq_out) < abs(best[-1] - freq_out):
+                    best = (divr, divf, divq, freq_pfd, freq)
+
+    if best is None:
+        raise ValueError("No PLL settings for {} MHz from {} MHz."
+                         .format(freq_out / 1e6, freq_in / 1e6))
+
+    divr, divf, divq, freq_pfd, freq = best
+    for filter_range, limit in enumerate([17e6, 26e6, 44e6, 66e6, 101e6], start=1):
+        if freq_pfd < limit:
+            break
+    else:
+        filter_range = 6
+
+    return divr, divf, divq, filter_range, freq
+
+
+class PLL(Elaboratable):
+    """Drive a clock domain from the iCE40 PLL.
+
+    The divider settings are computed for `freq_out` at construction time,
+    and `freq_out` is then replaced by the frequency the PLL will really run
+    at. Pass that on to anything that derives timing from the clock (baud
+    rates, debounce times, ...).
+
+    With `pad=True` the PLL is an `SB_PLL40_PAD` fed straight from the
+    `clk12` pin, which is how the oscillator is wired on the iCEBitsy
+    (pin 35, a PLL input). With `pad=False` an `SB_PLL40_CORE` takes its reference from the
+    buffered `clk12` input instead, which leaves the pin usable by other
+    logic too.
+
+    The `domain` clock domain is created here and held in reset until the
+    PLL reports lock, plus 15 us for the iCE40 block RAMs to come up, just
+    like the default `sync` domain of the platform.
+
+    In simulation (no platform) nothing is instantiated: the domain is
+    created without a clock, so the testbench has to add one with a period
+    of `1 / freq_out`, and `lock` is asserted right away.
+    """
+
+    def __init__(self, freq_in=12e6, freq_out=48e6, pad=True, domain="sync"):
+        self.freq_in = freq_in
+        self.pad = pad
+        self.domain = domain
+
+        (self.divr, self.divf, self.divq,
+         self.filter_range, self.freq_out) = pll_settings(freq_in, freq_out)
+
+        # Outputs
+        self.lock = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.domains += ClockDomain(self.domain)
+
+        if platform is not None:
+            if self.pad:
+                clk_pin = platform.request(platform.default_clk, dir="-")
+                m.submodules.pll = Instance(
+                    "SB_PLL40_PAD",
+                    p_FEEDBACK_PATH="SIMPLE",
+                    p_DIVR=self.divr,
+                    p_DIVF=self.divf,
+                    p_DIVQ=self.divq,
+                    p_FILTER_RANGE=self.filter_range,
+                    i_PACKAGEPIN=clk_pin.io,
+                    i_RESETB=1,
+                    i_BYPASS=0,
+                    o_PLLOUTGLOBAL=ClockSignal(self.domain),
+                    o_LOCK=self.lock
+                )
+            else:
+                clk_pin = platform.request(platform.default_clk)
+                m.submodules.pll = Instance(
+                    "SB_PLL40_CORE",
+                    p_FEEDBACK_PATH="SIMPLE",
+                    p_DIVR=self.divr,
+                    p_DIVF=self.divf,
+                    p_DIVQ=self.divq,
+                    p_FILTER_RANGE=self.filter_range,
+                    i_REFERENCECLK=clk_pin.i,
+                    i_RESETB=1,
+                    i_BYPASS=0,
+                    o_PLLOUTGLOBAL=ClockSignal(self.domain),
+                    o_LOCK=self.lock
+                )
+        else:
+            m.d.comb += self.lock.eq(1)
+
+        # Power-on reset
+        #
+        # Counts up (flip-flops can not be initialized to anything but 0)
+        # from the moment the PLL locks, and starts over if it loses lock.
+        delay = int(15e-6 * self.freq_out)
+        m.domains += ClockDomain("pll_por", reset_less=True, local=True)
+        m.d.comb += ClockSignal("pll_por").eq(ClockSignal(self.domain))
+
+        timer = Signal(range(delay + 1))
+        ready = Signal()
+        with m.If(~self.lock):
+            m.d.pll_por += [
+                timer.eq(0),
+                ready.eq(0)
+            ]
+        with m.Elif(timer == delay):
+            m.d.pll_por += ready.eq(1)
+        with m.Else():
+            m.d.pll_por += timer.eq(timer + 1)
+
+        m.submodules.reset_sync = ResetSynchronizer(~ready, domain=self.domain)
+
+        return m
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("freq", type=float, nargs="?", default=48,
+                        help="Output frequency in MHz (default 48)")
+    parser.add_argument("-s", action="store_true", help="Simulate PLL stand-in (for debugging).")
+    args = parser.parse_args()
+
+    pll = PLL(freq_out=args.freq * 1e6)
+    print("DIVR={} DIVF={} DIVQ={} FILTER_RANGE={}: {:.3f} MHz"
+          .format(pll.divr, pll.divf, pll.divq, pll.filter_range, pll.freq_out / 1e6))
+
+    if args.s:
+        m = Module()
+        m.submodules.pll = pll
+        counter = Signal(8)
+        m.d.sync += counter.eq(counter + 1)
+
+        s = sim.Simulator(m)
+        s.add_clock(1.0 / pll.freq_out, domain="sync")
+
+        def proc():
+            # The domain stays in reset for 15 us after lock.
+            for _ in range(int(15e-6 * pll.freq_out)):
+                yield
+            assert (yield counter) == 0
+            for _ in range(16):
+                yield
+            assert (yield counter) != 0
+
+        s.add_sync_process(proc)
+        with s.write_vcd("pll.vcd", "pll.gtkw",
+                         traces=[pll.lock, counter]):
+            s.run()
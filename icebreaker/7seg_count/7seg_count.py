@@ -1,9 +1,26 @@
 #!/usr/bin/env python3
 
+import argparse
+import random
+
 from amaranth import *
 from amaranth.build import *
+from amaranth import sim
+from amaranth.utils import log2_int
 from amaranth_boards.icebreaker import ICEBreakerPlatform
 
+# Import the stream, bus and BCD helpers, and the PDM driver and UART
+import sys
+import os
+sys.path.append(os.path.dirname(__file__) + '/..')
+sys.path.append(os.path.dirname(__file__) + '/../pdm_fade_gamma')
+sys.path.append(os.path.dirname(__file__) + '/../uart')
+from common.bcd import BinaryToBCD
+from common.stream import Stream
+from common.wishbone import WishboneBus, _test_access
+from gamma_pdm import PDMDriver
+from uart import UART
+
 # This PMOD is provided with your icebreaker, and should be attached
 # to PMOD1A.
 seven_seg_pmod = [
@@ -18,103 +35,451 @@ seven_seg_pmod = [
              Subsignal("ca", PinsN("10", dir="o", conn=("pmod", 0)), Attrs(IO_STANDARD="SB_LVCMOS33")))
 ]
 
+# Bits of a digit in the framebuffer, above its 4 bit value
+DIGIT_DP = 0x10
+DIGIT_BLANK = 0x20
+
+# Segments a to g of every character that reads well on 7 segments, a in
+# bit 0. Several letters only come in one case.
+SEGMENTS = {
+    "0": 0x3f, "1": 0x06, "2": 0x5b, "3": 0x4f, "4": 0x66,
+    "5": 0x6d, "6": 0x7d, "7": 0x07, "8": 0x7f, "9": 0x6f,
+    "A": 0x77, "b": 0x7c, "C": 0x39, "c": 0x58, "d": 0x5e,
+    "E": 0x79, "F": 0x71, "G": 0x3d, "H": 0x76, "h": 0x74,
+    "I": 0x06, "J": 0x1e, "L": 0x38, "n": 0x54, "O": 0x3f,
+    "o": 0x5c, "P": 0x73, "q": 0x67, "r": 0x50, "S": 0x6d,
+    "t": 0x78, "U": 0x3e, "u": 0x1c, "y": 0x6e,
+    "-": 0x40, "_": 0x08, "=": 0x48, " ": 0x00,
+}
+
+
+def glyph_table(chars):
+    """The segments of each of `chars`, for `DigitToSegments`."""
+    missing = [c for c in chars if c not in SEGMENTS]
+    if missing:
+        raise ValueError("No 7 segment glyph for {}.".format(", ".join(map(repr, missing))))
+    return [SEGMENTS[c] for c in chars]
+
+
+HEX_GLYPHS = glyph_table("0123456789AbCdEF")
+
 
 class Top(Elaboratable):
-    def __init__(self):
-        # TODO: Figure out how to expose the P1A{1-4, 7-10} pins in the
-        # constructor so Top can be built in a potentially platform-agnostic
-        # way using amaranth.cli.main. For now, only put child modules in
-        # constructor.
-        self.ones_to_segs = DigitToSegments()
-        self.tens_to_segs = DigitToSegments()
+    """Counts up on the two digits of the PMOD, in hex or with `decimal`
+    from 0 to 99, or with `uart` shows the last byte received."""
+
+    def __init__(self, uart=False, baud_rate=115200, decimal=False):
+        self.uart = uart
+        self.baud_rate = baud_rate
+        self.decimal = decimal
+        self.display = SevenSegController(digits=2)
 
     def elaborate(self, platform):
         seg_pins = platform.request("seven_seg")
 
         m = Module()
 
-        seg_pins_cat = Signal(7)
+        m.submodules.display = display = self.display
+        m.d.comb += [
+            Cat([seg_pins.aa, seg_pins.ab, seg_pins.ac, seg_pins.ad,
+                 seg_pins.ae, seg_pins.af, seg_pins.ag]).eq(display.segments[:7]),
+            # The ones are on the right, with ca low.
+            seg_pins.ca.eq(display.select[0])
+        ]
+
+        if self.uart:
+            serial = platform.request("uart")
+            m.submodules.uart = uart = UART(serial, clk_freq=12e6, baud_rate=self.baud_rate)
+            m.d.comb += uart.rx.connect(display.sink)
+        elif self.decimal:
+            prescaler = Signal(21)
+            count = Signal(range(100))
+            m.d.sync += prescaler.eq(prescaler + 1)
+            with m.If(prescaler.all()):
+                m.d.sync += count.eq(Mux(count == 99, 0, count + 1))
+            m.submodules.bcd = bcd = BinaryToBCD(width=len(count))
+            m.d.comb += [
+                bcd.sink.payload.eq(count),
+                bcd.sink.valid.eq(1),
+                display.sink.payload.eq(bcd.source.payload),
+                display.sink.valid.eq(bcd.source.valid),
+                bcd.source.ready.eq(1)
+            ]
+        else:
+            counter = Signal(29)
+            m.d.sync += counter.eq(counter + 1)
+            m.d.comb += [
+                display.sink.payload.eq(counter[21:]),
+                display.sink.valid.eq(1)
+            ]
+
+        return m
+
+
+class SevenSegController(Elaboratable):
+    """Scans a multiplexed display of `digits` 7 segment digits.
+
+    Every digit is lit in turn, `refresh_rate` times a second, by driving
+    its bit of `commons` and its segments on `segments` (a to g, then the
+    decimal point), all active high. `select` is the number of the digit,
+    for displays that take that instead. Digit 0 is the rightmost one. All
+    three are registered, and change in the same cycle.
 
-        counter = Signal(30)
-        ones_counter = Signal(4)
-        tens_counter = Signal(4)
-        display_state = Signal(3)
+    The segments are dark for `blank_time` seconds on both sides of every
+    switch to the next digit, so the common drivers have time to turn off
+    and one digit does not show faintly on the next. While they are lit,
+    a `PDMDriver` switches them on for `brightness` out of
+    `2**brightness_width` of the time. `blank` turns the display off.
 
-        m.submodules.ones_to_segs = self.ones_to_segs
-        m.submodules.tens_to_segs = self.tens_to_segs
+    The framebuffer holds a 4 bit value for every digit, shown as that
+    entry of `glyphs` (hex digits by default, or up to 16 others from
+    `glyph_table`), plus `DIGIT_DP` and `DIGIT_BLANK` flags. It is behind
+    `bus`, a word address per digit, with `brightness` at the address
+    after them, and reads back what was written. A transfer on `sink` sets all digits
+    at once to the hex digits of its payload instead, least significant
+    digit first, and clears their flags; a bus write in the same cycle
+    wins. That way the display can be fed from a UART or a counter
+    directly.
+    """
 
+    def __init__(self, digits=4, clk_freq=12e6, refresh_rate=500, blank_time=5e-6,
+                 brightness_width=8, glyphs=HEX_GLYPHS):
+        if len(glyphs) > 16:
+            raise ValueError("The framebuffer only has room for 16 glyphs.")
+        self.digits = digits
+        self.slot_cycles = int(clk_freq // (refresh_rate * digits))
+        self.blank_cycles = max(1, round(blank_time * clk_freq))
+        if self.slot_cycles <= 2 * self.blank_cycles:
+            raise ValueError("The refresh rate is too high to leave any time "
+                             "between the blanking.")
+        self.brightness_width = brightness_width
+
+        self.segments = Signal(8)
+        self.commons = Signal(digits, reset=1)
+        self.select = Signal(range(digits))
+        self.blank = Signal()
+
+        self.bus = WishboneBus(addr_width=log2_int(digits + 1, need_pow2=False))
+        self.sink = Stream(4 * digits, name="sink")
+        self.framebuffer = [Signal(6, name="digit{}".format(n)) for n in range(digits)]
+        self.brightness = Signal(brightness_width, reset=2**brightness_width - 1)
+
+        self.glyphs = list(glyphs)
+        self.decoder = DigitToSegments(glyphs)
+        self.pdm = PDMDriver(in_width=brightness_width)
+
+    def elaborate(self, _platform):
+        m = Module()
+
+        bus = self.bus
+        access = Signal()
         m.d.comb += [
-            Cat([seg_pins.aa, seg_pins.ab, seg_pins.ac, seg_pins.ad,
-                 seg_pins.ae, seg_pins.af, seg_pins.ag]).eq(seg_pins_cat),
-            ones_counter.eq(counter[21:25]),
-            tens_counter.eq(counter[25:29]),
-            display_state.eq(counter[2:5]),
-            self.ones_to_segs.digit.eq(ones_counter),
-            self.tens_to_segs.digit.eq(tens_counter)
+            access.eq(bus.cyc & bus.stb & ~bus.ack),
+            self.sink.ready.eq(1)
+        ]
+        m.d.sync += [
+            bus.ack.eq(access),
+            bus.dat_r.eq(0)
         ]
 
-        m.d.sync += counter.eq(counter + 1)
-
-        with m.Switch(display_state):
-            with m.Case("00-"):
-                m.d.sync += seg_pins_cat.eq(self.ones_to_segs.segments)
-            with m.Case("010"):
-                m.d.sync += seg_pins_cat.eq(0)
-            with m.Case("011"):
-                m.d.sync += seg_pins.ca.eq(1)
-            with m.Case("10-"):
-                m.d.sync += seg_pins_cat.eq(self.tens_to_segs.segments)
-            with m.Case("110"):
-                m.d.sync += seg_pins_cat.eq(0)
-            with m.Case("111"):
-                m.d.sync += seg_pins.ca.eq(0)
+        registers = self.framebuffer + [self.brightness]
+        with m.If(self.sink.valid):
+            for n, digit in enumerate(self.framebuffer):
+                m.d.sync += digit.eq(self.sink.payload[4 * n:4 * n + 4])
+        for address, register in enumerate(registers):
+            with m.If(access & (bus.adr == address)):
+                m.d.sync += bus.dat_r.eq(register)
+                with m.If(bus.we):
+                    m.d.sync += register.eq(bus.dat_w)
+
+        # Every digit gets a slot of `slot_cycles`, and is lit in the middle
+        # of it.
+        count = Signal(range(self.slot_cycles))
+        scan = Signal.like(self.select)
+        with m.If(count == self.slot_cycles - 1):
+            m.d.sync += [
+                count.eq(0),
+                scan.eq(Mux(scan == self.digits - 1, 0, scan + 1))
+            ]
+        with m.Else():
+            m.d.sync += count.eq(count + 1)
+
+        digit = Signal(6)
+        lit = Signal()
+        m.submodules.decoder = self.decoder
+        m.submodules.pdm = self.pdm
+        m.d.comb += [
+            digit.eq(Array(self.framebuffer)[scan]),
+            self.decoder.digit.eq(digit[:len(self.decoder.digit)]),
+            self.pdm.pdm_in.eq(self.brightness),
+            lit.eq((count >= self.blank_cycles) & (count < self.slot_cycles - self.blank_cycles) &
+                   ~(digit & DIGIT_BLANK).any() & ~self.blank & self.pdm.pdm_out)
+        ]
+        # The digit select goes through a register along with the segments,
+        # so they change together.
+        m.d.sync += [
+            self.segments.eq(Mux(lit, Cat(self.decoder.segments, (digit & DIGIT_DP).any()), 0)),
+            self.select.eq(scan),
+            self.commons.eq(1 << scan)
+        ]
 
         return m
 
 
 class DigitToSegments(Elaboratable):
-    def __init__(self):
-        self.digit = Signal(4)
+    """Shows `digit` as `glyphs[digit]` on `segments`, a to g. Digits
+    past the end of `glyphs` are blank.
+
+    By default `segments` follows `digit` in the same cycle. With
+    `registered` it comes a cycle later instead, from a flip-flop, which
+    keeps the decoding out of whatever path follows.
+
+    The glyphs are decoded by logic, or with `rom` read from a `Memory`:
+    an asynchronous read port becomes a LUT ROM, and with `registered` a
+    synchronous one goes in a block RAM, which leaves no logic at all.
+    For the 16 hex digits the logic is one 4 input LUT per segment, so the
+    block RAM is only worth it for bigger tables, or with a spare one.
+    """
+
+    def __init__(self, glyphs=HEX_GLYPHS, registered=False, rom=False):
+        self.glyphs = list(glyphs)
+        self.registered = registered
+        self.rom = rom
+
+        self.digit = Signal(range(max(2, len(self.glyphs))))
         self.segments = Signal(7)
 
     def elaborate(self, _platform):
         m = Module()
 
+        if self.rom:
+            depth = 2**len(self.digit)
+            rom = Memory(width=7, depth=depth, init=self.glyphs + [0] * (depth - len(self.glyphs)))
+            if self.registered:
+                m.submodules.rom_rd = rom_rd = rom.read_port(transparent=False)
+            else:
+                m.submodules.rom_rd = rom_rd = rom.read_port(domain="comb")
+            m.d.comb += [
+                rom_rd.addr.eq(self.digit),
+                self.segments.eq(rom_rd.data)
+            ]
+            return m
+
+        domain = m.d.sync if self.registered else m.d.comb
         with m.Switch(self.digit):
-            for n, seg_val in enumerate([
-                    0b0111111,
-                    0b0000110,
-                    0b1011011,
-                    0b1001111,
-                    0b1100110,
-                    0b1101101,
-                    0b1111101,
-                    0b0000111,
-                    0b1111111,
-                    0b1101111,
-                    0b1110111,
-                    0b1111100,
-                    0b0111001,
-                    0b1011110,
-                    0b1111001,
-                    0b1110001]):
+            for n, seg_val in enumerate(self.glyphs):
+                with m.Case(n):
+                    domain += self.segments.eq(seg_val)
+            with m.Default():
+                domain += self.segments.eq(0)
+
+        return m
+
+
+class SharedDigitToSegments(Elaboratable):
+    """Decodes `channels` digits with one `DigitToSegments`, one digit a
+    cycle in turn, for displays that show all their digits at once.
+
+    Each of `segments` is a register that keeps the glyph of its digit in
+    `digits` and is updated every `channels` cycles, so a change shows up
+    at most `channels` cycles later, one more with `registered`. That is
+    7 flip-flops and a share of the digit multiplexer per digit, instead
+    of a whole decoder, which pays for big glyph tables and especially
+    with the table in a block RAM (`rom` and `registered`).
+    """
+
+    def __init__(self, channels, glyphs=HEX_GLYPHS, registered=False, rom=False):
+        self.channels = channels
+        self.decoder = DigitToSegments(glyphs, registered=registered, rom=rom)
+
+        self.digits = [Signal(len(self.decoder.digit), name="digit{}".format(n))
+                       for n in range(channels)]
+        self.segments = [Signal(7, name="segments{}".format(n)) for n in range(channels)]
+
+    def elaborate(self, _platform):
+        m = Module()
+
+        m.submodules.decoder = decoder = self.decoder
+        channel = Signal(range(self.channels))
+        m.d.sync += channel.eq(Mux(channel == self.channels - 1, 0, channel + 1))
+        m.d.comb += decoder.digit.eq(Array(self.digits)[channel])
+
+        # A registered decoder answers for the channel of the cycle before.
+        target = channel
+        if decoder.registered:
+            target = Signal.like(channel)
+            m.d.sync += target.eq(channel)
+        with m.Switch(target):
+            for n, segments in enumerate(self.segments):
                 with m.Case(n):
-                    m.d.sync += self.segments.eq(seg_val)
+                    m.d.sync += segments.eq(decoder.segments)
 
         return m
 
 
+def _segments(digit, glyphs=HEX_GLYPHS):
+    # What the display should show for a framebuffer entry.
+    if digit & DIGIT_BLANK or (digit & 0xf) >= len(glyphs):
+        return 0
+    return glyphs[digit & 0xf] | (0x80 if digit & DIGIT_DP else 0)
+
+
+def _test_decoder(dut):
+    # Every digit, and one past the end of the table, in a shuffled order,
+    # and `segments` has to show each glyph in the right cycle.
+    values = list(range(2**len(dut.digit)))
+    random.Random(len(dut.glyphs)).shuffle(values)
+    expected = None
+    for value in values:
+        yield dut.digit.eq(value)
+        yield sim.Settle()
+        if not dut.registered:
+            expected = _segments(value, dut.glyphs)
+        if expected is not None:
+            assert (yield dut.segments) == expected, (dut.rom, dut.registered, value)
+        yield
+        expected = _segments(value, dut.glyphs)
+    yield sim.Settle()
+    assert (yield dut.segments) == expected
+
+
+def _test_shared(dut, rng, rounds=4):
+    # Changes digits at random, and each output has to catch up within
+    # the promised number of cycles, and never show anything else.
+    latency = dut.channels + dut.decoder.registered
+    glyphs = dut.decoder.glyphs
+    values = [0] * dut.channels
+    history = [list(values)] * (latency + 1)
+    # The outputs start blank, until the first round.
+    for _ in range(latency):
+        yield
+    for _ in range(rounds * dut.channels * latency):
+        if rng.random() < 0.3:
+            n = rng.randrange(dut.channels)
+            values[n] = rng.randrange(len(glyphs))
+            yield dut.digits[n].eq(values[n])
+        history = history[1:] + [list(values)]
+        yield
+        yield sim.Settle()
+        for n, segments in enumerate(dut.segments):
+            shown = yield segments
+            # Either what the digit was up to `latency` cycles ago...
+            assert shown in [_segments(past[n], glyphs) for past in history], (n, shown)
+        # ...and the oldest value, once it stayed for `latency` cycles.
+        for n, segments in enumerate(dut.segments):
+            if all(past[n] == values[n] for past in history):
+                assert (yield segments) == _segments(values[n], glyphs), n
+
+
+def _check_scan(dut, framebuffer, brightness, frames=2):
+    # Watches whole frames, starting at a slot boundary: each digit has to
+    # be selected for exactly its slot, dark at both ends of it, and in the
+    # middle show its entry for `brightness` out of 2^N of the time, give
+    # or take a cycle.
+    for n in (dut.digits - 1, 0):
+        yield sim.Settle()
+        while (yield dut.select) != n:
+            yield
+            yield sim.Settle()
+    lit_width = dut.slot_cycles - 2 * dut.blank_cycles
+    for _ in range(frames):
+        for n, entry in enumerate(framebuffer):
+            on = 0
+            for cycle in range(dut.slot_cycles):
+                yield sim.Settle()
+                assert (yield dut.select) == n
+                assert (yield dut.commons) == 1 << n
+                segments = yield dut.segments
+                # The select and the segments change in the same cycle.
+                if not dut.blank_cycles <= cycle < dut.slot_cycles - dut.blank_cycles:
+                    assert segments == 0, (n, cycle)
+                elif segments:
+                    assert segments == _segments(entry, dut.glyphs), (n, cycle, segments)
+                    on += 1
+                yield
+            if _segments(entry, dut.glyphs):
+                expected = lit_width * brightness / 2**dut.brightness_width
+                assert abs(on - expected) <= 1, (n, on, expected)
+            else:
+                assert on == 0
+
+
 if __name__ == "__main__":
-    # In this example, explicitly show the intermediate classes used to
-    # execute build() to demonstrate that a user can inspect
-    # each part of the build process (create files, execute, program,
-    # and create a zip file if you have a BuildPlan instance).
-    plat = ICEBreakerPlatform()
-    plat.add_resources(seven_seg_pmod)
-
-    # BuildPlan if do_build=False
-    # BuildProducts if do_build=True and do_program=False
-    # None otherwise.
-    plan = plat.build(Top(), do_build=False, do_program=False)  # BuildPlan
-    products = plan.execute()  # BuildProducts
-    plat.toolchain_program(products, "top")  # Manally run the programmer.
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", action="store_true", help="Simulate the display controller (for debugging).")
+    parser.add_argument("-u", action="store_true", help="Show the last byte received on the UART.")
+    parser.add_argument("-b", type=int, default=115200, help="Baud rate for -u (default 115200)")
+    parser.add_argument("-d", action="store_true", help="Count in decimal instead of hex.")
+    args = parser.parse_args()
+
+    if args.s:
+        # Every kind of decoder, with the hex digits and with letters.
+        for glyphs in (HEX_GLYPHS, glyph_table("0123456789-HELP")):
+            for rom in (False, True):
+                for registered in (False, True):
+                    dut = DigitToSegments(glyphs, registered=registered, rom=rom)
+                    m = Module()
+                    m.domains.sync = ClockDomain()
+                    m.submodules.dut = dut
+                    s = sim.Simulator(m)
+                    s.add_clock(1.0 / 12e6)
+
+                    def decoder_proc():
+                        yield from _test_decoder(dut)
+
+                    s.add_sync_process(decoder_proc)
+                    s.run()
+
+                    dut = SharedDigitToSegments(6, glyphs, registered=registered, rom=rom)
+                    s = sim.Simulator(dut)
+                    s.add_clock(1.0 / 12e6)
+
+                    def shared_proc():
+                        yield from _test_shared(dut, random.Random(len(glyphs)))
+
+                    s.add_sync_process(shared_proc)
+                    s.run()
+
+        # A short refresh period, so a few frames take a few hundred cycles.
+        dut = SevenSegController(digits=4, clk_freq=12e6, refresh_rate=12e6 / (4 * 40),
+                                 blank_time=3 / 12e6, brightness_width=4)
+        s = sim.Simulator(dut)
+        s.add_clock(1.0 / 12e6)
+
+        def process():
+            # Full brightness from the stream, then flags, a digit and the
+            # brightness from the bus.
+            yield dut.sink.payload.eq(0xa5c3)
+            yield dut.sink.valid.eq(1)
+            yield
+            yield dut.sink.valid.eq(0)
+            yield from _check_scan(dut, [0x3, 0xc, 0x5, 0xa], 15)
+
+            yield from _test_access(dut.bus, 1, 0xe | DIGIT_DP)
+            yield from _test_access(dut.bus, 2, DIGIT_BLANK)
+            yield from _test_access(dut.bus, 4, 6)
+            assert (yield from _test_access(dut.bus, 1)) == 0xe | DIGIT_DP
+            assert (yield from _test_access(dut.bus, 4)) == 6
+            yield from _check_scan(dut, [0x3, 0xe | DIGIT_DP, DIGIT_BLANK, 0xa], 6)
+
+            # Blanking the whole display.
+            yield dut.blank.eq(1)
+            yield from _check_scan(dut, [DIGIT_BLANK] * 4, 6, frames=1)
+
+        s.add_sync_process(process)
+        with s.write_vcd("7seg.vcd", "7seg.gtkw", traces=[dut.select, dut.segments]):
+            s.run()
+    else:
+        # In this example, explicitly show the intermediate classes used to
+        # execute build() to demonstrate that a user can inspect
+        # each part of the build process (create files, execute, program,
+        # and create a zip file if you have a BuildPlan instance).
+        plat = ICEBreakerPlatform()
+        plat.add_resources(seven_seg_pmod)
+
+        # BuildPlan if do_build=False
+        # BuildProducts if do_build=True and do_program=False
+        # None otherwise.
+        plan = plat.build(Top(uart=args.u, baud_rate=args.b, decimal=args.d), do_build=False, do_program=False)  # BuildPlan
+        products = plan.execute()  # BuildProducts
+        plat.toolchain_program(products, "top")  # Manally run the programmer.
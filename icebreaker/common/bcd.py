@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+import random
+
+from amaranth import *
+from amaranth import sim
+
+# Import the stream helpers
+import sys
+import os
+if __package__:
+    from .stream import Stream
+else:
+    sys.path.append(os.path.dirname(__file__))
+    from stream import Stream
+
+
+def bcd_digits(width):
+    """How many decimal digits a `width` bit number can need."""
+    return len(str(2**width - 1))
+
+
+def _dabble(m, bcd, bit):
+    # One step of double dabble: add 3 to every digit that is 5 or more, so
+    # that it carries into the next digit when it is doubled, then shift
+    # `bit` in from the right. The result is a signal of its own, so that
+    # the next step does not copy the whole expression three times over.
+    digits = [bcd[4 * n:4 * n + 4] for n in range(len(bcd) // 4)]
+    adjusted = Cat(Mux(digit >= 5, digit + 3, digit)[:4] for digit in digits)
+    result = Signal(len(bcd))
+    m.d.comb += result.eq(Cat(bit, adjusted))
+    return result
+
+
+class BinaryToBCD(Elaboratable):
+    """Converts `width` bit binary numbers from `sink` to packed BCD on
+    `source`, least significant digit in the lowest 4 bits.
+
+    Double dabble takes one step for every bit, and `bits_per_cycle` sets
+    how many of them share a clock cycle:
+
+    - With `bits_per_cycle` of `width` or more the conversion is purely
+      combinational and `source` follows `sink` in the same cycle.
+    - Otherwise the steps are done `bits_per_cycle` at a time by one block
+      of logic, in `ceil(width / bits_per_cycle)` cycles, plus one to load
+      the number and one to hand over the result.
+    - With `pipelined`, every group of steps gets logic and a register of
+      its own instead, so a number goes in every cycle and comes out that
+      many cycles later.
+
+    Fewer steps per cycle is a shorter path between registers, which is
+    what keeps wide numbers within timing at PLL clock speeds; more steps,
+    or the pipeline, is fewer cycles per number. Even one step per cycle
+    converts a 32 bit number in 32 cycles, far more often than a display
+    can show it.
+    """
+
+    def __init__(self, width=16, bits_per_cycle=1, pipelined=False):
+        self.width = width
+        self.digits = bcd_digits(width)
+        self.bits_per_cycle = min(bits_per_cycle, width)
+        self.pipelined = pipelined
+        self.cycles = -(-width // self.bits_per_cycle)
+        # Pad the number with zeros at the top to whole groups of steps,
+        # which changes nothing while the BCD value is still 0.
+        self.padded_width = self.cycles * self.bits_per_cycle
+
+        self.sink = Stream(width, name="sink")
+        self.source = Stream(4 * self.digits, name="source")
+
+    def _steps(self, m, bcd, binary):
+        # `bits_per_cycle` steps, taking bits from the top of `binary`.
+        for n in reversed(range(len(binary) - self.bits_per_cycle, len(binary))):
+            bcd = _dabble(m, bcd, binary[n])
+        return bcd, binary[:len(binary) - self.bits_per_cycle]
+
+    def elaborate(self, _platform):
+        m = Module()
+
+        zero = C(0, 4 * self.digits)
+        padded = Signal(self.padded_width)
+        m.d.comb += padded.eq(self.sink.payload)
+
+        if self.cycles == 1 and not self.pipelined:
+            bcd, _ = self._steps(m, zero, padded)
+            m.d.comb += [
+                self.source.payload.eq(bcd),
+                self.source.valid.eq(self.sink.valid),
+                self.sink.ready.eq(self.source.ready)
+            ]
+            return m
+
+        if self.pipelined:
+            # Every stage moves on when the last one is free or being taken.
+            advance = Signal()
+            m.d.comb += [
+                advance.eq(~self.source.valid | self.source.ready),
+                self.sink.ready.eq(advance)
+            ]
+            bcd, binary, valid = zero, padded, self.sink.valid
+            for n in range(self.cycles):
+                bcd, binary = self._steps(m, bcd, binary)
+                stage_bcd = Signal(4 * self.digits, name="bcd{}".format(n))
+                stage_binary = Signal(len(binary), name="binary{}".format(n))
+                stage_valid = Signal(name="valid{}".format(n))
+                with m.If(advance):
+                    m.d.sync += [
+                        stage_bcd.eq(bcd),
+                        stage_binary.eq(binary),
+                        stage_valid.eq(valid)
+                    ]
+                bcd, binary, valid = stage_bcd, stage_binary, stage_valid
+            m.d.comb += [
+                self.source.payload.eq(bcd),
+                self.source.valid.eq(valid)
+            ]
+            return m
+
+        # One block of logic, going around `cycles` times per number.
+        bcd = Signal(4 * self.digits)
+        binary = Signal(self.padded_width)
+        remaining = Signal(range(self.cycles + 1))
+        next_bcd, next_binary = self._steps(m, bcd, binary)
+        m.d.comb += self.source.payload.eq(bcd)
+
+        with m.FSM():
+            with m.State("IDLE"):
+                m.d.comb += self.sink.ready.eq(1)
+                with m.If(self.sink.valid):
+                    m.d.sync += [
+                        bcd.eq(0),
+                        binary.eq(padded),
+                        remaining.eq(self.cycles)
+                    ]
+                    m.next = "CONVERT"
+            with m.State("CONVERT"):
+                with m.If(remaining != 0):
+                    m.d.sync += [
+                        bcd.eq(next_bcd),
+                        binary.eq(Cat(C(0, self.bits_per_cycle), next_binary)),
+                        remaining.eq(remaining - 1)
+                    ]
+                with m.Else():
+                    m.d.comb += self.source.valid.eq(1)
+                    with m.If(self.source.ready):
+                        m.next = "IDLE"
+
+        return m
+
+
+def _bcd(value, digits):
+    return int(str(value).zfill(digits), 16)
+
+
+def _test_convert(dut, values, seed, stall=0.3):
+    # Feeds `values` with random gaps, takes the results with random
+    # stalls, and checks they all come out in order. Returns the cycles it
+    # took.
+    rng = random.Random(seed)
+    results = []
+    pending = list(values)
+    valid = False
+    cycles = 0
+    while len(results) < len(values):
+        if pending and not valid and rng.random() >= stall:
+            yield dut.sink.payload.eq(pending.pop(0))
+            valid = True
+        yield dut.sink.valid.eq(valid)
+        yield dut.source.ready.eq(rng.random() >= stall)
+        yield sim.Settle()
+        if (yield dut.source.valid) and (yield dut.source.ready):
+            results.append((yield dut.source.payload))
+        if valid and (yield dut.sink.ready):
+            valid = False
+        yield
+        cycles += 1
+        assert cycles < 20 * len(values) * (dut.cycles + 2), "results went missing"
+    yield dut.sink.valid.eq(0)
+    assert results == [_bcd(value, dut.digits) for value in values], (
+        dut.width, dut.bits_per_cycle, dut.pipelined)
+    return cycles
+
+
+if __name__ == "__main__":
+    # Every kind of converter at a few widths: the values at the ends and
+    # where digits roll over, then random ones, with random stalls on both
+    # sides. Then without stalls, to see how many cycles each takes.
+    for width in (4, 8, 16, 32):
+        rng = random.Random(width)
+        top = 2**width - 1
+        values = sorted({0, 1, 9, 10, 99 & top, 100 & top, top - 1, top})
+        values += [rng.randrange(2**width) for _ in range(40)]
+        for bits_per_cycle, pipelined in [(width, False), (1, False), (3, False),
+                                          (width, True), (1, True), (5, True)]:
+            dut = BinaryToBCD(width, bits_per_cycle, pipelined)
+            # The combinational one has no clock of its own.
+            m = Module()
+            m.domains.sync = ClockDomain()
+            m.submodules.dut = dut
+            s = sim.Simulator(m)
+            s.add_clock(1.0 / 12e6)
+            timing = []
+
+            def process():
+                yield from _test_convert(dut, values, seed=width)
+                timing.append((yield from _test_convert(dut, values, seed=width, stall=0)))
+
+            s.add_sync_process(process)
+            s.run()
+
+            # A number per cycle unless a single block is going around.
+            if pipelined or dut.cycles == 1:
+                limit = len(values) + dut.cycles + 1
+            else:
+                limit = len(values) * (dut.cycles + 2)
+            assert timing[0] <= limit, (width, bits_per_cycle, pipelined, timing[0], limit)
+            print("{:3} bits, {:2} per cycle{:11}: {:4} cycles for {} numbers".format(
+                width, dut.bits_per_cycle, ", pipelined" if pipelined else "",
+                timing[0], len(values)))
+
+    dut = BinaryToBCD(16, 4)
+    s = sim.Simulator(dut)
+    s.add_clock(1.0 / 12e6)
+
+    def process():
+        yield from _test_convert(dut, [12345, 65535], seed=0)
+
+    s.add_sync_process(process)
+    with s.write_vcd("bcd.vcd", "bcd.gtkw", traces=[dut.sink.payload, dut.source.payload]):
+        s.run()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+from amaranth import *
+from amaranth import sim
+
+# Width, polynomial, initial value and final XOR of the supported CRCs. Both
+# are reflected: bytes go in least significant bit first, and the CRC is
+# appended to a message least significant byte first.
+CRC_KINDS = {
+    # CRC-16/X-25, as used by HDLC and PPP
+    "crc16": (16, 0x1021, 0xffff, 0xffff),
+    # CRC-32/ISO-HDLC, as used by Ethernet and zlib
+    "crc32": (32, 0x04c11db7, 0xffffffff, 0xffffffff),
+}
+
+
+def _reflect(value, width):
+    return int("{:0{}b}".format(value, width)[::-1], 2)
+
+
+def _crc_register(kind, data, register=None):
+    # Runs the shift register over `data`, bit by bit.
+    width, poly, init, _xor_out = CRC_KINDS[kind]
+    poly = _reflect(poly, width)
+    if register is None:
+        register = init
+    for octet in data:
+        for i in range(8):
+            bit = (register ^ (octet >> i)) & 1
+            register = (register >> 1) ^ (poly if bit else 0)
+    return register
+
+
+def crc(kind, data):
+    """The CRC of `data` (bytes), computed in software."""
+    return _crc_register(kind, data) ^ CRC_KINDS[kind][3]
+
+
+def crc_bytes(kind, data):
+    """The CRC of `data` as the bytes to append to it."""
+    width = CRC_KINDS[kind][0]
+    return crc(kind, data).to_bytes(width // 8, "little")
+
+
+def crc_residue(kind):
+    """What the shift register holds after a message with its CRC appended."""
+    return _crc_register(kind, b"\x00" + crc_bytes(kind, b"\x00"))
+
+
+class CRC(Elaboratable):
+    """Computes a CRC over a byte stream, a byte per cycle.
+
+    `data` is added to the CRC when `en` is high. `clear` starts over with the
+    next byte, or with `data` itself if `en` is high in the same cycle.
+    `value` is the CRC of the bytes so far. `match` is high when those bytes
+    were a message followed by its CRC, which is how received frames are
+    checked.
+    """
+
+    def __init__(self, kind="crc32"):
+        if kind not in CRC_KINDS:
+            raise ValueError("Unknown CRC {}, pick one of {}."
+                             .format(kind, ", ".join(CRC_KINDS)))
+        self.kind = kind
+        self.width = CRC_KINDS[kind][0]
+
+        self.data = Signal(8)
+        self.en = Signal()
+        self.clear = Signal()
+        self.value = Signal(self.width)
+        self.match = Signal()
+
+    def elaborate(self, _platform):
+        m = Module()
+
+        width, poly, init, xor_out = CRC_KINDS[self.kind]
+        poly = _reflect(poly, width)
+
+        register = Signal(width, reset=init)
+        start = Signal(width)
+        m.d.comb += start.eq(Mux(self.clear, init, register))
+
+        # All 8 steps of the shift register unrolled into one XOR network.
+        step = start
+        for i in range(8):
+            bit = step[0] ^ self.data[i]
+            step = (step >> 1) ^ Mux(bit, poly, 0)
+
+        with m.If(self.en):
+            m.d.sync += register.eq(step)
+        with m.Elif(self.clear):
+            m.d.sync += register.eq(init)
+
+        m.d.comb += [
+            self.value.eq(register ^ xor_out),
+            self.match.eq(register == crc_residue(self.kind))
+        ]
+
+        return m
+
+
+if __name__ == "__main__":
+    # The standard check values, then a message followed by its own CRC.
+    for kind, check in [("crc16", 0x906e), ("crc32", 0xcbf43926)]:
+        assert crc(kind, b"123456789") == check
+
+        dut = CRC(kind)
+        s = sim.Simulator(dut)
+        s.add_clock(1.0 / 12e6)
+
+        def proc():
+            message = b"123456789"
+            for n, octet in enumerate(message):
+                yield dut.data.eq(octet)
+                yield dut.en.eq(1)
+                yield dut.clear.eq(n == 0)
+                yield
+            yield dut.en.eq(0)
+            yield dut.clear.eq(0)
+            yield
+            yield sim.Settle()
+            assert (yield dut.value) == check
+            assert not (yield dut.match)
+
+            for octet in crc_bytes(kind, message):
+                yield dut.data.eq(octet)
+                yield dut.en.eq(1)
+                yield
+            yield dut.en.eq(0)
+            yield
+            yield sim.Settle()
+            assert (yield dut.match)
+
+            # Clearing starts over.
+            yield dut.clear.eq(1)
+            yield
+            yield dut.clear.eq(0)
+            yield
+            yield sim.Settle()
+            assert (yield dut.value) == crc(kind, b"")
+
+        s.add_sync_process(proc)
+        with s.write_vcd("crc.vcd", "crc.gtkw", traces=[dut.data, dut.value, dut.match]):
+            s.run()
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+from amaranth import *
+from amaranth import sim
+
+# Import the bus helpers
+import sys
+import os
+if __package__:
+    from .wishbone import CSRBank, _test_access
+else:
+    sys.path.append(os.path.dirname(__file__))
+    from wishbone import CSRBank, _test_access
+
+CONTROL_SNAPSHOT = 0x1
+CONTROL_CLEAR = 0x2
+
+
+class PerfCounters(Elaboratable):
+    """Event counters and interval trackers, read through a `CSRBank`.
+
+    Every counter and tracker gets its registers in `csr` when it is added,
+    so add them all before the bank is elaborated. Hook events up by
+    driving the signals the `add_*()` methods return.
+
+    The counters run all the time, but the registers only show what they
+    were at the last snapshot, so that all of them are from the same cycle.
+    Writing `CONTROL_SNAPSHOT` to the `perf_control` register takes a
+    snapshot, `CONTROL_CLEAR` starts all counters over, and both at once
+    measure exactly the time since the last time that was done. The
+    `snapshot` and `clear` signals do the same from the design.
+    `perf_cycles` counts clock cycles.
+
+    Counters are `width` bits wide and stop at their largest value instead
+    of wrapping around. A tracker that did not see an interval yet reads
+    all ones as its minimum and 0 as its maximum.
+    """
+
+    def __init__(self, csr, width=32):
+        self.csr = csr
+        self.width = width
+
+        self.snapshot = Signal()
+        self.clear = Signal()
+
+        csr.add("perf_control", width=2, access="r")
+        self._counters = [(C(1), csr.add("perf_cycles", width, access="r"))]
+        self._trackers = []
+
+    def add_event(self, name):
+        """Count the cycles the returned signal is high in register `name`."""
+        event = Signal(name=name)
+        self._counters.append((event, self.csr.add(name, self.width, access="r")))
+        return event
+
+    def add_interval(self, name):
+        """Track the shortest and longest number of cycles between pulses of
+        the returned signal, in registers `name_min` and `name_max`."""
+        event = Signal(name=name)
+        self._add_tracker(name, event, event)
+        return event
+
+    def add_latency(self, name):
+        """Track the shortest and longest number of cycles from a pulse of
+        the first returned signal to the next pulse of the second one, in
+        registers `name_min` and `name_max`."""
+        start = Signal(name=name + "_start")
+        stop = Signal(name=name + "_stop")
+        self._add_tracker(name, start, stop)
+        return start, stop
+
+    def _add_tracker(self, name, start, stop):
+        self._trackers.append((start, stop,
+                               self.csr.add(name + "_min", self.width, access="r"),
+                               self.csr.add(name + "_max", self.width, access="r")))
+
+    def elaborate(self, _platform):
+        m = Module()
+
+        bus = self.csr.bus
+        written = self.csr.w_stb["perf_control"]
+        snapshot = Signal()
+        clear = Signal()
+        m.d.comb += [
+            snapshot.eq(self.snapshot | (written & (bus.dat_w & CONTROL_SNAPSHOT).any())),
+            clear.eq(self.clear | (written & (bus.dat_w & CONTROL_CLEAR).any()))
+        ]
+
+        for event, register in self._counters:
+            count = Signal(self.width)
+            with m.If(clear):
+                m.d.sync += count.eq(event)
+            with m.Elif(event & ~count.all()):
+                m.d.sync += count.eq(count + 1)
+            with m.If(snapshot):
+                m.d.sync += register.eq(count)
+
+        for start, stop, min_register, max_register in self._trackers:
+            # `since` counts the cycles since the last start.
+            since = Signal(self.width)
+            running = Signal()
+            shortest = Signal(self.width, reset=2**self.width - 1)
+            longest = Signal(self.width)
+
+            with m.If(~since.all()):
+                m.d.sync += since.eq(since + 1)
+            with m.If(stop & running & ~clear):
+                m.d.sync += running.eq(0)
+                with m.If(since < shortest):
+                    m.d.sync += shortest.eq(since)
+                with m.If(since > longest):
+                    m.d.sync += longest.eq(since)
+            with m.If(clear):
+                m.d.sync += [
+                    running.eq(0),
+                    shortest.eq(shortest.reset),
+                    longest.eq(0)
+                ]
+            with m.If(start):
+                m.d.sync += [
+                    since.eq(1),
+                    running.eq(1)
+                ]
+
+            with m.If(snapshot):
+                m.d.sync += [
+                    min_register.eq(shortest),
+                    max_register.eq(longest)
+                ]
+
+        return m
+
+
+if __name__ == "__main__":
+    # Events and intervals at known cycles, read back through the bank.
+    csr = CSRBank(addr_width=5)
+    dut = PerfCounters(csr, width=16)
+    event = dut.add_event("event")
+    interval = dut.add_interval("interval")
+    start, stop = dut.add_latency("latency")
+
+    m = Module()
+    m.submodules.csr = csr
+    m.submodules.perf = dut
+    s = sim.Simulator(m)
+    s.add_clock(1.0 / 12e6)
+
+    def read(name):
+        return (yield from _test_access(csr.bus, csr.addresses[name]))
+
+    def control(value):
+        yield from _test_access(csr.bus, csr.addresses["perf_control"], value)
+
+    def events():
+        # 10 single cycle events, pulses 5, 9 and 7 cycles apart, and
+        # start/stop pairs 3 and 12 cycles apart.
+        yield from control(CONTROL_SNAPSHOT | CONTROL_CLEAR)
+        for n in range(10):
+            yield event.eq(1)
+            yield
+            yield event.eq(0)
+            yield
+        for gap in (5, 9, 7):
+            yield interval.eq(1)
+            yield
+            yield interval.eq(0)
+            for _ in range(gap - 1):
+                yield
+        yield interval.eq(1)
+        yield
+        yield interval.eq(0)
+        for latency in (3, 12):
+            yield start.eq(1)
+            yield
+            yield start.eq(0)
+            for _ in range(latency - 1):
+                yield
+            yield stop.eq(1)
+            yield
+            yield stop.eq(0)
+            yield
+        # A stop without a start is not an interval.
+        yield stop.eq(1)
+        yield
+        yield stop.eq(0)
+
+        # Nothing shows before the snapshot.
+        assert (yield from read("event")) == 0
+        assert (yield from read("interval_min")) == 0xffff
+        yield from control(CONTROL_SNAPSHOT)
+        assert (yield from read("event")) == 10
+        assert (yield from read("interval_min")) == 5
+        assert (yield from read("interval_max")) == 9
+        assert (yield from read("latency_min")) == 3
+        assert (yield from read("latency_max")) == 12
+        cycles = yield from read("perf_cycles")
+        assert 60 < cycles < 100, cycles
+
+        # Clearing starts over.
+        yield from control(CONTROL_SNAPSHOT | CONTROL_CLEAR)
+        yield from control(CONTROL_SNAPSHOT)
+        assert (yield from read("event")) == 0
+        assert (yield from read("interval_min")) == 0xffff
+        assert (yield from read("latency_max")) == 0
+        # Back to back accesses are 2 cycles apart.
+        assert (yield from read("perf_cycles")) == 2
+
+    s.add_sync_process(events)
+    with s.write_vcd("perf.vcd", "perf.gtkw", traces=[event, interval, start, stop]):
+        s.run()
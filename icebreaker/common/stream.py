@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+from amaranth import *
+from amaranth.lib.fifo import SyncFIFOBuffered
+from amaranth import sim
+
+
+class Stream:
+    """A `payload`/`valid`/`ready` stream endpoint.
+
+    A transfer happens in every cycle in which both `valid` and `ready` are
+    high, so a stream can move one payload per clock. The source drives
+    `payload` and `valid`, keeps them stable until the transfer and must not
+    wait for `ready` before raising `valid`. The sink drives `ready`, which
+    may depend on `valid`.
+    """
+
+    def __init__(self, width=8, name=None):
+        self.width = width
+        prefix = name + "_" if name else ""
+        self.payload = Signal(width, name=prefix + "payload")
+        self.valid = Signal(name=prefix + "valid")
+        self.ready = Signal(name=prefix + "ready")
+
+    def connect(self, sink):
+        """Statements that feed this stream into `sink`.
+
+        Add them to the combinational domain of the module that owns both
+        ends.
+        """
+        return [
+            sink.payload.eq(self.payload),
+            sink.valid.eq(self.valid),
+            self.ready.eq(sink.ready)
+        ]
+
+    def transfer(self):
+        """Expression that is true in the cycles a payload changes hands."""
+        return self.valid & self.ready
+
+
+class PacketStream(Stream):
+    """A `Stream` that carries packets.
+
+    `last` goes with `payload` and is high on the final payload of every
+    packet.
+    """
+
+    def __init__(self, width=8, name=None):
+        super().__init__(width, name)
+        prefix = name + "_" if name else ""
+        self.last = Signal(name=prefix + "last")
+
+    def connect(self, sink):
+        return [
+            *super().connect(sink),
+            sink.last.eq(self.last)
+        ]
+
+
+class StreamFIFO(Elaboratable):
+    """`SyncFIFOBuffered` with stream endpoints.
+
+    Payloads written to `sink` come out of `source` in order. `level` is the
+    number of payloads held.
+    """
+
+    def __init__(self, width=8, depth=16):
+        self.width = width
+        self.depth = depth
+
+        self.sink = Stream(width, name="sink")
+        self.source = Stream(width, name="source")
+        self.level = Signal(range(depth + 1))
+
+    def elaborate(self, _platform):
+        m = Module()
+
+        m.submodules.fifo = fifo = SyncFIFOBuffered(width=self.width, depth=self.depth)
+        m.d.comb += [
+            fifo.w_data.eq(self.sink.payload),
+            fifo.w_en.eq(self.sink.valid),
+            self.sink.ready.eq(fifo.w_rdy),
+            self.source.payload.eq(fifo.r_data),
+            self.source.valid.eq(fifo.r_rdy),
+            fifo.r_en.eq(self.source.ready),
+            self.level.eq(fifo.level)
+        ]
+
+        return m
+
+
+class StreamPacker(Elaboratable):
+    """Packs `count` payloads from `sink` into one `count` times as wide on
+    `source`.
+
+    The first payload ends up in the least significant bits, or in the most
+    significant ones with `big_endian`. A new word is started in the same
+    cycle the previous one is taken, so the sink never stalls as long as the
+    source is ready.
+    """
+
+    def __init__(self, width=8, count=4, big_endian=False):
+        self.width = width
+        self.count = count
+        self.big_endian = big_endian
+
+        self.sink = Stream(width, name="sink")
+        self.source = Stream(width * count, name="source")
+
+    def elaborate(self, _platform):
+        m = Module()
+
+        data = Signal(self.width * self.count)
+        level = Signal(range(self.count + 1))
+        full = Signal()
+        m.d.comb += [
+            full.eq(level == self.count),
+            self.source.payload.eq(data),
+            self.source.valid.eq(full),
+            self.sink.ready.eq(~full | self.source.ready)
+        ]
+
+        with m.If(self.source.transfer()):
+            m.d.sync += level.eq(0)
+        with m.If(self.sink.transfer()):
+            if self.big_endian:
+                m.d.sync += data.eq(Cat(self.sink.payload, data[:-self.width]))
+            else:
+                m.d.sync += data.eq(Cat(data[self.width:], self.sink.payload))
+            m.d.sync += level.eq(Mux(full, 1, level + 1))
+
+        return m
+
+
+class StreamUnpacker(Elaboratable):
+    """Splits every payload from `sink` into `count` narrower ones on
+    `source`, in the order `StreamPacker` packs them.
+    """
+
+    def __init__(self, width=8, count=4, big_endian=False):
+        self.width = width
+        self.count = count
+        self.big_endian = big_endian
+
+        self.sink = Stream(width * self.count, name="sink")
+        self.source = Stream(width, name="source")
+
+    def elaborate(self, _platform):
+        m = Module()
+
+        data = Signal(self.width * self.count)
+        level = Signal(range(self.count + 1))
+        m.d.comb += [
+            self.source.valid.eq(level != 0),
+            self.sink.ready.eq((level == 0) | ((level == 1) & self.source.ready))
+        ]
+        if self.big_endian:
+            m.d.comb += self.source.payload.eq(data[-self.width:])
+        else:
+            m.d.comb += self.source.payload.eq(data[:self.width])
+
+        with m.If(self.source.transfer()):
+            if self.big_endian:
+                m.d.sync += data.eq(Cat(C(0, self.width), data[:-self.width]))
+            else:
+                m.d.sync += data.eq(data[self.width:])
+            m.d.sync += level.eq(level - 1)
+        with m.If(self.sink.transfer()):
+            m.d.sync += [
+                data.eq(self.sink.payload),
+                level.eq(self.count)
+            ]
+
+        return m
+
+
+if __name__ == "__main__":
+    # Push a counter through a FIFO with the source and sink both streaming
+    # every cycle, and check that nothing is lost, duplicated or delayed.
+    dut = StreamFIFO(width=8, depth=4)
+    s = sim.Simulator(dut)
+    s.add_clock(1.0 / 12e6)
+
+    def proc():
+        yield dut.sink.valid.eq(1)
+        yield dut.source.ready.eq(1)
+        received = []
+        for i in range(64):
+            yield dut.sink.payload.eq(i)
+            yield
+            if (yield dut.source.valid):
+                received.append((yield dut.source.payload))
+        assert received == list(range(len(received)))
+        assert len(received) >= 60
+
+    s.add_sync_process(proc)
+    with s.write_vcd("stream.vcd", "stream.gtkw",
+                     traces=[dut.sink.payload, dut.source.payload, dut.level]):
+        s.run()
+
+    # Pack bytes into 32 bit words and back again, one byte per cycle.
+    for big_endian in (False, True):
+        m = Module()
+        m.submodules.packer = packer = StreamPacker(8, 4, big_endian=big_endian)
+        m.submodules.unpacker = unpacker = StreamUnpacker(8, 4, big_endian=big_endian)
+        m.d.comb += packer.source.connect(unpacker.sink)
+        s = sim.Simulator(m)
+        s.add_clock(1.0 / 12e6)
+
+        def proc():
+            yield packer.sink.valid.eq(1)
+            yield unpacker.source.ready.eq(1)
+            words = []
+            received = []
+            for i in range(64):
+                yield packer.sink.payload.eq(i)
+                yield
+                if (yield packer.source.valid):
+                    words.append((yield packer.source.payload))
+                if (yield unpacker.source.valid):
+                    received.append((yield unpacker.source.payload))
+            assert received == list(range(len(received)))
+            assert len(received) >= 56
+            order = [3, 2, 1, 0] if big_endian else [0, 1, 2, 3]
+            assert words[0] == sum(i << (8 * n) for n, i in enumerate(order))
+
+        s.add_sync_process(proc)
+        with s.write_vcd("stream_packer.vcd", "stream_packer.gtkw",
+                         traces=[packer.sink.payload, packer.source.payload,
+                                 unpacker.source.payload]):
+            s.run()
@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+from amaranth import *
+from amaranth import sim
+
+
+class WishboneBus:
+    """The signals of a classic Wishbone bus with 32 bit words.
+
+    `adr` is a word address. Every access moves a whole word, so there is
+    no `sel`. The initiator holds `cyc`, `stb`, `we`, `adr` and `dat_w` until
+    the target raises `ack` for one cycle, along with `dat_r` on reads. It
+    may start the next access in the cycle right after `ack`.
+    """
+
+    def __init__(self, addr_width=30, name=None):
+        self.addr_width = addr_width
+        prefix = name + "_" if name else ""
+        self.cyc = Signal(name=prefix + "cyc")
+        self.stb = Signal(name=prefix + "stb")
+        self.we = Signal(name=prefix + "we")
+        self.adr = Signal(addr_width, name=prefix + "adr")
+        self.dat_w = Signal(32, name=prefix + "dat_w")
+        self.dat_r = Signal(32, name=prefix + "dat_r")
+        self.ack = Signal(name=prefix + "ack")
+
+    def connect(self, target):
+        """Statements that connect this initiator to `target`.
+
+        Add them to the combinational domain of the module that owns both
+        ends. Address bits the target does not have are dropped.
+        """
+        return [
+            target.cyc.eq(self.cyc),
+            target.stb.eq(self.stb),
+            target.we.eq(self.we),
+            target.adr.eq(self.adr),
+            target.dat_w.eq(self.dat_w),
+            self.dat_r.eq(target.dat_r),
+            self.ack.eq(target.ack)
+        ]
+
+
+class CSRBank(Elaboratable):
+    """A Wishbone target with a register at every word address.
+
+    Registers are added with `add()` before elaboration and get consecutive
+    addresses, which are kept in `addresses` for the host side. Reads of
+    unused addresses return 0 and writes to them are ignored, but they are
+    acknowledged like any other access. Every access takes two cycles.
+    """
+
+    def __init__(self, addr_width=8, name=None):
+        self.bus = WishboneBus(addr_width, name=name)
+        self.addresses = {}
+        self.w_stb = {}
+        self.r_stb = {}
+        self._registers = []
+
+    def add(self, name, width=32, access="rw", reset=0):
+        """Add the register `name` and return its signal.
+
+        With `access="rw"` the signal is a register the host writes and reads
+        back. With `access="r"` it is driven by the design and the host can
+        only read it. Either way `w_stb[name]` pulses for one cycle whenever
+        the host writes the address, which is also useful as a command
+        strobe on read-only registers (clearing a counter, say).
+        `r_stb[name]` pulses in the cycle the signal is read, so a register
+        can pop the next value off a FIFO: the value it shows in the cycle
+        after that is what the next read returns.
+        """
+        if access not in ("r", "rw"):
+            raise ValueError("Register access has to be 'r' or 'rw'.")
+        if width > 32:
+            raise ValueError("Registers are at most 32 bits wide.")
+        if name in self.addresses:
+            raise ValueError("There already is a register named {}.".format(name))
+        if len(self._registers) == 2**self.bus.addr_width:
+            raise ValueError("The bank is full.")
+
+        signal = Signal(width, reset=reset, name=name)
+        self.addresses[name] = len(self._registers)
+        self.w_stb[name] = Signal(name=name + "_w_stb")
+        self.r_stb[name] = Signal(name=name + "_r_stb")
+        self._registers.append((name, signal, access))
+        return signal
+
+    def elaborate(self, _platform):
+        m = Module()
+
+        bus = self.bus
+        access = Signal()
+        m.d.comb += access.eq(bus.cyc & bus.stb & ~bus.ack)
+        m.d.sync += [
+            bus.ack.eq(access),
+            bus.dat_r.eq(0)
+        ]
+
+        for address, (name, signal, mode) in enumerate(self._registers):
+            with m.If(access & (bus.adr == address)):
+                m.d.sync += bus.dat_r.eq(signal)
+                with m.If(bus.we):
+                    m.d.comb += self.w_stb[name].eq(1)
+                    if mode == "rw":
+                        m.d.sync += signal.eq(bus.dat_w)
+                with m.Else():
+                    m.d.comb += self.r_stb[name].eq(1)
+
+        return m
+
+
+def _test_access(bus, address, data=None):
+    # One Wishbone access as the initiator; returns what was read.
+    yield bus.cyc.eq(1)
+    yield bus.stb.eq(1)
+    yield bus.adr.eq(address)
+    yield bus.we.eq(data is not None)
+    if data is not None:
+        yield bus.dat_w.eq(data)
+    yield
+    yield sim.Settle()
+    while not (yield bus.ack):
+        yield
+        yield sim.Settle()
+    value = yield bus.dat_r
+    yield bus.cyc.eq(0)
+    yield bus.stb.eq(0)
+    yield
+    return value
+
+
+if __name__ == "__main__":
+    # Read and write registers of both kinds, and an address with nothing
+    # behind it.
+    dut = CSRBank(addr_width=4)
+    scratch = dut.add("scratch", reset=0x12345678)
+    narrow = dut.add("narrow", width=4, reset=5)
+    status = dut.add("status", width=16, access="r")
+    s = sim.Simulator(dut)
+    s.add_clock(1.0 / 12e6)
+
+    def proc():
+        yield status.eq(0xbeef)
+        assert (yield from _test_access(dut.bus, 0)) == 0x12345678
+        assert (yield from _test_access(dut.bus, 1)) == 5
+        assert (yield from _test_access(dut.bus, 2)) == 0xbeef
+        assert (yield from _test_access(dut.bus, 9)) == 0
+        yield from _test_access(dut.bus, 0, 0xcafef00d)
+        yield from _test_access(dut.bus, 1, 0xff)
+        yield from _test_access(dut.bus, 2, 0)
+        yield from _test_access(dut.bus, 9, 0xffffffff)
+        assert (yield from _test_access(dut.bus, 0)) == 0xcafef00d
+        assert (yield from _test_access(dut.bus, 1)) == 0xf
+        assert (yield from _test_access(dut.bus, 2)) == 0xbeef
+        assert (yield from _test_access(dut.bus, 9)) == 0
+
+    def strobes():
+        # The status register is read-only, but its strobe still fires.
+        reads = 0
+        for _ in range(64):
+            yield
+            reads += yield dut.r_stb["status"]
+            if (yield dut.w_stb["status"]):
+                assert (yield dut.bus.adr) == 2
+                assert reads == 1
+                return
+        assert False, "no write strobe"
+
+    s.add_sync_process(proc)
+    s.add_sync_process(strobes)
+    with s.write_vcd("wishbone.vcd", "wishbone.gtkw",
+                     traces=[dut.bus.adr, dut.bus.dat_r, dut.bus.ack, scratch]):
+        s.run()
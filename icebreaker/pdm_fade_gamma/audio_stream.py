@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+"""Host side of `UARTAudio`: streams 16 bit signed mono samples to it, as
+fast as it plays them and no faster.
+
+Samples go over the line least significant byte first. The design has room
+for `depth` samples to begin with, so that many are sent right away. After
+that, every time it played another `credit_size` samples it answers with
+the number of underruns so far, as two bytes least significant first, and
+each of those answers is room for `credit_size` more.
+
+This file does not need amaranth, and only needs pyserial to open a serial
+port by name.
+"""
+
+import math
+import struct
+import wave
+from argparse import ArgumentParser
+
+# Import the bridge client
+import sys
+import os
+if __package__:
+    from ..uart.bridge_client import open_port
+else:
+    sys.path.append(os.path.dirname(__file__) + '/../uart')
+    from bridge_client import open_port
+
+
+def stream(port, samples, depth=2048, credit_size=256, prefill=None):
+    """Send all of `samples` and return the last underrun count the design
+    reported.
+
+    Playback only starts (or starts again after an underrun) once `prefill`
+    samples are buffered, half the buffer by default, so that much silence
+    goes out after the samples to play the last of them.
+    """
+    if prefill is None:
+        prefill = depth // 2
+    samples = list(samples) + [0] * prefill
+
+    def send(chunk):
+        port.write(struct.pack("<{}h".format(len(chunk)), *chunk))
+        port.flush()
+
+    send(samples[:depth])
+    underruns = 0
+    for start in range(depth, len(samples), credit_size):
+        reply = b""
+        while len(reply) < 2:
+            chunk = port.read(2 - len(reply))
+            if not chunk:
+                raise ValueError("No credit came back after {} samples.".format(start))
+            reply += chunk
+        underruns = int.from_bytes(reply, "little")
+        send(samples[start:start + credit_size])
+    return underruns
+
+
+def read_wave(f, sample_rate):
+    """The samples of a 16 bit WAV file, mixed down to mono."""
+    with wave.open(f) as w:
+        if w.getsampwidth() != 2:
+            raise ValueError("Only 16 bit WAV files are supported.")
+        if w.getframerate() != sample_rate:
+            raise ValueError("The file has {} samples per second, not {}.".format(
+                w.getframerate(), sample_rate))
+        channels = w.getnchannels()
+        frames = w.readframes(w.getnframes())
+    values = struct.unpack("<{}h".format(len(frames) // 2), frames)
+    return [sum(values[n:n + channels]) // channels for n in range(0, len(values), channels)]
+
+
+def tone(freq, seconds, sample_rate, amplitude=0.5):
+    """A sine wave at `freq` Hz."""
+    return [round(amplitude * 32767 * math.sin(2 * math.pi * freq * n / sample_rate))
+            for n in range(round(seconds * sample_rate))]
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("port", help="Serial port, or a pyserial URL like socket://host:port")
+    parser.add_argument("-b", type=int, default=3000000, help="Baud rate (default 3000000)")
+    parser.add_argument("-a", type=int, default=44100, help="Sample rate the design was built for (default 44100)")
+    parser.add_argument("-d", type=int, default=2048, help="Buffer depth the design was built for (default 2048)")
+    parser.add_argument("-c", type=int, default=256, help="Samples per credit the design was built for (default 256)")
+    parser.add_argument("-w", help="16 bit WAV file to play")
+    parser.add_argument("-t", type=float, default=440, help="Without -w, play a tone of this many Hz (default 440)")
+    parser.add_argument("-l", type=float, default=5, help="Seconds of tone (default 5)")
+    args = parser.parse_args()
+
+    if args.w:
+        samples = read_wave(args.w, args.a)
+    else:
+        samples = tone(args.t, args.l, args.a)
+    port = open_port(args.port, args.b)
+    underruns = stream(port, samples, args.d, args.c)
+    print("Streamed {} samples, {} underruns".format(len(samples), underruns))
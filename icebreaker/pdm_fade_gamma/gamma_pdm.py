@@ -1,11 +1,37 @@
 #!/usr/bin/env python3
 
 import argparse
+import random
+import socket
+import threading
+import time
 
 from amaranth import *
 from amaranth import sim
+from amaranth.hdl.ir import Fragment
+from amaranth.utils import log2_int
 from amaranth_boards.icebreaker import ICEBreakerPlatform
 
+# Import the bus helpers, the UART and the host side
+import sys
+import os
+if __package__:
+    from .gamma_upload import gamma_table, upload
+    from ..common.wishbone import WishboneBus, _test_access
+    from ..uart.uart import UART, _TestPads, _proc_wrapper
+    from ..uart.uart_bridge import UARTBridge, _test_socket_rx, _test_socket_tx
+    from ..uart.bridge_client import BridgeClient
+    from .rgb_driver import RGBADriver, _LEDDAWriter
+else:
+    sys.path.append(os.path.dirname(__file__) + '/..')
+    sys.path.append(os.path.dirname(__file__) + '/../uart')
+    from gamma_upload import gamma_table, upload
+    from common.wishbone import WishboneBus, _test_access
+    from uart import UART, _TestPads, _proc_wrapper
+    from uart_bridge import UARTBridge, _test_socket_rx, _test_socket_tx
+    from bridge_client import BridgeClient
+    from rgb_driver import RGBADriver, _LEDDAWriter
+
 # This example is based on the PDM module by Tommy Thorn, and
 # was written from esden's reimplementation.
 # You can find him on GitHub as @tommythorn
@@ -25,30 +51,126 @@ from amaranth_boards.icebreaker import ICEBreakerPlatform
 
 
 class Top(Elaboratable):
-    def __init__(self, width=16, gamma=2.2):
+    """Fades the red and green LEDs in opposite directions.
+
+    With the "gpio" backend they are the LEDs of the board, driven from
+    PDMDrivers through I/O pins. "rgba" sends the same PDM outputs through
+    the constant current sinks of an RGB LED instead, and "ledda" leaves
+    the modulation to the SB_LEDDA_IP block as well, from the top 8 bits of
+    the levels, so there are no PDMDrivers at all (see `RGBADriver`).
+    """
+
+    def __init__(self, width=16, gamma=2.2, order=1, uart=False, baud_rate=115200, backend="gpio"):
+        if backend not in ("gpio", "rgba", "ledda"):
+            raise ValueError("The backend has to be gpio, rgba or ledda, not {}.".format(backend))
         self.width = width
         self.gamma = gamma
+        self.uart = uart
+        self.baud_rate = baud_rate
+        self.backend = backend
+
+        if backend == "ledda":
+            self.rgb = RGBADriver(ledda=True)
+        else:
+            self.pdm_g = PDMDriver(order=order)
+            self.pdm_r = PDMDriver(order=order)
+            if backend == "rgba":
+                self.rgb = RGBADriver()
+        # With the UART, each LED gets a gamma table of its own, which
+        # gamma_upload.py replaces while the design runs.
+        self.cnt = PDMCounter(gamma=gamma, writable=uart, per_channel=uart)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.cnt = self.cnt
+
+        if self.backend == "ledda":
+            m.submodules.rgb = self.rgb
+            m.d.comb += [
+                self.rgb.duty[0].eq(self.cnt.pdm_level2[-8:]),
+                self.rgb.duty[1].eq(self.cnt.pdm_level1[-8:])
+            ]
+        else:
+            m.submodules.pdm_g = self.pdm_g
+            m.submodules.pdm_r = self.pdm_r
+            m.d.comb += [
+                self.pdm_g.pdm_in.eq(self.cnt.pdm_level1),
+                self.pdm_r.pdm_in.eq(self.cnt.pdm_level2)
+            ]
+            if self.backend == "rgba":
+                m.submodules.rgb = self.rgb
+                m.d.comb += self.rgb.pwm.eq(Cat(self.pdm_r.pdm_out, self.pdm_g.pdm_out))
+            else:
+                ledr_n = platform.request("led_r")
+                ledg_n = platform.request("led_g")
+                m.d.comb += [
+                    ledg_n.eq(self.pdm_g.pdm_out),
+                    ledr_n.eq(self.pdm_r.pdm_out)
+                ]
+
+        if self.uart:
+            serial = platform.request("uart")
+            m.submodules.uart = uart = UART(serial, clk_freq=12e6, baud_rate=self.baud_rate)
+            m.submodules.bridge = bridge = UARTBridge(timeout=int(0.1 * 12e6))
+            m.d.comb += [
+                *uart.rx.connect(bridge.sink),
+                *bridge.source.connect(uart.tx),
+                *bridge.bus.connect(self.cnt.bus)
+            ]
+
+        return m
 
-        self.pdm_g = PDMDriver()
-        self.pdm_r = PDMDriver()
-        self.cnt = PDMCounter(gamma=gamma)
+
+class BankTop(Elaboratable):
+    """A wave of brightness running over the LEDs of the board and of the
+    break-off PMOD, from a shared `PDMBank` with its levels written over
+    the bus."""
+
+    def __init__(self, gamma=2.2):
+        self.gamma = gamma
 
     def elaborate(self, platform):
-        ledr_n = platform.request("led_r")
-        ledg_n = platform.request("led_g")
+        platform.add_resources(platform.break_off_pmod)
+        leds = [platform.request("led_r", 0), platform.request("led_g", 0),
+                platform.request("led_r", 1)]
+        leds += [platform.request("led_g", n) for n in range(1, 5)]
 
         m = Module()
 
-        m.submodules.pdm_g = self.pdm_g
-        m.submodules.pdm_r = self.pdm_r
-        m.submodules.cnt = self.cnt
+        m.submodules.bank = bank = PDMBank(len(leds), shared=True, mapped=True)
+        m.d.comb += Cat(led.o for led in leds).eq(bank.pdm_out)
+
+        gamma = Memory(width=16, depth=256, init=gamma_table(self.gamma))
+        m.submodules.gamma_rd = gamma_rd = gamma.read_port()
 
+        # The wave moves a step every 2^16 cycles. Each LED is a bit further
+        # along a triangle, looked up one after the other: the address goes
+        # out, the level comes back a cycle later and is written.
+        prescaler = Signal(16)
+        phase = Signal(8)
+        m.d.sync += prescaler.eq(prescaler + 1)
+        with m.If(prescaler.all()):
+            m.d.sync += phase.eq(phase + 1)
+
+        channel = Signal(range(len(leds)))
+        position = Signal(8)
+        fetched = Signal()
         m.d.comb += [
-            self.pdm_g.pdm_in.eq(self.cnt.pdm_level1),
-            self.pdm_r.pdm_in.eq(self.cnt.pdm_level2),
-            ledg_n.eq(self.pdm_g.pdm_out),
-            ledr_n.eq(self.pdm_r.pdm_out)
+            position.eq(phase + channel * (256 // len(leds))),
+            gamma_rd.addr.eq(Cat(0, Mux(position[-1], ~position[:7], position[:7]))),
+            bank.bus.cyc.eq(fetched),
+            bank.bus.stb.eq(fetched),
+            bank.bus.we.eq(1),
+            bank.bus.adr.eq(channel),
+            bank.bus.dat_w.eq(gamma_rd.data)
         ]
+        m.d.sync += fetched.eq(1)
+        with m.If(bank.bus.ack):
+            m.d.sync += [
+                fetched.eq(0),
+                channel.eq(Mux(channel == len(leds) - 1, 0, channel + 1))
+            ]
 
         return m
 
@@ -82,47 +204,452 @@ class Top(Elaboratable):
 #   D = T + (~pdm_out + 1) << N === T + (pdm_out << N) + (pdm_out << (N+1))
 #   pdm_sigma = pdm_sigma + D
 #   pdm_out = 1 & (pdm_sigma >> (N+1))
+#
+# A first order modulator repeats short patterns at low levels (idle tones),
+# which shows up as flicker on a dim LED, and it pushes little of its noise
+# away from low frequencies. With order=2 or 3 the error goes through a
+# cascade of integrators instead (CIFB: every integrator takes the one
+# before it, minus the output fed back with a gain of its own). In signed
+# arithmetic, with H = 2^(N-1), u = T - H and v = H or -H for pdm_out:
+#
+# order 2:  i1 += u - v;  i2 += i1 - 2v
+# order 3:  i1 += u - v;  i2 += i1 - 8v;  i3 += i2 - 16v
+#
+# where the right hand sides use the integrators from before the update,
+# and pdm_out = (last integrator >= 0). The third order gains are 1/16, 1/2
+# and 1, scaled by 16 to stay integers; more aggressive ones become unstable
+# for large inputs. Near 0 and 1 even these overload, so the integrators
+# saturate at PDM_SATURATION[order] bits above N instead of wrapping around,
+# which keeps the average right over the whole range.
+PDM_FEEDBACK = {2: (1, 2), 3: (1, 8, 16)}
+PDM_SATURATION = {2: 4, 3: 6}
+
+
 class PDMDriver(Elaboratable):
-    def __init__(self, in_width=16):
+    def __init__(self, in_width=16, order=1):
+        if order not in (1, 2, 3):
+            raise ValueError("The modulator order has to be 1, 2 or 3.")
         self.pdm_out = Signal(1)
         self.pdm_in = Signal(in_width)
         self.in_width = in_width
+        self.order = order
 
     def elaborate(self, _platform):
         m = Module()
 
-        pdm_sigma = Signal(self.in_width + 2)
+        if self.order == 1:
+            pdm_sigma = Signal(self.in_width + 2)
+
+            m.d.comb += self.pdm_out.eq(~pdm_sigma[-1])
+            m.d.sync += [
+                pdm_sigma.eq(pdm_sigma + Cat(self.pdm_in, self.pdm_out, self.pdm_out))
+            ]
+
+            return m
+
+        width = self.in_width + PDM_SATURATION[self.order]
+        half = 2**(self.in_width - 1)
+        integrators = [Signal(signed(width), name="pdm_i{}".format(n + 1))
+                       for n in range(self.order)]
+
+        feedback = Signal(signed(self.in_width + 1))
+        m.d.comb += [
+            self.pdm_out.eq(integrators[-1] >= 0),
+            feedback.eq(Mux(self.pdm_out, half, -half))
+        ]
+
+        inputs = [self.pdm_in - half] + integrators[:-1]
+        for integrator, source, gain in zip(integrators, inputs, PDM_FEEDBACK[self.order]):
+            total = Signal(signed(width + 2))
+            m.d.comb += total.eq(integrator + source - feedback * gain)
+            with m.If(total > 2**(width - 1) - 1):
+                m.d.sync += integrator.eq(2**(width - 1) - 1)
+            with m.Elif(total < -2**(width - 1)):
+                m.d.sync += integrator.eq(-2**(width - 1))
+            with m.Else():
+                m.d.sync += integrator.eq(total)
+
+        return m
+
+
+def pdm_model(levels, in_width=16, order=1):
+    """What `PDMDriver` outputs for `levels`, computed with NumPy.
+
+    `levels` holds one input per cycle along its first axis. Further axes
+    are independent drivers, which run side by side. Returns the outputs
+    as an array of the same shape. Only the first order is vectorised: it
+    runs at tens of millions of cycles per second (the `-s` run prints the
+    rate). The higher orders step through the cycles one by one in Python,
+    at tens of thousands of cycles per second, so keep their inputs short.
+    """
+    import numpy as np
+
+    levels = np.asarray(levels, dtype=np.int64)
+    if order == 1:
+        # pdm_out is 1 in the first cycle, and after that exactly when the
+        # sum of the levels before the cycle passes a multiple of 2^N, as
+        # long as pdm_sigma stays in the range where it does not wrap.
+        sums = np.cumsum(levels, axis=0) >> in_width
+        outs = np.ones(levels.shape, dtype=np.uint8)
+        outs[1:] = np.diff(sums, axis=0, prepend=np.zeros_like(sums[:1]))[:-1]
+        return outs
+
+    outs = np.empty(levels.shape, dtype=np.uint8)
+    width = in_width + PDM_SATURATION[order]
+    half = 2**(in_width - 1)
+    integrators = np.zeros((order,) + levels.shape[1:], dtype=np.int64)
+    gains = np.array(PDM_FEEDBACK[order]).reshape((order,) + (1,) * (levels.ndim - 1))
+    for t, level in enumerate(levels):
+        out = integrators[-1] >= 0
+        outs[t] = out
+        feedback = np.where(out, half, -half)
+        inputs = np.concatenate([(level - half)[None], integrators[:-1]])
+        integrators = np.clip(integrators + inputs - gains * feedback,
+                              -2**(width - 1), 2**(width - 1) - 1)
+    return outs
+
+
+def pdm_snr(outs, signal_bin, oversampling=64):
+    """Signal to noise ratio in dB of a PDM bitstream carrying a sine that
+    makes `signal_bin` whole periods, within the lowest 1/(2*oversampling)
+    of the spectrum."""
+    import numpy as np
+
+    outs = np.asarray(outs, dtype=float) * 2 - 1
+    power = np.abs(np.fft.rfft(outs * np.hanning(len(outs))))**2
+    band = len(outs) // (2 * oversampling)
+    signal = power[signal_bin - 2:signal_bin + 3].sum()
+    noise = power[1:band].sum() - signal
+    return 10 * np.log10(signal / noise)
+
+
+class PDMBank(Elaboratable):
+    """`channels` PDM outputs in one module, on the bits of `pdm_out`.
+
+    By default every channel is a `PDMDriver` of its own. With `shared`
+    there is one adder for all of them instead, and the accumulators live
+    in block RAM: every cycle one channel takes a step, so each output
+    changes at most every `channels` cycles, which is still far too fast
+    to see on an LED. The outputs themselves stay in flip-flops.
+
+    The levels are the `levels` signals, or with `mapped` a level array
+    behind `bus`, one channel per word address, that reads back what was
+    written. Shared and mapped together keep the levels in block RAM too.
+    """
+
+    def __init__(self, channels, in_width=16, shared=False, mapped=False):
+        if shared and channels < 2:
+            raise ValueError("A shared bank needs at least 2 channels.")
+        self.channels = channels
+        self.in_width = in_width
+        self.shared = shared
+        self.mapped = mapped
+
+        self.pdm_out = Signal(channels, reset=2**channels - 1)
+        if mapped:
+            self.levels = None
+            self.bus = WishboneBus(addr_width=max(1, log2_int(channels, need_pow2=False)))
+        else:
+            self.levels = [Signal(in_width, name="level{}".format(n)) for n in range(channels)]
+
+    def elaborate(self, _platform):
+        m = Module()
 
-        m.d.comb += self.pdm_out.eq(~pdm_sigma[-1])
+        if self.mapped:
+            bus = self.bus
+            access = Signal()
+            write = Signal()
+            m.d.comb += [
+                access.eq(bus.cyc & bus.stb & ~bus.ack),
+                write.eq(access & bus.we & (bus.adr < self.channels))
+            ]
+            m.d.sync += bus.ack.eq(access)
+
+        if not self.shared:
+            if self.mapped:
+                levels = Array(Signal(self.in_width, name="level{}".format(n))
+                               for n in range(self.channels))
+                with m.If(write):
+                    m.d.sync += levels[bus.adr].eq(bus.dat_w)
+                m.d.sync += bus.dat_r.eq(levels[bus.adr])
+            else:
+                levels = self.levels
+            for n in range(self.channels):
+                m.submodules["pdm{}".format(n)] = pdm = PDMDriver(self.in_width)
+                m.d.comb += [
+                    pdm.pdm_in.eq(levels[n]),
+                    self.pdm_out[n].eq(pdm.pdm_out)
+                ]
+            return m
+
+        # Read channel `index` while the one before it, `step_index`, is
+        # written back, so the two never collide.
+        sigmas = Memory(width=self.in_width + 2, depth=self.channels)
+        m.submodules.sigma_rd = sigma_rd = sigmas.read_port()
+        m.submodules.sigma_wr = sigma_wr = sigmas.write_port()
+
+        index = Signal(range(self.channels))
+        step_index = Signal.like(index)
         m.d.sync += [
-            pdm_sigma.eq(pdm_sigma + Cat(self.pdm_in, self.pdm_out, self.pdm_out))
+            index.eq(Mux(index == self.channels - 1, 0, index + 1)),
+            step_index.eq(index)
+        ]
+
+        level = Signal(self.in_width)
+        if self.mapped:
+            levels = Memory(width=self.in_width, depth=self.channels)
+            m.submodules.level_rd = level_rd = levels.read_port()
+            m.submodules.level_bus_rd = level_bus_rd = levels.read_port()
+            m.submodules.level_wr = level_wr = levels.write_port()
+            m.d.comb += [
+                level_rd.addr.eq(index),
+                level.eq(level_rd.data),
+                level_bus_rd.addr.eq(bus.adr),
+                bus.dat_r.eq(level_bus_rd.data),
+                level_wr.addr.eq(bus.adr),
+                level_wr.data.eq(bus.dat_w),
+                level_wr.en.eq(write)
+            ]
+        else:
+            m.d.comb += level.eq(Array(self.levels)[step_index])
+
+        # The same step as PDMDriver takes every cycle.
+        sigma = Signal(self.in_width + 2)
+        out = Signal()
+        m.d.comb += [
+            sigma_rd.addr.eq(index),
+            out.eq(~sigma_rd.data[-1]),
+            sigma.eq(sigma_rd.data + Cat(level, out, out)),
+            sigma_wr.addr.eq(step_index),
+            sigma_wr.data.eq(sigma),
+            sigma_wr.en.eq(1)
         ]
+        m.d.sync += self.pdm_out.bit_select(step_index, 1).eq(~sigma[-1])
 
         return m
 
 
+def _resources(elaboratable):
+    # Pre-synthesis estimate of a design: the flip-flop and memory bits in
+    # its netlist, and how many 4 kbit block RAMs (256 x 16 bits each) the
+    # memories would take on the iCE40. Synthesis may still merge or trim
+    # flip-flops, and there is no LUT count; run yosys for the real figures.
+    ffs = bits = brams = 0
+    fragments = [Fragment.get(elaboratable, None)]
+    while fragments:
+        fragment = fragments.pop()
+        if getattr(fragment, "type", None) == "$mem_v2":
+            width = fragment.parameters["WIDTH"]
+            depth = fragment.parameters["SIZE"]
+            bits += width * depth
+            brams += (fragment.parameters["RD_PORTS"] * -(-width // 16) * -(-depth // 256))
+            continue
+        ffs += sum(len(signal) for domain, signal in fragment.iter_drivers()
+                   if domain is not None)
+        fragments += [subfragment for subfragment, _name in fragment.subfragments]
+    return ffs, bits, brams
+
+
+class _PDMCapture(Elaboratable):
+    # Shifts the output of `dut` into `capture`, oldest first, so the test
+    # only has to look at it once every `window` cycles.
+    def __init__(self, dut, window=64):
+        self.dut = dut
+        self.window = window
+        self.capture = Signal(window)
+
+    def elaborate(self, _platform):
+        m = Module()
+        m.submodules.dut = self.dut
+        m.d.sync += self.capture.eq(Cat(self.capture[1:], self.dut.pdm_out))
+        return m
+
+
+def _test_pdm(harness, window_levels, captures):
+    # Holds each level for a window, only looking at the output at the end
+    # of it, and keeps what was captured.
+    for level in window_levels:
+        yield harness.dut.pdm_in.eq(int(level))
+        for _ in range(harness.window):
+            yield
+        yield sim.Settle()
+        captures.append((yield harness.capture))
+
+
+def _check_pdm(dut, window_levels, window=64):
+    # Simulates `dut` and compares all of it with the model at once.
+    # Returns the outputs.
+    import numpy as np
+
+    harness = _PDMCapture(dut, window)
+    s = sim.Simulator(harness)
+    s.add_clock(1.0 / 12e6)
+    captures = []
+
+    def process():
+        yield from _test_pdm(harness, window_levels, captures)
+
+    s.add_sync_process(process)
+    s.run()
+
+    words = np.array(captures, dtype=np.uint64)
+    outs = (words[:, None] >> np.arange(window, dtype=np.uint64)) & 1
+    outs = outs.reshape(-1).astype(np.uint8)
+    # The first clock edge comes before the first level.
+    levels = np.concatenate([[0], np.repeat(window_levels, window)])
+    expected = pdm_model(levels, dut.in_width, dut.order)[1:]
+    mismatches = np.flatnonzero(outs != expected)
+    assert not len(mismatches), (dut.order, mismatches[:10])
+    return outs
+
+
+def _check_counter(dut, tables, rng=None):
+    # Runs `dut` with small tables for two whole periods of its triangle,
+    # and checks that every channel goes through the levels of its table
+    # in order. A writable counter gets `tables` over the bus first, and
+    # the bus keeps reading them back at addresses from `rng` while it runs.
+    samples = []
+    uploaded = []
+    done = []
+    s = sim.Simulator(dut)
+    s.add_clock(1.0 / 12e6)
+
+    def address(n, index):
+        return (n << dut.in_width) + index
+
+    def sample_proc():
+        if dut.writable:
+            for n, table in enumerate(tables):
+                for index, level in enumerate(table):
+                    yield from _test_access(dut.bus, address(n, index), level)
+            for n, table in enumerate(tables):
+                for index, level in enumerate(table):
+                    assert (yield from _test_access(dut.bus, address(n, index))) == level
+        uploaded.append(True)
+        for _ in range(2 * 2**(dut.in_width + 1) * (2**dut.out_width + 1)):
+            yield sim.Settle()
+            sample = []
+            for level in dut.levels:
+                sample.append((yield level))
+            samples.append(sample)
+            yield
+        done.append(True)
+
+    def read_proc():
+        while not uploaded:
+            yield
+        while not done:
+            for n, table in enumerate(tables):
+                index = rng.randrange(len(table))
+                assert (yield from _test_access(dut.bus, address(n, index))) == table[index]
+
+    s.add_sync_process(sample_proc)
+    if dut.writable:
+        s.add_sync_process(read_proc)
+    s.run()
+
+    def runs(values):
+        return [v for n, v in enumerate(values) if n == 0 or v != values[n - 1]]
+
+    top = 2**dut.in_width
+    for n in range(dut.channels):
+        table = tables[n if dut.per_channel else 0]
+        positions = [step + n * 2 * top // dut.channels for step in range(6 * top)]
+        expected = runs([table[(x if x & top else ~x) % top] for x in positions])
+        # Skip the reset value, or the old table, before the first lookup.
+        got = runs([sample[n] for sample in samples[dut.channels + 1:]])
+        assert any(expected[i:i + len(got)] == got for i in range(2 * top)), \
+            (n, got, expected)
+
+
+def _test_bank(dut, levels, rounds):
+    # Runs every channel for `rounds` steps at a constant level. With the
+    # levels on signals, set before the first clock edge, each channel has
+    # to match the model exactly; a shared bank steps channel n in cycle
+    # n + 1 of every round, which shows in the cycle after. Levels written
+    # over the bus come in after the channels started, so there the count
+    # of ones only has to be right to within the error a PDM can have.
+    if dut.mapped:
+        for n, level in enumerate(levels):
+            yield from _test_access(dut.bus, n, level)
+        for n, level in enumerate(levels):
+            assert (yield from _test_access(dut.bus, n)) == level
+    else:
+        for signal, level in zip(dut.levels, levels):
+            yield signal.eq(level)
+
+    period = dut.channels if dut.shared else 1
+    samples = [2**dut.channels - 1]
+    for _ in range((rounds + 1) * period + 1):
+        yield
+        yield sim.Settle()
+        samples.append((yield dut.pdm_out))
+
+    for n, level in enumerate(levels):
+        offset = n + 2 - period if dut.shared else 0
+        outs = [samples[max(0, offset + r * period)] >> n & 1 for r in range(rounds)]
+        if dut.mapped:
+            ones = rounds * level / 2**dut.in_width
+            assert abs(sum(outs[1:]) - ones) <= 2, (n, level, sum(outs), ones)
+        else:
+            expected = list(pdm_model([level] * rounds, dut.in_width))
+            assert outs == expected, (n, level, outs, expected)
+
+
 class PDMCounter(Elaboratable):
-    def __init__(self, in_width=8, out_width=16, gamma=2.2):
+    """Fades `channels` levels up and down through the gamma table.
+
+    Each channel follows the same triangle, shifted by an equal part of its
+    period, so with the default 2 channels `pdm_level1` and `pdm_level2`
+    (the first two of `levels`) fade in opposite directions.
+
+    The position on the triangle only moves every `2**out_width + 1`
+    cycles, so all channels share a single read port of the table: every
+    cycle it looks up the next channel, round robin, and the levels are
+    held in registers in between. The table stays one block RAM however
+    many channels there are, up to one per cycle of a step, and a level
+    follows a step at most `channels + 1` cycles late.
+
+    With `writable` the table is behind `bus`, so another gamma curve can be
+    tried without building the design again (see `gamma_upload.py`). A read
+    borrows the port for a cycle and holds up the next lookup by as much,
+    so that bound only holds while the bus is not reading; reads back to
+    back stop the lookups altogether.
+    With `per_channel` as well, every channel has a table of its own, at
+    word address `channel << in_width`.
+    """
+
+    def __init__(self, in_width=8, out_width=16, gamma=2.2, channels=2,
+                 writable=False, per_channel=False):
+        if not 1 <= channels <= 2**out_width + 1:
+            raise ValueError("A PDMCounter has 1 to 2**out_width + 1 channels.")
+        if out_width > 32:
+            raise ValueError("Levels are at most 32 bits wide.")
         # Somewhat matter of preference whether to put submodules/Memory in
         # __init__() or elaborate, esp if submodule depends on other parameters
         # sent to __init__(). Contrast to Blinker, where Signals get maxperiod
         # in elaborate from self.maxperiod; there is no "self.gamma" here.
-        gamma_init = [int(pow(1 / 255.0 * i, gamma) * 0xFFFF)
-                      for i in range(256)]
-        self.gamma_table = Memory(width=out_width, depth=2**in_width, init=gamma_init)
+        tables = channels if per_channel else 1
+        self.gamma_table = Memory(width=out_width, depth=tables * 2**in_width,
+                                  init=gamma_table(gamma, in_width, out_width) * tables)
         self.in_width = in_width
         self.out_width = out_width
-        self.pdm_level1 = Signal(out_width)
-        self.pdm_level2 = Signal.like(self.pdm_level1)
+        self.channels = channels
+        self.writable = writable
+        self.per_channel = per_channel
+        if writable:
+            self.bus = WishboneBus(addr_width=in_width + (tables - 1).bit_length())
+        self.levels = [Signal(out_width, name="pdm_level{}".format(n + 1))
+                       for n in range(channels)]
+        self.pdm_level1 = self.levels[0]
+        if channels > 1:
+            self.pdm_level2 = self.levels[1]
 
     def elaborate(self, _platform) -> Module:
         m = Module()
 
-        m.submodules.gamma_rd_p = gamma_rd_p = self.gamma_table.read_port()
-        m.submodules.gamma_rd_n = gamma_rd_n = self.gamma_table.read_port()
+        m.submodules.gamma_rd = gamma_rd = self.gamma_table.read_port()
 
-        pdm_level_gamma_p = Signal.like(self.pdm_level2)
-        pdm_level_gamma_n = Signal.like(pdm_level_gamma_p)
         pdm_count = Signal(self.out_width + 1)
         pdm_level = Signal(self.in_width + 1)
 
@@ -136,54 +663,221 @@ class PDMCounter(Elaboratable):
                 pdm_level.eq(pdm_level + 1)
             ]
 
-        # In the Verilog version, the output data from the gamma table is in an
-        # explicit always/sync block. The default memory in amaranth has a
-        # synchronous read port (asynchronous=False), so data appears one clock
-        # cycle after addr is put on the bus. Therefore we connect nets
-        # directly.
-        m.d.comb += [
-            gamma_rd_p.addr.eq(pdm_level),
-            gamma_rd_n.addr.eq(~pdm_level),
-            pdm_level_gamma_p.eq(gamma_rd_p.data),
-            pdm_level_gamma_n.eq(gamma_rd_n.data)
+        # The read port is synchronous, so the data for the channel whose
+        # address went out in one cycle comes back in the next, while the
+        # address of the channel after it goes out.
+        channel = Signal(range(self.channels))
+        data_channel = Signal.like(channel)
+        data_valid = Signal()
+        bus_read = Signal()
+        with m.If(~bus_read):
+            m.d.sync += channel.eq(Mux(channel == self.channels - 1, 0, channel + 1))
+        m.d.sync += [
+            data_channel.eq(channel),
+            data_valid.eq(~bus_read)
         ]
 
-        with m.If(pdm_level[-1]):
-            m.d.comb += [
-                self.pdm_level1.eq(pdm_level_gamma_p),
-                self.pdm_level2.eq(pdm_level_gamma_n)
-            ]
-        with m.Else():
+        offsets = Array(n * 2**(self.in_width + 1) // self.channels
+                        for n in range(self.channels))
+        position = Signal.like(pdm_level)
+        index = Signal(self.in_width)
+        m.d.comb += [
+            position.eq(pdm_level + offsets[channel]),
+            # Up the table in the second half of the triangle, down in the first
+            index.eq(Mux(position[-1], position, ~position))
+        ]
+        if self.per_channel:
+            m.d.comb += gamma_rd.addr.eq(Cat(index, channel))
+        else:
+            m.d.comb += gamma_rd.addr.eq(index)
+
+        if self.writable:
+            m.submodules.gamma_wr = gamma_wr = self.gamma_table.write_port()
+            bus = self.bus
+            access = Signal()
             m.d.comb += [
-                self.pdm_level1.eq(pdm_level_gamma_n),
-                self.pdm_level2.eq(pdm_level_gamma_p)
+                access.eq(bus.cyc & bus.stb & ~bus.ack),
+                bus_read.eq(access & ~bus.we),
+                gamma_wr.addr.eq(bus.adr),
+                gamma_wr.data.eq(bus.dat_w),
+                gamma_wr.en.eq(access & bus.we),
+                bus.dat_r.eq(gamma_rd.data)
             ]
+            m.d.sync += bus.ack.eq(access)
+            with m.If(bus_read):
+                m.d.comb += gamma_rd.addr.eq(bus.adr)
+
+        for n, level in enumerate(self.levels):
+            with m.If(data_valid & (data_channel == n)):
+                m.d.sync += level.eq(gamma_rd.data)
 
         return m
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("-s", action="store_true", help="Simulate PDMDriver (for debugging).")
+    parser.add_argument("-s", action="store_true", help="Simulate PDMDriver, PDMCounter and PDMBank (for debugging).")
     parser.add_argument("-g", type=float, default=2.2, help="Gamma exponent (default 2.2)")
+    parser.add_argument("-o", type=int, default=1, help="Modulator order, 1 to 3 (default 1)")
+    parser.add_argument("-u", action="store_true", help="Make the gamma tables writable over the UART (see gamma_upload.py).")
+    parser.add_argument("-r", type=int, default=115200, help="Baud rate for -u (default 115200)")
+    parser.add_argument("-b", action="store_true", help="Fade all LEDs, including the break-off PMOD, with a PDMBank.")
+    parser.add_argument("-l", choices=["gpio", "rgba", "ledda"], default="gpio",
+                        help="Drive the board LEDs, or an RGB LED on pins 39-41 with PDM or SB_LEDDA_IP (default gpio)")
+    parser.add_argument("-c", action="store_true", help="Estimate the resources of PDMBank, separate PDMDrivers and SB_LEDDA_IP before synthesis (no LUT counts).")
     args = parser.parse_args()
 
     if args.s:
+        import numpy as np
+
+        # The model is what everything else is checked against, so check it
+        # once against PDMDriver, a cycle at a time.
         p = PDMDriver(8)
         s = sim.Simulator(p)
         s.add_clock(1.0 / 12e6)
+        outs = []
 
         def out_proc():
             for i in range(256):
                 yield p.pdm_in.eq(i)
-                yield
-                yield
-                yield
-                yield
+                for _ in range(4):
+                    yield sim.Settle()
+                    outs.append((yield p.pdm_out))
+                    yield
 
         s.add_sync_process(out_proc)
         with s.write_vcd("drv.vcd", "drv.gtkw", traces=[p.pdm_in, p.pdm_out]):
             s.run()
+        # The first clock edge comes before the first level.
+        expected = pdm_model(np.concatenate([[0], np.repeat(np.arange(256), 4)]), 8)[1:]
+        assert (np.array(outs) == expected).all()
+
+        # Only the first order of the model is vectorised; time it.
+        levels = np.random.RandomState(0).randint(0, 2**16, 2**24)
+        start = time.perf_counter()
+        pdm_model(levels)
+        print("Model: {:.0f} million cycles per second".format(
+            len(levels) / (time.perf_counter() - start) / 1e6))
+
+        # After that, whole windows at a time. A full fade through every
+        # value of the gamma table, up and down, for every order.
+        table = gamma_table(args.g)
+        for order in (1, 2, 3):
+            _check_pdm(PDMDriver(16, order=order), table + table[::-1])
+
+        # Sines of a few amplitudes, which change every 4 cycles. The higher
+        # orders have to push more of the noise out of the band the sines
+        # are in.
+        length = 2**14
+        signal_bin = 7
+        print("order  amplitude  SNR (dB)")
+        snrs = {}
+        for order in (1, 2, 3):
+            for amplitude in (0.02, 0.2, 0.8):
+                sine = np.sin(2 * np.pi * signal_bin * np.arange(length // 4) / (length // 4))
+                levels = (2**15 + amplitude * 2**15 * sine).astype(np.int64)
+                outs = _check_pdm(PDMDriver(16, order=order), levels, window=4)
+                snrs[order, amplitude] = pdm_snr(outs, signal_bin)
+                print("{:5}  {:9}  {:8.1f}".format(order, amplitude, snrs[order, amplitude]))
+        for amplitude in (0.02, 0.2, 0.8):
+            assert snrs[1, amplitude] + 10 < snrs[2, amplitude], amplitude
+            assert snrs[1, amplitude] + 10 < snrs[3, amplitude], amplitude
+
+        # PDMCounter with small tables, for a few numbers of channels, and
+        # with new tables written over the bus.
+        table = gamma_table(args.g, 4, 6)
+        for channels in (1, 2, 3, 7, 2**6 + 1):
+            _check_counter(PDMCounter(4, 6, args.g, channels), [table])
+        _check_counter(PDMCounter(4, 6, args.g, 2, writable=True), [gamma_table(1.0, 4, 6)],
+                       random.Random(3))
+        _check_counter(PDMCounter(4, 6, args.g, 3, writable=True, per_channel=True),
+                       [gamma_table(1.0, 4, 6), [5] * 8 + [60] * 8, table[::-1]],
+                       random.Random(4))
+
+        # The whole way from gamma_upload.upload() through a socket, the UART
+        # and the bridge, which reads the tables back to check them.
+        pads = _TestPads()
+        clk_per_bit = 4
+
+        m = Module()
+        m.submodules.uart = uart = UART(pads, clk_freq=12000000, baud_rate=3000000,
+                                        rx_fifo_depth=16)
+        m.submodules.bridge = bridge = UARTBridge()
+        m.submodules.cnt = cnt = PDMCounter(4, 6, args.g, 2, writable=True, per_channel=True)
+        m.d.comb += [
+            *uart.rx.connect(bridge.sink),
+            *bridge.source.connect(uart.tx),
+            *bridge.bus.connect(cnt.bus)
+        ]
+        s = sim.Simulator(m)
+        s.add_clock(1.0 / 12e6)
+
+        host, device = socket.socketpair()
+        host.settimeout(60)
+        done = threading.Event()
+        s.add_sync_process(_proc_wrapper(
+            _test_socket_rx(pads.rx, clk_per_bit, device, done)))
+        s.add_sync_process(_proc_wrapper(
+            _test_socket_tx(pads.tx, clk_per_bit, device, [])))
+
+        errors = []
+
+        def run_host():
+            try:
+                upload(BridgeClient(host.makefile("rwb")),
+                       [gamma_table(1.8, 4, 6), gamma_table(2.4, 4, 6, scale=0.5)], 4)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                done.set()
+
+        thread = threading.Thread(target=run_host)
+        thread.start()
+        try:
+            s.run()
+        finally:
+            done.set()
+            host.shutdown(socket.SHUT_RDWR)
+            thread.join()
+        if errors:
+            raise errors[0]
+
+        # Every kind of bank against the model of PDMDriver.
+        levels = [0, 1, 37, 128, 200, 255]
+        for shared in (False, True):
+            for mapped in (False, True):
+                dut = PDMBank(len(levels), in_width=8, shared=shared, mapped=mapped)
+                s = sim.Simulator(dut)
+                s.add_clock(1.0 / 12e6)
+
+                def bank_proc():
+                    yield from _test_bank(dut, levels, rounds=300)
+
+                s.add_sync_process(bank_proc)
+                with s.write_vcd("bank.vcd", "bank.gtkw", traces=[dut.pdm_out]):
+                    s.run()
+    elif args.c:
+        print("Pre-synthesis estimate from the netlist; no LUT counts, use yosys for those.")
+        print("channels  kind         flip-flops  memory bits  block RAMs")
+        for channels in (8, 32, 64):
+            for kind, bank in [
+                ("PDMDrivers", PDMBank(channels)),
+                ("shared", PDMBank(channels, shared=True)),
+                ("shared+bus", PDMBank(channels, shared=True, mapped=True)),
+            ]:
+                ffs, bits, brams = _resources(bank)
+                print("{:8}  {:11}  {:10}  {:11}  {:10}".format(channels, kind, ffs, bits, brams))
+        # What the LED backends of Top add to PDMCounter, for 3 colours.
+        for kind, outputs in [
+            ("PDMDrivers", [PDMDriver(order=args.o) for _ in range(3)]),
+            ("LEDDA", [_LEDDAWriter(12e6)]),
+        ]:
+            ffs, bits, brams = 0, 0, 0
+            for output in outputs:
+                ffs, bits, brams = [a + b for a, b in zip((ffs, bits, brams), _resources(output))]
+            print("{:8}  {:11}  {:10}  {:11}  {:10}".format(3, kind, ffs, bits, brams))
     else:
         plat = ICEBreakerPlatform()
-        plat.build(Top(gamma=args.g), do_program=True)
+        top = BankTop(gamma=args.g) if args.b else Top(gamma=args.g, order=args.o,
+                                                       uart=args.u, baud_rate=args.r, backend=args.l)
+        plat.build(top, do_program=True)
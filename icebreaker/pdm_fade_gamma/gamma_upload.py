@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+"""Host side of a writable `PDMCounter`: computes gamma tables and uploads
+them over a `UARTBridge`, without building the design again.
+
+Table `n` starts at word address `n << in_width`, one level per word. A
+counter with `per_channel` has a table for every channel, which is how the
+colours of an RGB LED get calibrated: a gamma and a scale for each.
+
+This file does not need amaranth, and only needs pyserial to open a serial
+port by name.
+"""
+
+from argparse import ArgumentParser
+
+# Tables of `gamma_pdm.py -u`, one for each LED
+TOP_TABLES = 2
+
+# Import the bridge client
+import sys
+import os
+if __package__:
+    from ..uart.bridge_client import BridgeClient, open_port
+else:
+    sys.path.append(os.path.dirname(__file__) + '/../uart')
+    from bridge_client import BridgeClient, open_port
+
+
+def gamma_table(gamma, in_width=8, out_width=16, scale=1.0):
+    """Maps every `in_width` bit brightness to an `out_width` bit PDM level,
+    with full brightness at `scale` times the largest level."""
+    top_in = 2**in_width - 1
+    top_out = 2**out_width - 1
+    return [int(pow(i / top_in, gamma) * top_out * scale) for i in range(2**in_width)]
+
+
+def upload(client, tables, in_width=8, verify=True):
+    """Write `tables` in one go, and read them back if `verify`."""
+    with client.batch() as batch:
+        for n, table in enumerate(tables):
+            batch.write(n << in_width, table)
+        replies = [batch.read(n << in_width, len(table)) if verify else None
+                   for n, table in enumerate(tables)]
+    for n, (table, reply) in enumerate(zip(tables, replies)):
+        if reply is not None and reply.values != list(table):
+            raise ValueError("Table {} did not read back as written.".format(n))
+
+
+def parse_list(text, count):
+    """Turns "2.2,1.8" into floats, one per table, repeating the last one."""
+    values = [float(item) for item in text.split(",")]
+    if len(values) > count:
+        raise ValueError("There are only {} tables.".format(count))
+    return values + values[-1:] * (count - len(values))
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("port", help="Serial port, or a pyserial URL like socket://host:port")
+    parser.add_argument("-b", type=int, default=115200, help="Baud rate (default 115200)")
+    parser.add_argument("-g", default="2.2", help="Gamma exponent, or one per table like 2.2,2.0 (default 2.2)")
+    parser.add_argument("-k", default="1", help="Scale of the brightest level, or one per table (default 1)")
+    parser.add_argument("-n", type=int, help="Number of tables (default as many as -g or -k give, "
+                        "at least the {} of gamma_pdm.py -u)".format(TOP_TABLES))
+    parser.add_argument("-i", type=int, default=8, help="Brightness bits (default 8)")
+    parser.add_argument("-o", type=int, default=16, help="PDM level bits (default 16)")
+    args = parser.parse_args()
+
+    # The design cannot tell how many tables it has, so fill all of those
+    # of gamma_pdm.py, and more when asked for.
+    if args.n is None:
+        args.n = max(TOP_TABLES, len(args.g.split(",")), len(args.k.split(",")))
+    tables = [gamma_table(gamma, args.i, args.o, scale)
+              for gamma, scale in zip(parse_list(args.g, args.n), parse_list(args.k, args.n))]
+    client = BridgeClient(open_port(args.port, args.b))
+    upload(client, tables, args.i)
+    print("Uploaded {} table(s) of {} levels".format(len(tables), 2**args.i))
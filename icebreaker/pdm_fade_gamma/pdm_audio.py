@@ -0,0 +1,428 @@
+#!/usr/bin/env python3
+
+import argparse
+import math
+import random
+import socket
+import threading
+import time
+
+from amaranth import *
+from amaranth.build import *
+from amaranth import sim
+from amaranth.utils import log2_int
+from amaranth_boards.icebreaker import ICEBreakerPlatform
+
+# Import the PDM driver, the UART and the host side
+import sys
+import os
+if __package__:
+    from .gamma_pdm import PDMDriver, pdm_model
+    from .audio_stream import stream
+    from ..common.stream import Stream
+    from ..uart.uart import UART, _TestPads, _proc_wrapper
+    from ..uart.uart_bridge import _test_socket_rx, _test_socket_tx
+else:
+    sys.path.append(os.path.dirname(__file__) + '/..')
+    sys.path.append(os.path.dirname(__file__) + '/../uart')
+    from gamma_pdm import PDMDriver, pdm_model
+    from audio_stream import stream
+    from common.stream import Stream
+    from uart import UART, _TestPads, _proc_wrapper
+    from uart_bridge import _test_socket_rx, _test_socket_tx
+
+# This example plays audio streamed from the host (see audio_stream.py) on
+# PMOD 1A pin 1, as PDM. A first order RC low pass, like 1 kOhm and 22 nF,
+# turns it back into something a line input or an amplifier can take.
+
+audio_pmod = [
+    Resource("pdm_audio", 0, Pins("1", dir="o", conn=("pmod", 0)), Attrs(IO_STANDARD="SB_LVCMOS33"))
+]
+
+
+class PDMAudio(Elaboratable):
+    """Plays a stream of 16 bit signed samples on a `PDMDriver`.
+
+    Samples from `sink` go into a ring buffer of `depth` words of block RAM
+    and come out at `sample_rate`, timed by a phase accumulator from
+    `clk_freq`, so they are exactly as steady as the clock. In between, the
+    level moves from one sample to the next in a straight line, in
+    `2**interpolation_bits` steps, which keeps the images of the sample
+    rate out of the output. `out` is that level, still signed.
+
+    Playback starts once `prefill` samples are buffered, half the buffer by
+    default. A sample that is due when the buffer is empty counts in
+    `underruns`; the last sample is held and playback waits to be
+    prefilled again. A sample that arrives when the buffer is full is
+    dropped and counted in `overruns`. Both counters stop at their largest
+    value and `clear` resets them. `played` pulses for every sample taken
+    from the buffer, `level` is how many are in there and `running` is high
+    while playing.
+    """
+
+    def __init__(self, clk_freq=12e6, sample_rate=44100, depth=2048, prefill=None,
+                 order=2, interpolation_bits=8, counter_width=16):
+        if sample_rate * 4 > clk_freq:
+            raise ValueError("The sample rate can be a quarter of the clock at most.")
+        log2_int(depth)
+        if prefill is None:
+            prefill = depth // 2
+        if not 0 < prefill <= depth:
+            raise ValueError("The prefill has to be 1 to {} samples.".format(depth))
+        self.depth = depth
+        self.prefill = prefill
+        self.interpolation_bits = interpolation_bits
+        # The phase accumulator is 24 bits, within 30 ppm for audio rates.
+        self.phase_width = 24
+        self.phase_inc = round(sample_rate * 2**self.phase_width / clk_freq)
+        self.actual_sample_rate = self.phase_inc * clk_freq / 2**self.phase_width
+
+        self.sink = Stream(16, name="sink")
+        self.out = Signal(signed(16))
+        self.pdm_out = Signal()
+
+        self.level = Signal(range(depth + 1))
+        self.running = Signal()
+        self.played = Signal()
+        self.underruns = Signal(counter_width)
+        self.overruns = Signal(counter_width)
+        self.clear = Signal()
+
+        self.driver = PDMDriver(in_width=16, order=order)
+
+    def elaborate(self, _platform):
+        m = Module()
+
+        buffer = Memory(width=16, depth=self.depth)
+        m.submodules.wr = wr = buffer.write_port()
+        m.submodules.rd = rd = buffer.read_port()
+        w_ptr = Signal(log2_int(self.depth) + 1)
+        r_ptr = Signal(log2_int(self.depth) + 1)
+        m.d.comb += [
+            self.level.eq(w_ptr - r_ptr),
+            wr.addr.eq(w_ptr),
+            wr.data.eq(self.sink.payload),
+            rd.addr.eq(r_ptr),
+            self.sink.ready.eq(1)
+        ]
+
+        with m.If(self.sink.valid):
+            with m.If(self.level != self.depth):
+                m.d.comb += wr.en.eq(1)
+                m.d.sync += w_ptr.eq(w_ptr + 1)
+            with m.Elif(~self.overruns.all()):
+                m.d.sync += self.overruns.eq(self.overruns + 1)
+
+        # A sample is due when the phase accumulator carries, and the top
+        # bits of the phase are how far along the way from `last` to
+        # `current` the output is.
+        phase = Signal(self.phase_width)
+        next_phase = Signal(self.phase_width)
+        due = Signal()
+        m.d.comb += Cat(next_phase, due).eq(phase + self.phase_inc)
+        m.d.sync += phase.eq(next_phase)
+
+        last = Signal(signed(16))
+        current = Signal(signed(16))
+        with m.If(due):
+            m.d.sync += last.eq(current)
+            with m.If(self.running & (self.level != 0)):
+                m.d.comb += self.played.eq(1)
+                m.d.sync += [
+                    current.eq(rd.data),
+                    r_ptr.eq(r_ptr + 1)
+                ]
+            with m.Elif(self.running):
+                m.d.sync += self.running.eq(0)
+                with m.If(~self.underruns.all()):
+                    m.d.sync += self.underruns.eq(self.underruns + 1)
+        with m.If(~self.running & (self.level >= self.prefill)):
+            m.d.sync += self.running.eq(1)
+
+        with m.If(self.clear):
+            m.d.sync += [
+                self.underruns.eq(0),
+                self.overruns.eq(0)
+            ]
+
+        step = Signal(signed(17 + self.interpolation_bits))
+        m.d.comb += step.eq((current - last) * phase[-self.interpolation_bits:])
+        m.d.sync += self.out.eq(last + (step >> self.interpolation_bits))
+
+        m.submodules.driver = self.driver
+        m.d.comb += [
+            self.driver.pdm_in.eq(self.out ^ 0x8000),
+            self.pdm_out.eq(self.driver.pdm_out)
+        ]
+
+        return m
+
+
+class UARTAudio(Elaboratable):
+    """`PDMAudio` fed from a UART, with the credits audio_stream.py paces
+    itself by.
+
+    16 bit samples come in least significant byte first. Every time
+    `credit_size` more samples were played, the `underruns` count goes back
+    as two bytes the same way. Streaming 16 bit samples takes 20 bits on
+    the line each, so 44.1 kHz needs at least 882 kbaud.
+    """
+
+    def __init__(self, serial, clk_freq=12e6, baud_rate=3000000, credit_size=256, **kwargs):
+        self.uart = UART(serial, clk_freq=clk_freq, baud_rate=baud_rate, word_width=16)
+        self.audio = PDMAudio(clk_freq=clk_freq, **kwargs)
+        self.credit_size = credit_size
+        if self.audio.depth % credit_size:
+            raise ValueError("The buffer has to hold a whole number of credits.")
+
+        self.pdm_out = self.audio.pdm_out
+
+    def elaborate(self, _platform):
+        m = Module()
+
+        m.submodules.uart = uart = self.uart
+        m.submodules.audio = audio = self.audio
+        m.d.comb += uart.rx.connect(audio.sink)
+
+        # The credits owed can pile up while the line is busy, up to one
+        # for every credit the buffer holds.
+        played = Signal(range(self.credit_size))
+        owed = Signal(range(self.audio.depth // self.credit_size + 1))
+        credit = Signal()
+        with m.If(audio.played):
+            m.d.sync += played.eq(played + 1)
+            with m.If(played == self.credit_size - 1):
+                m.d.comb += credit.eq(1)
+                m.d.sync += played.eq(0)
+        m.d.sync += owed.eq(owed + credit - uart.tx.transfer())
+        m.d.comb += [
+            uart.tx.payload.eq(audio.underruns),
+            uart.tx.valid.eq(owed != 0)
+        ]
+
+        return m
+
+
+class Top(Elaboratable):
+    """Plays audio from the UART on PMOD 1A pin 1. The green LED is on while
+    playing, the red one once there was an underrun or overrun, and the
+    button clears the counts."""
+
+    def __init__(self, sample_rate=44100, baud_rate=3000000, order=2):
+        self.sample_rate = sample_rate
+        self.baud_rate = baud_rate
+        self.order = order
+
+    def elaborate(self, platform):
+        platform.add_resources(audio_pmod)
+        serial = platform.request("uart")
+        pdm = platform.request("pdm_audio")
+        led_r = platform.request("led_r")
+        led_g = platform.request("led_g")
+        button = platform.request("button")
+
+        m = Module()
+
+        m.submodules.player = player = UARTAudio(serial, clk_freq=12e6, baud_rate=self.baud_rate,
+                                                 sample_rate=self.sample_rate, order=self.order)
+        audio = player.audio
+        m.d.comb += [
+            pdm.o.eq(player.pdm_out),
+            led_g.o.eq(audio.running),
+            led_r.o.eq((audio.underruns != 0) | (audio.overruns != 0)),
+            audio.clear.eq(button.i)
+        ]
+
+        return m
+
+
+def _test_buffer(dut, samples, gap, accepted, counts):
+    # Feeds `samples` to the sink `gap` cycles apart, keeps the ones that
+    # fit into the buffer, and the counters once it all played out.
+    for sample in samples:
+        yield sim.Settle()
+        if (yield dut.level) != dut.depth:
+            accepted.append(sample)
+        yield dut.sink.payload.eq(sample & 0xffff)
+        yield dut.sink.valid.eq(1)
+        yield
+        yield dut.sink.valid.eq(0)
+        for _ in range(gap - 1):
+            yield
+
+    # A full buffer runs dry within twice the time it takes to play.
+    for _ in range(2 * dut.depth * 2**dut.phase_width // dut.phase_inc):
+        yield
+    assert not (yield dut.running)
+    counts.append(((yield dut.underruns), (yield dut.overruns)))
+
+
+def _test_played(dut, played):
+    # Notes every sample taken out of the buffer, and the output level
+    # every cycle.
+    yield sim.Passive()
+    while True:
+        yield sim.Settle()
+        played.append(((yield dut.played), (yield dut.out)))
+        yield
+
+
+def _check_interpolation(dut, samples, trace):
+    # Checks the output level against the samples the trace says were
+    # played: from one due sample to the next, it has to follow the phase
+    # accumulator in a straight line.
+    k = dut.interpolation_bits
+    # The first clock edge comes before the first entry of the trace.
+    phase = dut.phase_inc
+    last = current = 0
+    n = 0
+    expected = []
+    for was_played, out in trace:
+        expected.append(last + (((current - last) * (phase >> (dut.phase_width - k))) >> k))
+        phase += dut.phase_inc
+        if phase >> dut.phase_width:
+            phase &= 2**dut.phase_width - 1
+            last = current
+            if was_played:
+                current = samples[n]
+                n += 1
+    outs = [out for _was_played, out in trace]
+    # The output register is a cycle behind.
+    assert outs[1:] == expected[:-1], next(
+        t for t, (a, b) in enumerate(zip(outs[1:], expected)) if a != b)
+    return n
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", action="store_true", help="Simulate the buffer and the UART path (for debugging).")
+    parser.add_argument("-a", type=int, default=44100, help="Sample rate (default 44100)")
+    parser.add_argument("-b", type=int, default=3000000, help="Baud rate (default 3000000)")
+    parser.add_argument("-o", type=int, default=2, help="Modulator order, 1 to 3 (default 2)")
+    args = parser.parse_args()
+
+    if args.s:
+        import numpy as np
+
+        rng = random.Random(21)
+        samples = [rng.randrange(-2**15, 2**15) for _ in range(40)]
+
+        # Fed faster than it plays, a buffer of 16 overflows; everything
+        # that fit is played in order, in straight lines from one sample to
+        # the next, and the buffer runs dry once at the end. A sample takes
+        # 7.3 clocks, so the phase is different every time.
+        dut = PDMAudio(clk_freq=12e6, sample_rate=12e6 / 7.3, depth=16, prefill=8)
+        s = sim.Simulator(dut)
+        s.add_clock(1.0 / 12e6)
+        accepted = []
+        trace = []
+        counts = []
+        s.add_sync_process(_proc_wrapper(_test_buffer(dut, samples, 2, accepted, counts)))
+        s.add_sync_process(_proc_wrapper(_test_played(dut, trace)))
+        with s.write_vcd("audio.vcd", "audio.gtkw", traces=[dut.sink.valid, dut.level, dut.out]):
+            s.run()
+        assert _check_interpolation(dut, accepted, trace) == len(accepted)
+        assert counts[0] == (1, len(samples) - len(accepted)), counts[0]
+        assert len(accepted) < len(samples)
+
+        # Fed just as fast as it plays, nothing is lost.
+        dut = PDMAudio(clk_freq=12e6, sample_rate=12e6 / 8, depth=16, prefill=8)
+        s = sim.Simulator(dut)
+        s.add_clock(1.0 / 12e6)
+        accepted = []
+        trace = []
+        counts = []
+        s.add_sync_process(_proc_wrapper(_test_buffer(dut, samples, 8, accepted, counts)))
+        s.add_sync_process(_proc_wrapper(_test_played(dut, trace)))
+        s.run()
+        assert accepted == samples
+        assert _check_interpolation(dut, samples, trace) == len(samples)
+        assert counts[0] == (1, 0), counts[0]
+
+        # Stream a sine through the UART with audio_stream.py, at a sample
+        # rate where the line is busy 62% of the time, with the buffer only
+        # a few credits deep. It has to arrive without underruns, and every
+        # output bit has to be what the modulator makes of the levels.
+        pads = _TestPads()
+        clk_per_bit = 4
+        depth = 64
+        credit_size = 16
+        dut = UARTAudio(pads, clk_freq=12e6, baud_rate=3000000, credit_size=credit_size,
+                        sample_rate=12e6 / 128, depth=depth)
+        audio = dut.audio
+        s = sim.Simulator(dut)
+        s.add_clock(1.0 / 12e6)
+
+        host, device = socket.socketpair()
+        host.settimeout(60)
+        done = threading.Event()
+        starts = []
+        samples = [round(30000 * math.sin(2 * math.pi * n / 50)) for n in range(400)]
+        received = []
+        counts = []
+        levels = []
+        outs = []
+
+        def monitor():
+            # What went into the buffer, and what the modulator did.
+            yield sim.Passive()
+            while True:
+                yield sim.Settle()
+                if (yield audio.sink.valid):
+                    received.append((yield audio.sink.payload.as_signed()))
+                levels.append((yield audio.driver.pdm_in))
+                outs.append((yield audio.pdm_out))
+                yield
+
+        def drain():
+            # Runs until the host is done and the buffer ran dry.
+            while not done.is_set() or (yield audio.running) or (yield audio.level):
+                for _ in range(1000):
+                    yield
+            counts.append(((yield audio.underruns), (yield audio.overruns)))
+
+        s.add_sync_process(_proc_wrapper(
+            _test_socket_rx(pads.rx, clk_per_bit, device, done)))
+        s.add_sync_process(_proc_wrapper(
+            _test_socket_tx(pads.tx, clk_per_bit, device, starts)))
+        s.add_sync_process(monitor)
+        s.add_sync_process(drain)
+
+        errors = []
+
+        def run():
+            try:
+                with s.write_vcd("audio_uart.vcd", "audio_uart.gtkw",
+                                 traces=[pads.rx, pads.tx, audio.level, audio.out]):
+                    s.run()
+            except Exception as e:
+                errors.append(e)
+                host.shutdown(socket.SHUT_RDWR)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        try:
+            underruns = stream(host.makefile("rwb"), samples, depth, credit_size)
+            # Let the last of it reach the design before the line stops.
+            deadline = time.monotonic() + 60
+            while len(received) < len(samples) + depth // 2 and time.monotonic() < deadline:
+                time.sleep(0.01)
+        finally:
+            done.set()
+            thread.join()
+        if errors:
+            raise errors[0]
+
+        assert underruns == 0, underruns
+        # Only once it all played, and not a sample was dropped.
+        assert counts[0] == (1, 0), counts[0]
+        # Everything arrived, then the silence that pushes it out.
+        assert received == samples + [0] * (depth // 2), len(received)
+        # The first clock edge comes before the first level, which was the
+        # reset value of `out`, silence.
+        expected = pdm_model([0x8000] + levels, 16, audio.driver.order)[1:]
+        mismatches = np.flatnonzero(np.array(outs) != expected)
+        assert not len(mismatches), mismatches[:10]
+    else:
+        plat = ICEBreakerPlatform()
+        plat.build(Top(sample_rate=args.a, baud_rate=args.b, order=args.o), do_program=True)
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+import argparse
+
+from amaranth import *
+from amaranth.build import *
+from amaranth import sim
+from amaranth_boards.resources import RGBLEDResource
+
+# Registers of SB_LEDDA_IP, from the iCE40 LED Driver Usage Guide (TN1288)
+LEDD_PWRR = 0b0001   # Red duty cycle
+LEDD_PWRG = 0b0010   # Green duty cycle
+LEDD_PWRB = 0b0011   # Blue duty cycle
+LEDD_BCRR = 0b0101   # Breathe on
+LEDD_BCFR = 0b0110   # Breathe off
+LEDD_CR0 = 0b1000    # Enable, 250 Hz PWM, polarity, ... and prescaler MSBs
+LEDD_BR = 0b1001     # Prescaler, clk_freq / 64 kHz - 1
+LEDD_ONR = 0b1010    # Blink on time
+LEDD_OFR = 0b1011    # Blink off time, 0 to stay on
+
+LEDD_CR0_ENABLE = 0x80
+LEDD_CR0_FR250 = 0x40
+
+
+def _current_bits(current):
+    # SB_RGBA_DRV sets the current with a thermometer code of 6 bits, in
+    # steps of 4 mA, or of 2 mA in half current mode.
+    if current % 4 == 0 and 4 <= current <= 24:
+        return False, "0b{:06b}".format(2**(current // 4) - 1)
+    if current % 2 == 0 and 2 <= current <= 12:
+        return True, "0b{:06b}".format(2**(current // 2) - 1)
+    raise ValueError("The LED current has to be 4 to 24 mA in steps of 4, "
+                     "or 2 to 12 mA in steps of 2.")
+
+
+class _LEDDAWriter(Elaboratable):
+    # Sets up SB_LEDDA_IP once, then keeps writing the three duty cycles to
+    # it, one per cycle, so a change shows up within three cycles.
+    def __init__(self, clk_freq):
+        prescaler = int(clk_freq // 64e3) - 1
+        if not 0 <= prescaler < 2**10:
+            raise ValueError("SB_LEDDA_IP needs a clock of 64 kHz to 65 MHz.")
+        self.setup = [
+            (LEDD_BR, prescaler & 0xff),
+            (LEDD_ONR, 0xff),
+            (LEDD_OFR, 0),
+            (LEDD_BCRR, 0),
+            (LEDD_BCFR, 0),
+            (LEDD_CR0, LEDD_CR0_ENABLE | LEDD_CR0_FR250 | prescaler >> 8),
+        ]
+
+        self.duty = [Signal(8, name="duty_{}".format(c)) for c in "rgb"]
+        self.addr = Signal(4)
+        self.data = Signal(8)
+        self.den = Signal()
+        self.exe = Signal()
+
+    def elaborate(self, _platform):
+        m = Module()
+
+        writes = self.setup + list(zip([LEDD_PWRR, LEDD_PWRG, LEDD_PWRB], self.duty))
+        step = Signal(range(len(writes)))
+        with m.If(step == len(writes) - 1):
+            m.d.sync += [
+                step.eq(len(self.setup)),
+                self.exe.eq(1)
+            ]
+        with m.Else():
+            m.d.sync += step.eq(step + 1)
+
+        m.d.comb += [
+            self.addr.eq(Array(addr for addr, _data in writes)[step]),
+            self.data.eq(Array(data for _addr, data in writes)[step]),
+            self.den.eq(1)
+        ]
+
+        return m
+
+
+class _LEDDAModel(Elaboratable):
+    # What SB_LEDDA_IP does with the registers _LEDDAWriter writes: 8 bit
+    # PWM at clk_freq / (prescaler + 1) / 256. Blinking and breathing are
+    # not modelled.
+    def __init__(self, writer):
+        self.writer = writer
+        self.pwm = Signal(3)
+
+    def elaborate(self, _platform):
+        m = Module()
+
+        w = self.writer
+        prescaler = Signal(10)
+        enabled = Signal()
+        duty = Array(Signal(8, name="pwr_{}".format(c)) for c in "rgb")
+        with m.If(w.den):
+            with m.Switch(w.addr):
+                with m.Case(LEDD_BR):
+                    m.d.sync += prescaler[:8].eq(w.data)
+                with m.Case(LEDD_CR0):
+                    m.d.sync += [
+                        prescaler[8:].eq(w.data[:2]),
+                        enabled.eq(w.data[7])
+                    ]
+                for n, addr in enumerate([LEDD_PWRR, LEDD_PWRG, LEDD_PWRB]):
+                    with m.Case(addr):
+                        m.d.sync += duty[n].eq(w.data)
+
+        count = Signal(10)
+        position = Signal(8)
+        with m.If(count == prescaler):
+            m.d.sync += [
+                count.eq(0),
+                position.eq(position + 1)
+            ]
+        with m.Else():
+            m.d.sync += count.eq(count + 1)
+
+        for n in range(3):
+            m.d.comb += self.pwm[n].eq(enabled & w.exe & (position < duty[n]))
+
+        return m
+
+
+class RGBADriver(Elaboratable):
+    """Drives an RGB LED through the constant current sinks of the UP5K.
+
+    SB_RGBA_DRV is hard-wired to pins 39, 40 and 41 (red, green and blue),
+    where the iCEBitsy has its RGB LED; on other boards the LED has to be
+    connected there. Each colour sinks `current` mA while it is on, so no
+    resistors are needed.
+
+    By default the `pwm` bits turn the colours on and off, so that fabric
+    logic like `PDMDriver` sets the brightness. With `ledda` the
+    SB_LEDDA_IP block does the PWM instead, at 250 Hz, from the 8 bit
+    `duty` levels, which leaves the fabric nothing to do but write them to
+    its registers.
+
+    Without a platform, as in simulation, both blocks are replaced by
+    models. Either way `leds` shows which colours are on.
+    """
+
+    def __init__(self, ledda=False, current=4, clk_freq=12e6):
+        self.half_current, self.current_bits = _current_bits(current)
+        self.ledda = ledda
+
+        self.pwm = Signal(3)
+        self.leds = Signal(3)
+        if ledda:
+            self.writer = _LEDDAWriter(clk_freq)
+            self.duty = self.writer.duty
+
+    def elaborate(self, platform):
+        m = Module()
+
+        pwm = self.pwm
+        if self.ledda:
+            m.submodules.writer = w = self.writer
+            pwm = Signal(3)
+            if platform is None:
+                m.submodules.ledda = model = _LEDDAModel(w)
+                m.d.comb += pwm.eq(model.pwm)
+            else:
+                m.submodules.ledda = Instance(
+                    "SB_LEDDA_IP",
+                    i_LEDDCS=1,
+                    i_LEDDCLK=ClockSignal(),
+                    **{"i_LEDDDAT{}".format(n): w.data[n] for n in range(8)},
+                    **{"i_LEDDADDR{}".format(n): w.addr[n] for n in range(4)},
+                    i_LEDDDEN=w.den,
+                    i_LEDDEXE=w.exe,
+                    i_LEDDRST=0,
+                    o_PWMOUT0=pwm[0],
+                    o_PWMOUT1=pwm[1],
+                    o_PWMOUT2=pwm[2],
+                )
+        m.d.comb += self.leds.eq(pwm)
+
+        if platform is not None:
+            if ("rgb_led", 0) not in platform.resources:
+                platform.add_resources([RGBLEDResource(0, r="39", g="40", b="41")])
+            rgb = platform.request("rgb_led", 0, dir={"r": "-", "g": "-", "b": "-"})
+            m.submodules.rgba = Instance(
+                "SB_RGBA_DRV",
+                p_CURRENT_MODE="0b1" if self.half_current else "0b0",
+                p_RGB0_CURRENT=self.current_bits,
+                p_RGB1_CURRENT=self.current_bits,
+                p_RGB2_CURRENT=self.current_bits,
+                i_CURREN=1,
+                i_RGBLEDEN=1,
+                i_RGB0PWM=pwm[0],
+                i_RGB1PWM=pwm[1],
+                i_RGB2PWM=pwm[2],
+                o_RGB0=rgb.r.io,
+                o_RGB1=rgb.g.io,
+                o_RGB2=rgb.b.io,
+            )
+
+        return m
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", action="store_true", help="Simulate the LED driver models (for debugging).")
+    args = parser.parse_args()
+
+    if args.s:
+        # Over two whole PWM periods, every colour has to be on for its duty
+        # cycle out of 256 steps. The clock is slowed down to 4 cycles a
+        # step, to keep the simulation short.
+        dut = RGBADriver(ledda=True, clk_freq=4 * 64e3)
+        s = sim.Simulator(dut)
+        s.add_clock(1.0 / (4 * 64e3))
+        duties = [0, 100, 255]
+
+        def ledda_proc():
+            for signal, duty in zip(dut.duty, duties):
+                yield signal.eq(duty)
+            # Wait out the setup and the rest of the first period.
+            while not (yield dut.writer.exe):
+                yield
+            for _ in range(4 * 256):
+                yield
+            on = [0, 0, 0]
+            for _ in range(2 * 4 * 256):
+                yield sim.Settle()
+                leds = yield dut.leds
+                for n in range(3):
+                    on[n] += leds >> n & 1
+                yield
+            assert on == [2 * 4 * duty for duty in duties], on
+
+        s.add_sync_process(ledda_proc)
+        with s.write_vcd("rgb_driver.vcd", "rgb_driver.gtkw", traces=[dut.leds]):
+            s.run()
+
+        # Without SB_LEDDA_IP, the LEDs follow the pwm bits.
+        dut = RGBADriver()
+        s = sim.Simulator(dut)
+
+        def pwm_proc():
+            for value in range(8):
+                yield dut.pwm.eq(value)
+                yield sim.Settle()
+                assert (yield dut.leds) == value
+
+        s.add_process(pwm_proc)
+        s.run()
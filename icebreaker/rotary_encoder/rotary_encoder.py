@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import random
 from argparse import ArgumentParser
 
 from amaranth import *
@@ -24,114 +25,284 @@ rotary_encoder_pmod = [
 ]
 
 class Top(Elaboratable):
-    def __init__(self):
-        self.iq_to_step_dir = IQToStepDir()
-        self.state = Signal(unsigned(4), reset=0b0001)
+    def __init__(self, filter_cycles=12):
+        self.decoder = QuadratureDecoder(filter_cycles=filter_cycles, reset_on_index=True)
 
     def elaborate(self, platform):
         encoder_pins = platform.request("rotary_encoder")
-        red = platform.request("led_r", 0)
-        green = platform.request("led_g", 0)
+        red = platform.request("led_r", 0).o
+        green = platform.request("led_g", 0).o
+        error = platform.request("led_r", 1).o
         leds = Cat(
-            # leds in ccw order
-            platform.request("led_g", 1),
-            platform.request("led_g", 4),
-            platform.request("led_g", 2),
-            platform.request("led_g", 3),
+            # leds in cw order
+            platform.request("led_g", 3).o,
+            platform.request("led_g", 2).o,
+            platform.request("led_g", 4).o,
+            platform.request("led_g", 1).o,
         )
 
         m = Module()
 
-        m.submodules.iq_to_step_dir = self.iq_to_step_dir
+        m.submodules.decoder = decoder = self.decoder
 
         # only change state when step happened
-        with m.If(self.iq_to_step_dir.step):
+        with m.If(decoder.step):
             m.d.sync += [
                 # on = cw, off = ccw
-                red.eq(self.iq_to_step_dir.direction),
+                red.eq(decoder.direction),
                 # toggle led
                 green.eq(1-green),
             ]
-            # shift with wrap around
-            with m.If(self.iq_to_step_dir.direction == 0):
-                m.d.sync += self.state.eq(Cat(self.state[-1:], self.state[:-1]))
-            with m.Else():
-                m.d.sync += self.state.eq(Cat(self.state[1:], self.state[:1]))
 
         m.d.comb += [
-            self.iq_to_step_dir.iq.eq(Cat(encoder_pins.in_phase, encoder_pins.quadrature)),
-            leds.eq(self.state),
+            decoder.iq.eq(Cat(encoder_pins.in_phase.i, encoder_pins.quadrature.i)),
+            # pressing the knob sets the position back to 0
+            decoder.index.eq(encoder_pins.switch.i),
+            # one led lit, going around with the position
+            leds.eq(1 << decoder.position[:2]),
+            error.eq(decoder.errors != 0),
         ]
 
         return m
 
-class IQToStepDir(Elaboratable):
-    def __init__(self):
+class GlitchFilter(Elaboratable):
+    """Passes `i` on to `o` once it has held a new value for `cycles`
+    cycles in a row, so shorter pulses never show up on `o`. Every bit is
+    filtered on its own. With `cycles` of 1 it is just a register."""
+
+    def __init__(self, width=1, cycles=1):
+        if cycles < 1:
+            raise ValueError("The glitch filter needs at least 1 cycle.")
+        self.cycles = cycles
+        self.i = Signal(width)
+        self.o = Signal(width)
+
+    def elaborate(self, _platform):
+        m = Module()
+
+        for n in range(len(self.i)):
+            count = Signal(range(self.cycles), name="count{}".format(n))
+            with m.If(self.i[n] == self.o[n]):
+                m.d.sync += count.eq(0)
+            with m.Elif(count == self.cycles - 1):
+                m.d.sync += [
+                    self.o[n].eq(self.i[n]),
+                    count.eq(0),
+                ]
+            with m.Else():
+                m.d.sync += count.eq(count + 1)
+
+        return m
+
+class QuadratureDecoder(Elaboratable):
+    """Decodes a quadrature encoder into `step`s and a signed `position`.
+
+    The I and Q inputs in `iq`, and the `index` (or switch) input, can
+    come straight from the pins: they go through two flip-flops against
+    metastability, then a `GlitchFilter` of `filter_cycles`. Decoding
+    starts 2 + `filter_cycles` cycles after an edge.
+
+    Whenever one of I and Q changed, `step` is high for a cycle, with the
+    `direction` (1 = cw), and `position` counts up or down by one a cycle
+    later. When both changed at once the encoder turned too fast to tell
+    which way: `error` is high for a cycle instead of `step`, the
+    position stays where it was, and `errors` counts it, stopping at its
+    maximum until `clear_errors`.
+
+    `index_pulse` is high for a cycle when `index` goes high, and with
+    `reset_on_index` the position goes back to 0 then. `zero` does that
+    at any time.
+
+    Every level of I and Q has to last `filter_cycles` cycles, and so does
+    the time from an edge of one to the next edge of the other, or the
+    two can swap places. With the filter at 3 cycles that is an edge
+    every 4 cycles at 12 MHz, 3 MHz, well beyond fast motor encoders.
+    """
+
+    def __init__(self, filter_cycles=1, position_width=16, error_width=8,
+                 reset_on_index=False):
+        self.reset_on_index = reset_on_index
+        self.filter = GlitchFilter(width=3, cycles=filter_cycles)
+
         # two incoming bits for in-phase and quadrature (A and B) inputs
         self.iq = Signal(2)
-        # create storage for inputs
-        self.iq_history = Array(Signal(2) for _ in range(2))
+        self.index = Signal()
+        self.zero = Signal()
+        self.clear_errors = Signal()
+
         # outgoing signals
-        self.step = Signal(1)
-        self.direction = Signal(1)
+        self.step = Signal()
+        self.direction = Signal()
+        self.error = Signal()
+        self.index_pulse = Signal()
+        self.position = Signal(signed(position_width))
+        self.errors = Signal(error_width)
 
     def elaborate(self, _platform):
         m = Module()
 
-        m.d.comb += [
-            # a step is only taken when either I or Q flip.
-            # if none flip, no step is taken
-            # if both flip, an error happend
-            self.step.eq(Cat(self.iq_history).xor()),
-            # if the former value of I is the current value of Q, we move counter clockwise
-            self.direction.eq(Cat(self.iq_history[1][0], self.iq_history[0][1]).xor()),
+        # two flip-flops, then the filter
+        synced = Signal(3)
+        sync_stage = Signal(3)
+        m.d.sync += [
+            sync_stage.eq(Cat(self.iq, self.index)),
+            synced.eq(sync_stage),
         ]
+        m.submodules.filter = self.filter
+        m.d.comb += self.filter.i.eq(synced)
 
+        # the current and former filtered state
+        iq = self.filter.o[:2]
+        index = self.filter.o[2]
+        last_iq = Signal(2)
+        last_index = Signal()
         m.d.sync += [
-            # store the current and former state
-            self.iq_history[1].eq(self.iq_history[0]),
-            self.iq_history[0].eq(self.iq),
+            last_iq.eq(iq),
+            last_index.eq(index),
+        ]
+
+        changed = Signal(2)
+        m.d.comb += [
+            changed.eq(iq ^ last_iq),
+            # a step is only taken when either I or Q flip,
+            # if both flip, an error happened
+            self.step.eq(changed.xor()),
+            self.error.eq(changed.all()),
+            # if the former value of I is the current value of Q, we move counter clockwise
+            self.direction.eq(last_iq[0] ^ iq[1]),
+            self.index_pulse.eq(index & ~last_index),
         ]
 
+        with m.If(self.zero | (self.index_pulse if self.reset_on_index else 0)):
+            m.d.sync += self.position.eq(0)
+        with m.Elif(self.step):
+            m.d.sync += self.position.eq(Mux(self.direction, self.position + 1, self.position - 1))
+
+        with m.If(self.clear_errors):
+            m.d.sync += self.errors.eq(0)
+        with m.Elif(self.error & ~self.errors.all()):
+            m.d.sync += self.errors.eq(self.errors + 1)
+
         return m
 
+def _encoder_trace(rng, edges, spacing, glitch_cycles=0, illegal=0.0, index=False,
+                   reset_on_index=False, clk_freq=12e6):
+    # Edges of an encoder turning back and forth, every `spacing` cycles
+    # give or take half a cycle, at times unrelated to the clock. Between
+    # edges there can be glitches shorter than `glitch_cycles` and index
+    # pulses, and with a chance of `illegal` both I and Q change at once.
+    # Returns the (time, bit, value) events, bit 2 being the index, and
+    # the steps, position, errors and index pulses that should come out.
+    period = 1 / clk_freq
+    seq = (0b00, 0b01, 0b11, 0b10)
+    events = []
+    phase = 0
+    turn = 1
+    index_level = 0
+    expected = {"steps": 0, "position": 0, "errors": 0, "indexes": 0}
+    for k in range(edges):
+        start = k * spacing * period
+        if glitch_cycles > 1 and rng.random() < 0.5:
+            # well after the last edge was taken, and ending well before the next
+            bit = rng.randrange(3 if index else 2)
+            level = index_level if bit == 2 else seq[phase % 4] >> bit & 1
+            begin = start + rng.uniform(0.4, 0.5) * spacing * period
+            width = rng.uniform(0.2, glitch_cycles - 1.1) * period
+            events += [(begin, bit, 1 - level), (begin + width, bit, level)]
+        if index and rng.random() < 0.1:
+            index_level = 1 - index_level
+            events.append((start + 0.7 * spacing * period, 2, index_level))
+            if index_level:
+                expected["indexes"] += 1
+                if reset_on_index:
+                    expected["position"] = 0
+
+        if rng.random() < 0.2:
+            turn = -turn
+        last = seq[phase % 4]
+        if rng.random() < illegal:
+            phase += 2
+            expected["errors"] += 1
+        else:
+            # going through seq forwards is counter clockwise
+            phase += turn
+            expected["steps"] += 1
+            expected["position"] -= turn
+        time = (k + 1) * spacing * period + rng.uniform(0, 0.5) * period
+        for bit in range(2):
+            if (last ^ seq[phase % 4]) >> bit & 1:
+                events.append((time, bit, seq[phase % 4] >> bit & 1))
+    return sorted(events), expected
+
+def _check_trace(dut, events, expected, counts, settle_time):
+    # Plays back the events of `_encoder_trace`, in between clock edges,
+    # then checks what came out against what should have, with `counts`
+    # from `_count_pulses`.
+    pins = [dut.iq[0], dut.iq[1], dut.index]
+    now = 0
+    for time, bit, value in events:
+        if time > now:
+            yield sim.Delay(time - now)
+            now = time
+        yield pins[bit].eq(value)
+    yield sim.Delay(settle_time)
+    result = dict(counts)
+    result["position"] = yield dut.position
+    result["errors"] = yield dut.errors
+    expected = dict(expected, errors=min(expected["errors"], 2**len(dut.errors) - 1))
+    assert result == expected, (result, expected)
+
+def _count_pulses(dut, counts):
+    # Counts the steps and index pulses, for as long as the simulation runs.
+    yield sim.Passive()
+    while True:
+        yield sim.Settle()
+        counts["steps"] += yield dut.step
+        counts["indexes"] += yield dut.index_pulse
+        assert not ((yield dut.step) and (yield dut.error))
+        yield
+
 if __name__ == "__main__":
     parser = ArgumentParser()
     parser.add_argument("-s", action="store_true", help="Simulate Rotary Encoder (for debugging).")
+    parser.add_argument("-f", type=int, default=12, help="Glitch filter length in cycles (default 12)")
     args = parser.parse_args()
 
     if args.s:
-        iq_to_step_dir = IQToStepDir()
-        s = sim.Simulator(iq_to_step_dir)
-        s.add_clock(1.0 / 12e6)
-
-        def out_proc():
-            seq = (0b00, 0b01, 0b11, 0b10)
-            yield iq_to_step_dir.iq.eq(0b00)
-            for _ in range(16):
-                for _ in range(4):
-                    for iq in seq:
-                        yield iq_to_step_dir.iq.eq(iq)
-                        yield
-                        yield
-                        yield
-                        yield
-                for _ in range(4):
-                    for iq in seq[::-1]:
-                        yield iq_to_step_dir.iq.eq(iq)
-                        yield
-                        yield
-                        yield
-                        yield
-
-        s.add_sync_process(out_proc)
-        with s.write_vcd("rotary_encoder.vcd", "rotary_encoder.gtkw",
-                           traces=[iq_to_step_dir.iq,
-                                   iq_to_step_dir.step,
-                                   iq_to_step_dir.direction]):
-            s.run()
+        rng = random.Random(0)
+        for filter_cycles, spacing, options in [
+                # without the filter, an edge every other cycle or so
+                (1, 2, {}),
+                # fast motor encoders, an edge every 4 cycles
+                (3, 4, {}),
+                # slower, with glitches, illegal transitions and the index
+                (4, 20, {"glitch_cycles": 4, "illegal": 0.05, "index": True,
+                         "reset_on_index": True}),
+                (2, 8, {"glitch_cycles": 2, "illegal": 0.3, "index": True,
+                        "error_width": 2})]:
+            error_width = options.pop("error_width", 8)
+            dut = QuadratureDecoder(filter_cycles=filter_cycles, error_width=error_width,
+                                    reset_on_index=options.get("reset_on_index", False))
+            events, expected = _encoder_trace(rng, 400, spacing, **options)
+            s = sim.Simulator(dut)
+            s.add_clock(1.0 / 12e6)
+            counts = {"steps": 0, "indexes": 0}
+
+            def count_proc():
+                yield from _count_pulses(dut, counts)
+
+            def trace_proc():
+                yield from _check_trace(dut, events, expected, counts, (filter_cycles + 8) / 12e6)
+
+            s.add_sync_process(count_proc)
+            s.add_process(trace_proc)
+            with s.write_vcd("rotary_encoder.vcd", "rotary_encoder.gtkw",
+                             traces=[dut.iq, dut.index, dut.step, dut.direction,
+                                     dut.error, dut.position]):
+                s.run()
+            print("filter {}, an edge every {:2} cycles: {}".format(filter_cycles, spacing, expected))
     else:
         plat = ICEBreakerPlatform()
         plat.add_resources(plat.break_off_pmod)
         plat.add_resources(rotary_encoder_pmod)
-        plat.build(Top(), do_program=True)
+        plat.build(Top(filter_cycles=args.f), do_program=True)
@@ -0,0 +1,507 @@
+#!/usr/bin/env python3
+
+import io
+import random
+import socket
+import threading
+from argparse import ArgumentParser
+from ctypes import ArgumentError
+from amaranth import *
+from amaranth.build import *
+from amaranth import sim
+from amaranth_boards.icebreaker import *
+
+# Import the UART, the bridge, the host side and the bus helpers
+import sys
+import os
+if __package__:
+    from .uart import UART, _TestPads, _proc_wrapper
+    from .uart_bridge import UARTBridge, _test_socket_rx, _test_socket_tx
+    from .bridge_client import BridgeClient
+    from .analyzer_vcd import (REGISTERS, ADDRESSES, STATUS_ARMED, STATUS_TRIGGERED,
+                               STATUS_DONE, CONTROL_ARM, CONTROL_STOP, capture, decode,
+                               write_vcd, parse_probes)
+    from ..common.wishbone import CSRBank, _test_access
+else:
+    sys.path.append(os.path.dirname(__file__) + '/..')
+    from uart import UART, _TestPads, _proc_wrapper
+    from uart_bridge import UARTBridge, _test_socket_rx, _test_socket_tx
+    from bridge_client import BridgeClient
+    from analyzer_vcd import (REGISTERS, ADDRESSES, STATUS_ARMED, STATUS_TRIGGERED,
+                              STATUS_DONE, CONTROL_ARM, CONTROL_STOP, capture, decode,
+                              write_vcd, parse_probes)
+    from common.wishbone import CSRBank, _test_access
+
+
+class _CaptureMemory(Elaboratable):
+    """Single port RAM for captures: block RAM, or the UP5K SPRAM.
+
+    `data_r` follows `addr` one cycle later. With `spram` the depth is
+    fixed at 16384 words, and in simulation a `Memory` stands in for the
+    SPRAM blocks.
+    """
+
+    def __init__(self, width, depth, spram=False):
+        self.width = width
+        self.depth = depth
+        self.spram = spram
+
+        self.addr = Signal(range(depth))
+        self.data_w = Signal(width)
+        self.data_r = Signal(width)
+        self.we = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        if self.spram and platform is not None:
+            for n in range(0, self.width, 16):
+                data_w = Signal(16)
+                data_r = Signal(16)
+                m.d.comb += [
+                    data_w.eq(self.data_w[n:n + 16]),
+                    self.data_r[n:n + 16].eq(data_r)
+                ]
+                m.submodules["spram{}".format(n // 16)] = Instance(
+                    "SB_SPRAM256KA",
+                    i_ADDRESS=self.addr,
+                    i_DATAIN=data_w,
+                    i_MASKWREN=0b1111,
+                    i_WREN=self.we,
+                    i_CHIPSELECT=1,
+                    i_CLOCK=ClockSignal(),
+                    i_STANDBY=0,
+                    i_SLEEP=0,
+                    i_POWEROFF=1,
+                    o_DATAOUT=data_r
+                )
+        else:
+            memory = Memory(width=self.width, depth=self.depth)
+            m.submodules.rdport = rdport = memory.read_port(transparent=False)
+            m.submodules.wrport = wrport = memory.write_port()
+            m.d.comb += [
+                rdport.addr.eq(self.addr),
+                self.data_r.eq(rdport.data),
+                wrport.addr.eq(self.addr),
+                wrport.data.eq(self.data_w),
+                wrport.en.eq(self.we)
+            ]
+
+        return m
+
+
+class LogicAnalyzer(Elaboratable):
+    """Captures `probes` every cycle into block RAM, for reading out over a
+    Wishbone bus.
+
+    Samples are run-length compressed: every entry holds a sample and how
+    many more cycles it stayed the same, up to `2**rle_width - 1`, so a
+    `depth` entry capture covers anything from `depth` cycles of busy
+    probes to `depth * 2**rle_width` cycles of quiet ones. An entry is one
+    32 bit word, so `width + rle_width` is at most 32. With `spram` the
+    capture goes into the UP5K SPRAM instead, 16384 entries deep.
+
+    Writing `CONTROL_ARM` to the status register starts a capture. The
+    analyzer keeps the last `pre_trigger` entries until the trigger
+    condition holds, then records until the memory is full, or until the
+    host writes `CONTROL_STOP`. The trigger sample always starts an entry
+    of its own. The registers are listed in `analyzer_vcd.py`, which also
+    has the host side.
+    """
+
+    def __init__(self, width, depth=512, rle_width=8, spram=False):
+        if spram:
+            depth = 16384
+        if width + rle_width > 32:
+            raise ArgumentError("Probes and run length have to fit in 32 bits.")
+        if depth < 2 or depth & (depth - 1):
+            raise ArgumentError("Depth has to be a power of 2.")
+
+        self.width = width
+        self.depth = depth
+        self.rle_width = rle_width
+        self.spram = spram
+
+        self.probes = Signal(width)
+
+        self.csr = CSRBank(addr_width=4, name="analyzer")
+        self.bus = self.csr.bus
+        self._registers = {}
+        for name in REGISTERS:
+            if name in ("trigger_mask", "trigger_value", "trigger_edge", "pre_trigger"):
+                self._registers[name] = self.csr.add(name)
+            else:
+                self._registers[name] = self.csr.add(name, access="r")
+
+    def elaborate(self, _platform: Platform) -> Module:
+        m = Module()
+
+        m.submodules.csr = self.csr
+        m.submodules.memory = memory = _CaptureMemory(
+            self.width + self.rle_width, self.depth, self.spram)
+
+        regs = self._registers
+        depth = self.depth
+        ptr_width = (depth - 1).bit_length()
+
+        arm = Signal()
+        stop = Signal()
+        m.d.comb += [
+            arm.eq(self.csr.w_stb["status"] & (self.bus.dat_w & CONTROL_ARM).any()),
+            stop.eq(self.csr.w_stb["status"] & (self.bus.dat_w & CONTROL_STOP).any()),
+            regs["info"].eq(self.width | self.rle_width << 8 | ptr_width << 16)
+        ]
+
+        # Trigger
+
+        previous = Signal(self.width)
+        m.d.sync += previous.eq(self.probes)
+
+        started = Signal()
+        triggered = Signal()
+        match = Signal()
+        edge = Signal()
+        trigger = Signal()
+        m.d.comb += [
+            match.eq(((self.probes ^ regs["trigger_value"]) & regs["trigger_mask"]) == 0),
+            edge.eq((regs["trigger_edge"][:self.width] == 0) |
+                    (started & (((self.probes ^ previous) & regs["trigger_edge"]) != 0))),
+            trigger.eq(match & edge)
+        ]
+
+        # Capture
+        #
+        # `run_value` has been seen for `run_length + 1` cycles. The run is
+        # written out when a different sample comes in, the length is about
+        # to overflow, at the trigger and when stopping.
+        run_value = Signal(self.width)
+        run_length = Signal(self.rle_width)
+        w_ptr = Signal(ptr_width)
+        written = Signal(range(depth + 1))
+        trigger_ptr = Signal(ptr_width)
+        pre_kept = Signal(range(depth + 1))
+        post_count = Signal(range(depth + 1))
+        pre_trigger = Signal(range(depth))
+        m.d.comb += pre_trigger.eq(Mux(regs["pre_trigger"] >= depth, depth - 1, regs["pre_trigger"]))
+
+        new_run = Signal()
+        write = Signal()
+        capturing = Signal()
+        m.d.comb += [
+            new_run.eq(~started | (self.probes != run_value) | run_length.all() |
+                       (trigger & ~triggered) | stop),
+            write.eq(capturing & started & new_run),
+            memory.data_w.eq(Cat(run_value, run_length)),
+            memory.we.eq(write)
+        ]
+
+        with m.If(capturing):
+            m.d.sync += started.eq(1)
+            with m.If(new_run):
+                m.d.sync += [
+                    run_value.eq(self.probes),
+                    run_length.eq(0)
+                ]
+            with m.Else():
+                m.d.sync += run_length.eq(run_length + 1)
+            with m.If(write):
+                m.d.sync += w_ptr.eq(w_ptr + 1)
+                with m.If(written != depth):
+                    m.d.sync += written.eq(written + 1)
+
+        # Readout
+        #
+        # The memory is pointed at the next entry as soon as `data` is read,
+        # so it shows up in time for the next read.
+        r_ptr = Signal(ptr_width)
+        pop = self.csr.r_stb["data"]
+        with m.If(pop):
+            m.d.sync += r_ptr.eq(r_ptr + 1)
+        m.d.comb += [
+            memory.addr.eq(Mux(capturing, w_ptr, Mux(pop, r_ptr + 1, r_ptr))),
+            regs["data"].eq(memory.data_r),
+            regs["trigger_index"].eq(pre_kept),
+            regs["count"].eq(pre_kept + post_count)
+        ]
+
+        entries = Signal(range(depth + 1))
+        m.d.comb += entries.eq(written + write)
+
+        with m.FSM(reset="IDLE") as fsm:
+            with m.State("IDLE"):
+                with m.If(arm):
+                    m.d.sync += [
+                        started.eq(0),
+                        triggered.eq(0),
+                        w_ptr.eq(0),
+                        written.eq(0),
+                        pre_kept.eq(0),
+                        post_count.eq(0)
+                    ]
+                    m.next = "PRE"
+
+            with m.State("PRE"):
+                m.d.comb += capturing.eq(1)
+                with m.If(stop):
+                    # Stopped before the trigger: keep all there is, which
+                    # is no more than the memory holds once it went round.
+                    kept = Mux(entries > depth, depth, entries)
+                    m.d.sync += [
+                        pre_kept.eq(kept),
+                        r_ptr.eq(w_ptr + write - kept)
+                    ]
+                    m.next = "IDLE"
+                with m.Elif(trigger):
+                    # The run that starts now is the first entry after the
+                    # trigger.
+                    m.d.sync += [
+                        triggered.eq(1),
+                        trigger_ptr.eq(w_ptr + write),
+                        pre_kept.eq(Mux(entries < pre_trigger, entries, pre_trigger))
+                    ]
+                    m.next = "POST"
+
+            with m.State("POST"):
+                m.d.comb += capturing.eq(1)
+                with m.If(write):
+                    m.d.sync += post_count.eq(post_count + 1)
+                with m.If(stop | (write & (post_count + 1 + pre_kept == depth))):
+                    m.d.sync += r_ptr.eq(trigger_ptr - pre_kept)
+                    m.next = "IDLE"
+
+        m.d.comb += regs["status"].eq(Cat(
+            ~fsm.ongoing("IDLE"),
+            triggered,
+            fsm.ongoing("IDLE") & started
+        ))
+
+        return m
+
+
+def _test_probes(probes, samples):
+    # Plays `samples` on the probes, a cycle each.
+    yield sim.Passive()
+    for sample in samples:
+        yield probes.eq(sample)
+        yield
+
+
+def _test_samples(seed, count, width=8, max_run=40):
+    # Runs of random length, some longer than an entry can hold, leaving
+    # the top two bits clear for triggering on.
+    rng = random.Random(seed)
+    samples = []
+    while len(samples) < count:
+        samples += [rng.randrange(2**(width - 2))] * rng.randrange(1, max_run)
+    return samples[:count]
+
+
+def _test_check(samples, runs, trigger_index, trigger_cycle=None):
+    # The runs have to be a stretch of `samples`, with the trigger entry
+    # starting at `trigger_cycle`.
+    captured = [sample for sample, length in runs for _ in range(length)]
+    if trigger_cycle is not None:
+        start = trigger_cycle - sum(length for _sample, length in runs[:trigger_index])
+    else:
+        start = next(n for n in range(len(samples))
+                     if samples[n:n + len(captured)] == captured)
+    assert samples[start:start + len(captured)] == captured
+
+
+def _test_capture(dut, samples, mask=0, value=0, edge=0, pre_trigger=0,
+                  trigger_cycle=None, stop_after=None, expected_pre=None,
+                  expected_count=None):
+    # Runs a capture like analyzer_vcd.capture() does, straight on the bus.
+    for name, data in [("trigger_mask", mask), ("trigger_value", value),
+                       ("trigger_edge", edge), ("pre_trigger", pre_trigger)]:
+        yield from _test_access(dut.bus, ADDRESSES[name], data)
+    yield from _test_access(dut.bus, ADDRESSES["status"], CONTROL_ARM)
+    assert (yield from _test_access(dut.bus, ADDRESSES["status"])) & STATUS_ARMED
+
+    cycles = 0
+    while not (yield from _test_access(dut.bus, ADDRESSES["status"])) & STATUS_DONE:
+        cycles += 3
+        assert cycles < len(samples)
+        if stop_after is not None and cycles >= stop_after:
+            yield from _test_access(dut.bus, ADDRESSES["status"], CONTROL_STOP)
+
+    status = yield from _test_access(dut.bus, ADDRESSES["status"])
+    assert bool(status & STATUS_TRIGGERED) == (trigger_cycle is not None)
+    info = yield from _test_access(dut.bus, ADDRESSES["info"])
+    count = yield from _test_access(dut.bus, ADDRESSES["count"])
+    trigger_index = yield from _test_access(dut.bus, ADDRESSES["trigger_index"])
+    entries = []
+    for _ in range(count):
+        entries.append((yield from _test_access(dut.bus, ADDRESSES["data"])))
+
+    assert info == dut.width | dut.rle_width << 8 | (dut.depth.bit_length() - 1) << 16
+    assert count <= dut.depth
+    if expected_count is not None:
+        assert count == expected_count, count
+    if trigger_cycle is not None:
+        assert count == dut.depth
+        if expected_pre is not None:
+            assert trigger_index == expected_pre
+        else:
+            assert 0 < trigger_index < pre_trigger
+    else:
+        assert trigger_index == count
+    _test_check(samples, decode(entries, dut.width, dut.rle_width), trigger_index,
+                trigger_cycle)
+
+
+def _test_host(client, samples_per_value, done):
+    # What analyzer_vcd.py does, from the host side of the socket.
+    try:
+        entries, trigger_index, width, rle_width = capture(
+            client, mask=0xff, value=0x80, pre_trigger=8)
+        runs = decode(entries, width, rle_width)
+        assert len(runs) == 64 and trigger_index == 8
+        assert [sample for sample, _length in runs] == list(range(0x78, 0xb8))
+        assert all(length == samples_per_value for _sample, length in runs[1:])
+
+        f = io.StringIO()
+        write_vcd(f, runs, trigger_index, parse_probes("count:8", width))
+        assert "b10000000 !" in f.getvalue()
+    finally:
+        done.set()
+
+
+class _AnalyzerTest(Elaboratable):
+    def __init__(self, baud_rate=3000000, spram=False):
+        self.baud_rate = baud_rate
+        self.spram = spram
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        serial = platform.request("uart")
+        button = platform.request("button")
+
+        m.submodules.uart = uart = UART(serial, clk_freq=12e6, baud_rate=self.baud_rate,
+                                        rx_fifo_depth=512, tx_fifo_depth=512)
+        m.submodules.bridge = bridge = UARTBridge(timeout=int(0.1 * 12e6))
+        m.submodules.analyzer = analyzer = LogicAnalyzer(8, spram=self.spram)
+        m.d.comb += [
+            *uart.rx.connect(bridge.sink),
+            *bridge.source.connect(uart.tx),
+            *bridge.bus.connect(analyzer.bus)
+        ]
+
+        # What _LoopbackTest puts on the debug pins, and then some.
+        m.d.comb += analyzer.probes.eq(Cat(
+            serial.rx,
+            serial.tx,
+            uart.rx_strobe,
+            uart.tx_strobe,
+            bridge.bus.stb,
+            bridge.bus.ack,
+            uart.rx_error,
+            button
+        ))
+
+        return m
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-s", action="store_true", help="Simulate logic analyzer (for debugging).")
+    parser.add_argument("-b", type=int, default=3000000, help="Baud rate (default 3000000)")
+    parser.add_argument("-r", action="store_true", help="Capture to SPRAM, 16384 entries deep")
+    args = parser.parse_args()
+
+    if args.s:
+        samples = _test_samples(seed=30, count=4000)
+
+        # Trigger on a value, once the top bits go high for a single cycle.
+        trigger_cycle = 1500
+        samples_value = list(samples)
+        samples_value[trigger_cycle] |= 0xc0
+        dut = LogicAnalyzer(8, depth=64, rle_width=4)
+        s = sim.Simulator(dut)
+        s.add_clock(1.0 / 12e6)
+        s.add_sync_process(_proc_wrapper(_test_probes(dut.probes, samples_value)))
+        s.add_sync_process(_proc_wrapper(_test_capture(
+            dut, samples_value, mask=0xc0, value=0xc0, pre_trigger=16,
+            trigger_cycle=trigger_cycle, expected_pre=16)))
+        with s.write_vcd("analyzer.vcd", "analyzer.gtkw",
+                         traces=[dut.probes, dut.bus.adr, dut.bus.dat_r]):
+            s.run()
+
+        # Trigger on bit 6 rising, with more pre-trigger entries asked for
+        # than were captured since arming.
+        trigger_cycle = 200
+        samples_edge = [sample | (0x40 if n >= trigger_cycle else 0)
+                        for n, sample in enumerate(samples)]
+        dut = LogicAnalyzer(8, depth=64, rle_width=4)
+        s = sim.Simulator(dut)
+        s.add_clock(1.0 / 12e6)
+        s.add_sync_process(_proc_wrapper(_test_probes(dut.probes, samples_edge)))
+        s.add_sync_process(_proc_wrapper(_test_capture(
+            dut, samples_edge, mask=0x40, value=0x40, edge=0x40, pre_trigger=60,
+            trigger_cycle=trigger_cycle)))
+        s.run()
+
+        # No trigger, stopped by hand, before the memory is full and long
+        # after it went round, like analyzer_vcd.capture() does on its
+        # timeout.
+        for stop_after in (300, 1200):
+            dut = LogicAnalyzer(8, depth=64, rle_width=4)
+            s = sim.Simulator(dut)
+            s.add_clock(1.0 / 12e6)
+            s.add_sync_process(_proc_wrapper(_test_probes(dut.probes, samples)))
+            s.add_sync_process(_proc_wrapper(_test_capture(
+                dut, samples, mask=0xc0, value=0xc0, stop_after=stop_after,
+                expected_count=64 if stop_after > 300 else None)))
+            s.run()
+
+        # The whole way from analyzer_vcd.capture() through a socket, the
+        # UART and the bridge, with a counter on the probes.
+        pads = _TestPads()
+        clk_per_bit = 4
+
+        m = Module()
+        m.submodules.uart = uart = UART(pads, clk_freq=12000000, baud_rate=3000000,
+                                        rx_fifo_depth=16)
+        m.submodules.bridge = bridge = UARTBridge()
+        m.submodules.analyzer = analyzer = LogicAnalyzer(8, depth=64, rle_width=4)
+        counter = Signal(12)
+        m.d.sync += counter.eq(counter + 1)
+        m.d.comb += [
+            *uart.rx.connect(bridge.sink),
+            *bridge.source.connect(uart.tx),
+            *bridge.bus.connect(analyzer.bus),
+            analyzer.probes.eq(counter[4:])
+        ]
+        s = sim.Simulator(m)
+        s.add_clock(1.0 / 12e6)
+
+        host, device = socket.socketpair()
+        host.settimeout(60)
+        done = threading.Event()
+        s.add_sync_process(_proc_wrapper(
+            _test_socket_rx(pads.rx, clk_per_bit, device, done)))
+        s.add_sync_process(_proc_wrapper(
+            _test_socket_tx(pads.tx, clk_per_bit, device, [])))
+
+        errors = []
+
+        def run_host():
+            try:
+                _test_host(BridgeClient(host.makefile("rwb")), 16, done)
+            except Exception as e:
+                errors.append(e)
+
+        thread = threading.Thread(target=run_host)
+        thread.start()
+        try:
+            s.run()
+        finally:
+            done.set()
+            host.shutdown(socket.SHUT_RDWR)
+            thread.join()
+        if errors:
+            raise errors[0]
+    else:
+        plat = ICEBreakerPlatform()
+        plat.build(_AnalyzerTest(baud_rate=args.b, spram=args.r), do_program=True)
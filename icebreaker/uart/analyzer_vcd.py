@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+"""Host side of `LogicAnalyzer`: arms a capture over a `UARTBridge`, reads it
+back and writes it out as a VCD file.
+
+The capture is read from the registers below, at word addresses in this
+order. Every entry stands for a run of identical samples: the sample in the
+low `width` bits, and the number of samples less one above that.
+
+This file does not need amaranth, and only needs pyserial to open a serial
+port by name.
+"""
+
+import time
+from argparse import ArgumentParser
+
+# Import the bridge client
+import sys
+import os
+if __package__:
+    from .bridge_client import BridgeClient, open_port
+else:
+    sys.path.append(os.path.dirname(__file__))
+    from bridge_client import BridgeClient, open_port
+
+REGISTERS = (
+    # Reads STATUS_* bits, write CONTROL_* bits to start and stop
+    "status",
+    # Trigger when (probes & mask) == (value & mask), and if any edge bits
+    # are set, when one of those probes changed too
+    "trigger_mask",
+    "trigger_value",
+    "trigger_edge",
+    # How many entries to keep from before the trigger
+    "pre_trigger",
+    # width | rle_width << 8 | log2(depth) << 16
+    "info",
+    # How many entries were captured, and how many of them came before the
+    # trigger
+    "count",
+    "trigger_index",
+    # Every read returns the next entry, oldest first
+    "data",
+)
+ADDRESSES = {name: address for address, name in enumerate(REGISTERS)}
+
+STATUS_ARMED = 0x1
+STATUS_TRIGGERED = 0x2
+STATUS_DONE = 0x4
+
+CONTROL_ARM = 0x1
+CONTROL_STOP = 0x2
+
+
+def capture(client, mask=0, value=0, edge=0, pre_trigger=0, timeout=10):
+    """Arm the analyzer and wait for the capture.
+
+    Stops the capture after `timeout` seconds if it did not finish by
+    itself, keeping what was captured so far. Returns `(entries,
+    trigger_index, width, rle_width)`.
+    """
+    client.write(ADDRESSES["trigger_mask"], [mask, value, edge, pre_trigger])
+    client.write(ADDRESSES["status"], [CONTROL_ARM])
+
+    deadline = time.monotonic() + timeout
+    while not client.read(ADDRESSES["status"])[0] & STATUS_DONE:
+        if time.monotonic() > deadline:
+            client.write(ADDRESSES["status"], [CONTROL_STOP])
+            deadline = float("inf")
+
+    info, count, trigger_index = client.read(ADDRESSES["info"], 3)
+    entries = client.read(ADDRESSES["data"], count, fixed=True) if count else []
+    return entries, trigger_index, info & 0xff, (info >> 8) & 0xff
+
+
+def decode(entries, width, rle_width):
+    """Splits entries into `(sample, length)` runs."""
+    return [(entry & (2**width - 1), (entry >> width) + 1) for entry in entries]
+
+
+def write_vcd(f, runs, trigger_index, probes, clk_freq=12e6):
+    """Writes the runs as a VCD file, one signal per `(name, width)` probe
+    from the least significant bit up, plus a `trigger` marker."""
+    period = round(1e12 / clk_freq)
+    codes = [chr(ord("!") + n) for n in range(len(probes) + 1)]
+
+    f.write("$timescale 1ps $end\n")
+    f.write("$scope module analyzer $end\n")
+    for code, (name, width) in zip(codes, probes):
+        f.write("$var wire {} {} {} $end\n".format(width, code, name))
+    f.write("$var wire 1 {} trigger $end\n".format(codes[-1]))
+    f.write("$upscope $end\n$enddefinitions $end\n")
+
+    def value(code, value, width):
+        if width == 1:
+            return "{}{}\n".format(value, code)
+        return "b{:b} {}\n".format(value, code)
+
+    cycle = 0
+    last = None
+    for n, (sample, length) in enumerate(runs):
+        changes = []
+        offset = 0
+        for code, (_name, width) in zip(codes, probes):
+            bits = (sample >> offset) & (2**width - 1)
+            offset += width
+            if last is None or bits != (last >> (offset - width)) & (2**width - 1):
+                changes.append(value(code, bits, width))
+        if n in (0, trigger_index):
+            changes.append(value(codes[-1], int(n == trigger_index), 1))
+        if changes:
+            f.write("#{}\n".format(cycle * period))
+            f.writelines(changes)
+        last = sample
+        cycle += length
+    f.write("#{}\n".format(cycle * period))
+
+
+def parse_probes(text, width):
+    """Turns "rx,tx,count:4" into `[("rx", 1), ("tx", 1), ("count", 4)]`,
+    with single bit probes named after their bit for whatever is left."""
+    probes = []
+    for item in filter(None, text.split(",")):
+        name, _, bits = item.partition(":")
+        probes.append((name, int(bits or 1)))
+    used = sum(bits for _name, bits in probes)
+    if used > width:
+        raise ValueError("The probes are {} bits wide, not {}.".format(width, used))
+    probes += [("probe{}".format(n), 1) for n in range(used, width)]
+    return probes
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("port", help="Serial port, or a pyserial URL like socket://host:port")
+    parser.add_argument("-b", type=int, default=3000000, help="Baud rate (default 3000000)")
+    parser.add_argument("-m", type=lambda x: int(x, 0), default=0, help="Trigger mask (default 0, trigger right away)")
+    parser.add_argument("-v", type=lambda x: int(x, 0), default=0, help="Trigger value")
+    parser.add_argument("-e", type=lambda x: int(x, 0), default=0, help="Also trigger on a change of any of these bits")
+    parser.add_argument("-p", type=int, default=0, help="Entries to keep from before the trigger")
+    parser.add_argument("-t", type=float, default=10, help="Seconds to wait before stopping the capture (default 10)")
+    parser.add_argument("-f", type=float, default=12, help="Sample clock in MHz (default 12)")
+    parser.add_argument("-n", default="", help="Probe names from bit 0 up, like rx,tx,count:4")
+    parser.add_argument("-o", default="analyzer.vcd", help="Output file (default analyzer.vcd)")
+    args = parser.parse_args()
+
+    client = BridgeClient(open_port(args.port, args.b, timeout=args.t + 1))
+    entries, trigger_index, width, rle_width = capture(
+        client, args.m, args.v, args.e, args.p, timeout=args.t)
+    runs = decode(entries, width, rle_width)
+    with open(args.o, "w") as f:
+        write_vcd(f, runs, trigger_index, parse_probes(args.n, width), args.f * 1e6)
+    print("{} samples in {} entries, trigger at sample {}".format(
+        sum(length for _sample, length in runs), len(runs),
+        sum(length for _sample, length in runs[:trigger_index])))
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+"""Host side of `UARTBridge`.
+
+Every command starts with a command byte, then the number of words less
+one, then the word address, big endian:
+
+    CMD_WRITE | [CMD_FIXED], count - 1, address[4], data[4 * count]
+    CMD_READ | [CMD_FIXED], count - 1, address[4]   -> data[4 * count]
+
+Words go over the line big endian too. The address goes up by one after
+every word, unless `CMD_FIXED` is set. Writes are not answered; commands are
+carried out in order, so a read after them returns once they are done.
+
+This file does not need amaranth, and only needs pyserial to open a serial
+port by name.
+"""
+
+from argparse import ArgumentParser
+
+CMD_WRITE = 0x01
+CMD_READ = 0x02
+CMD_FIXED = 0x04
+
+MAX_BURST = 256
+
+
+def open_port(url, baud_rate=115200, timeout=1):
+    """Open a serial port for `BridgeClient` by name or pyserial URL."""
+    import serial
+    return serial.serial_for_url(url, baudrate=baud_rate, timeout=timeout)
+
+
+class Reply:
+    """The words a batched read returns, in `values` once the batch ran."""
+
+    def __init__(self, count):
+        self.count = count
+        self.values = None
+
+
+class Batch:
+    """Commands that go to the bridge in one write.
+
+    Reads return a `Reply` right away, which is filled in by `run()`. Used as
+    a context manager, the batch runs on leaving the `with` block.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self._commands = bytearray()
+        self._replies = []
+
+    def _add(self, cmd, address, words):
+        self._commands += bytes([cmd, words - 1])
+        self._commands += address.to_bytes(4, "big")
+
+    def read(self, address, count=1, fixed=False):
+        reply = Reply(count)
+        cmd = CMD_READ | (CMD_FIXED if fixed else 0)
+        for offset in range(0, count, MAX_BURST):
+            words = min(count - offset, MAX_BURST)
+            self._add(cmd, address if fixed else address + offset, words)
+        self._replies.append(reply)
+        return reply
+
+    def write(self, address, values, fixed=False):
+        values = list(values)
+        cmd = CMD_WRITE | (CMD_FIXED if fixed else 0)
+        for offset in range(0, len(values), MAX_BURST):
+            chunk = values[offset:offset + MAX_BURST]
+            self._add(cmd, address if fixed else address + offset, len(chunk))
+            for value in chunk:
+                self._commands += (value & 0xffffffff).to_bytes(4, "big")
+
+    def run(self):
+        """Send the commands and collect the replies of all reads."""
+        self.port.write(bytes(self._commands))
+        self.port.flush()
+        self._commands = bytearray()
+
+        length = 4 * sum(reply.count for reply in self._replies)
+        data = b""
+        while len(data) < length:
+            chunk = self.port.read(length - len(data))
+            if not chunk:
+                raise TimeoutError("The bridge sent {} of {} bytes."
+                                   .format(len(data), length))
+            data += chunk
+
+        offset = 0
+        for reply in self._replies:
+            reply.values = [int.from_bytes(data[i:i + 4], "big")
+                            for i in range(offset, offset + 4 * reply.count, 4)]
+            offset += 4 * reply.count
+        self._replies = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.run()
+
+
+class BridgeClient:
+    """Reads and writes words through a `UARTBridge`.
+
+    `port` is anything with `write()`, `flush()` and a `read(n)` that returns
+    up to `n` bytes, and nothing on timeout, like a pyserial port or a file
+    made from a socket. Every call is a round trip; to make many small
+    accesses, put them in a `batch()` so they share one.
+    """
+
+    def __init__(self, port):
+        self.port = port
+
+    def batch(self):
+        return Batch(self.port)
+
+    def read(self, address, count=1, fixed=False):
+        """Read `count` words from consecutive addresses, or from the same
+        one with `fixed`."""
+        with self.batch() as batch:
+            reply = batch.read(address, count, fixed)
+        return reply.values
+
+    def write(self, address, values, fixed=False):
+        with self.batch() as batch:
+            batch.write(address, values, fixed)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("port", help="Serial port, or a pyserial URL like socket://host:port")
+    parser.add_argument("-b", type=int, default=115200, help="Baud rate (default 115200)")
+    parser.add_argument("-x", action="store_true", help="Keep the address fixed (for FIFO-like registers)")
+    commands = parser.add_subparsers(dest="command", required=True)
+    read = commands.add_parser("read", help="Read and print words")
+    read.add_argument("address", type=lambda x: int(x, 0))
+    read.add_argument("count", type=int, nargs="?", default=1)
+    write = commands.add_parser("write", help="Write words")
+    write.add_argument("address", type=lambda x: int(x, 0))
+    write.add_argument("values", type=lambda x: int(x, 0), nargs="+")
+    args = parser.parse_args()
+
+    client = BridgeClient(open_port(args.port, args.b))
+    if args.command == "read":
+        values = client.read(args.address, args.count, fixed=args.x)
+        for n, value in enumerate(values):
+            address = args.address if args.x else args.address + n
+            print("{:08x}: {:08x}".format(address, value))
+    else:
+        client.write(args.address, args.values, fixed=args.x)
+        # Writes are not answered, read back to know they are done.
+        client.read(args.address)
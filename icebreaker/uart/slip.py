@@ -0,0 +1,540 @@
+#!/usr/bin/env python3
+
+import random
+from argparse import ArgumentParser
+from ctypes import ArgumentError
+from amaranth import *
+from amaranth.build import *
+from amaranth import sim
+from amaranth_boards.icebreaker import *
+
+# Import the UART, stream and CRC helpers
+import sys
+import os
+if __package__:
+    from .uart import UART, _TestPads, _test_fifo_rx, _test_fifo_tx_monitor, _proc_wrapper
+    from ..common.stream import Stream, PacketStream
+    from ..common.crc import CRC, CRC_KINDS, crc_bytes
+else:
+    sys.path.append(os.path.dirname(__file__) + '/..')
+    from uart import UART, _TestPads, _test_fifo_rx, _test_fifo_tx_monitor, _proc_wrapper
+    from common.stream import Stream, PacketStream
+    from common.crc import CRC, CRC_KINDS, crc_bytes
+
+# RFC 1055 special characters
+END = 0xc0
+ESC = 0xdb
+ESC_END = 0xdc
+ESC_ESC = 0xdd
+
+
+def slip_encode(data, crc=None):
+    """Frame `data` (bytes) like `SLIPEncoder` does, for the host side."""
+    if crc is not None:
+        data = bytes(data) + crc_bytes(crc, data)
+    frame = bytearray()
+    for octet in data:
+        if octet == END:
+            frame += bytes([ESC, ESC_END])
+        elif octet == ESC:
+            frame += bytes([ESC, ESC_ESC])
+        else:
+            frame.append(octet)
+    frame.append(END)
+    return bytes(frame)
+
+
+class SLIPEncoder(Elaboratable):
+    """Frames packets from `sink` as SLIP on the byte stream `source`.
+
+    With `crc` set to one of the kinds in `common/crc.py`, the CRC of every
+    packet goes after it, inside the frame. Every frame ends with END and
+    nothing is sent between frames.
+
+    Bytes go out one per cycle, except for END and ESC in the data, which
+    take two.
+    """
+
+    def __init__(self, crc=None):
+        if crc is not None and crc not in CRC_KINDS:
+            raise ArgumentError("Unknown CRC {}.".format(crc))
+        self.crc = crc
+
+        self.sink = PacketStream(8, name="sink")
+        self.source = Stream(8, name="source")
+
+    def elaborate(self, _platform: Platform) -> Module:
+        m = Module()
+
+        octet = Signal(8)
+        special = Signal()
+        escaped = Signal()
+        done = Signal()
+        m.d.comb += [
+            special.eq((octet == END) | (octet == ESC)),
+            self.source.payload.eq(Mux(special,
+                                       Mux(escaped, Mux(octet == END, ESC_END, ESC_ESC), ESC),
+                                       octet)),
+            # The byte is done once it is sent, escaped if need be.
+            done.eq(self.source.transfer() & (~special | escaped))
+        ]
+
+        if self.crc is not None:
+            m.submodules.crc = crc = CRC(self.crc)
+            crc_length = crc.width // 8
+            crc_index = Signal(range(crc_length))
+            m.d.comb += [
+                crc.data.eq(self.sink.payload),
+                crc.en.eq(self.sink.transfer())
+            ]
+
+        with m.FSM(reset="DATA"):
+            with m.State("DATA"):
+                m.d.comb += [
+                    octet.eq(self.sink.payload),
+                    self.source.valid.eq(self.sink.valid),
+                    self.sink.ready.eq(done)
+                ]
+                with m.If(self.sink.transfer() & self.sink.last):
+                    if self.crc is not None:
+                        m.d.sync += crc_index.eq(0)
+                        m.next = "CRC"
+                    else:
+                        m.next = "END"
+
+            if self.crc is not None:
+                with m.State("CRC"):
+                    m.d.comb += [
+                        octet.eq(crc.value.word_select(crc_index, 8)),
+                        self.source.valid.eq(1)
+                    ]
+                    with m.If(done):
+                        m.d.sync += crc_index.eq(crc_index + 1)
+                        with m.If(crc_index == crc_length - 1):
+                            m.next = "END"
+
+            with m.State("END"):
+                m.d.comb += [
+                    self.source.payload.eq(END),
+                    self.source.valid.eq(1)
+                ]
+                with m.If(self.source.ready):
+                    if self.crc is not None:
+                        m.d.comb += crc.clear.eq(1)
+                    m.next = "DATA"
+
+        with m.If(self.source.transfer()):
+            m.d.sync += escaped.eq(special & ~escaped)
+
+        return m
+
+
+class SLIPDecoder(Elaboratable):
+    """Unframes SLIP from the byte stream `sink` into packets on `source`.
+
+    With `crc` set, the last bytes of every frame are checked as the CRC of
+    the rest and stripped. Frames are stored in a `depth` byte buffer and
+    only come out of `source` once they were received whole and checked, so
+    what comes out is always a complete, good packet.
+
+    Frames that fail the CRC, are too short for it or have a bad escape
+    sequence are counted in `bad_frames`. Frames that do not fit in the
+    buffer, because they are too long or `source` is not taken fast enough,
+    are counted in `dropped_frames`. The counters saturate and are cleared
+    by `error_clear`. Empty frames are ignored, so frames may be sent with
+    END on both sides.
+
+    `sink` takes a byte every cycle.
+    """
+
+    def __init__(self, crc=None, depth=512, error_counter_width=16):
+        if crc is not None and crc not in CRC_KINDS:
+            raise ArgumentError("Unknown CRC {}.".format(crc))
+        if depth < 2 or depth & (depth - 1):
+            raise ArgumentError("Depth has to be a power of 2.")
+        self.crc = crc
+        self.depth = depth
+
+        self.sink = Stream(8, name="sink")
+        self.source = PacketStream(8, name="source")
+        self.bad_frames = Signal(error_counter_width)
+        self.dropped_frames = Signal(error_counter_width)
+        self.error_clear = Signal()
+
+    def elaborate(self, _platform: Platform) -> Module:
+        m = Module()
+
+        crc_length = CRC_KINDS[self.crc][0] // 8 if self.crc is not None else 0
+
+        # Unescaping
+
+        octet = Signal(8)
+        octet_valid = Signal()
+        frame_end = Signal()
+        escaped = Signal()
+        bad_escape = Signal()
+        m.d.comb += self.sink.ready.eq(1)
+
+        with m.If(self.sink.valid):
+            m.d.sync += escaped.eq(~escaped & (self.sink.payload == ESC))
+            with m.If(self.sink.payload == END):
+                m.d.comb += frame_end.eq(1)
+            with m.Elif(escaped):
+                with m.Switch(self.sink.payload):
+                    with m.Case(ESC_END):
+                        m.d.comb += [
+                            octet.eq(END),
+                            octet_valid.eq(1)
+                        ]
+                    with m.Case(ESC_ESC):
+                        m.d.comb += [
+                            octet.eq(ESC),
+                            octet_valid.eq(1)
+                        ]
+                    with m.Default():
+                        m.d.comb += bad_escape.eq(1)
+            with m.Elif(self.sink.payload != ESC):
+                m.d.comb += [
+                    octet.eq(self.sink.payload),
+                    octet_valid.eq(1)
+                ]
+
+        if self.crc is not None:
+            m.submodules.crc = crc = CRC(self.crc)
+            m.d.comb += [
+                crc.data.eq(octet),
+                crc.en.eq(octet_valid),
+                crc.clear.eq(frame_end)
+            ]
+            crc_ok = crc.match
+        else:
+            crc_ok = C(1)
+
+        # Frame buffer
+        #
+        # Bytes are held back in `history` until `crc_length` more came in,
+        # so the CRC never makes it into the buffer and the final byte can
+        # be written with `last` set once END shows up. `w_ptr` runs ahead
+        # of `w_commit` while a frame comes in, and is set back when it
+        # turns out to be bad.
+        memory = Memory(width=9, depth=self.depth)
+        m.submodules.wrport = wrport = memory.write_port()
+        m.submodules.rdport = rdport = memory.read_port(transparent=True)
+
+        ptr_width = self.depth.bit_length()
+        w_ptr = Signal(ptr_width)
+        w_commit = Signal(ptr_width)
+        r_ptr = Signal(ptr_width)
+        full = Signal()
+        m.d.comb += full.eq((w_ptr - r_ptr)[:ptr_width] == self.depth)
+
+        history = Signal(8 * (crc_length + 1))
+        fill = Signal(range(crc_length + 2))
+        oldest = history[-8:]
+        bad = Signal()
+        overflow = Signal()
+        m.d.comb += [
+            wrport.addr.eq(w_ptr),
+            wrport.data.eq(oldest)
+        ]
+
+        with m.If(bad_escape):
+            m.d.sync += bad.eq(1)
+
+        with m.If(octet_valid):
+            m.d.sync += history.eq(Cat(octet, history[:-8]))
+            with m.If(fill == crc_length + 1):
+                with m.If(full):
+                    m.d.sync += overflow.eq(1)
+                with m.Elif(~overflow):
+                    m.d.comb += wrport.en.eq(1)
+                    m.d.sync += w_ptr.eq(w_ptr + 1)
+            with m.Else():
+                m.d.sync += fill.eq(fill + 1)
+
+        bad_frame = Signal()
+        dropped_frame = Signal()
+        with m.If(frame_end):
+            m.d.sync += [
+                fill.eq(0),
+                bad.eq(0),
+                overflow.eq(0)
+            ]
+            with m.If(overflow | ((fill == crc_length + 1) & full)):
+                m.d.comb += dropped_frame.eq(1)
+                m.d.sync += w_ptr.eq(w_commit)
+            with m.Elif((fill == crc_length + 1) & ~bad & ~escaped & crc_ok):
+                m.d.comb += [
+                    wrport.data.eq(Cat(oldest, C(1, 1))),
+                    wrport.en.eq(1)
+                ]
+                m.d.sync += [
+                    w_ptr.eq(w_ptr + 1),
+                    w_commit.eq(w_ptr + 1)
+                ]
+            with m.Elif((fill != 0) | bad | escaped):
+                m.d.comb += bad_frame.eq(1)
+                m.d.sync += w_ptr.eq(w_commit)
+
+        # Reading
+        #
+        # The read port is one cycle behind its address, so it is pointed at
+        # the next byte as soon as the current one is taken.
+        m.d.comb += [
+            self.source.valid.eq(r_ptr != w_commit),
+            self.source.payload.eq(rdport.data[:8]),
+            self.source.last.eq(rdport.data[8]),
+            rdport.addr.eq(Mux(self.source.transfer(), r_ptr + 1, r_ptr))
+        ]
+        with m.If(self.source.transfer()):
+            m.d.sync += r_ptr.eq(r_ptr + 1)
+
+        # Error counters
+
+        for event, counter in [(bad_frame, self.bad_frames),
+                               (dropped_frame, self.dropped_frames)]:
+            with m.If(self.error_clear):
+                m.d.sync += counter.eq(0)
+            with m.Elif(event & ~counter.all()):
+                m.d.sync += counter.eq(counter + 1)
+
+        return m
+
+
+def _test_packets(seed, count, max_length=40):
+    # Random packets, with plenty of bytes that need escaping.
+    rng = random.Random(seed)
+    return [bytes(rng.choice([END, ESC, ESC_END, ESC_ESC, rng.randrange(256)])
+                  for _ in range(rng.randrange(1, max_length + 1)))
+            for _ in range(count)]
+
+
+def _test_send(stream, packets):
+    # Offers a byte every cycle.
+    for packet in packets:
+        for n, octet in enumerate(packet):
+            yield stream.payload.eq(octet)
+            yield stream.last.eq(n == len(packet) - 1)
+            yield stream.valid.eq(1)
+            yield sim.Settle()
+            while not (yield stream.ready):
+                yield
+                yield sim.Settle()
+            yield
+    yield stream.valid.eq(0)
+
+
+def _test_send_bytes(stream, octets):
+    # Like _test_send for a decoder, which always takes a byte.
+    for octet in octets:
+        yield stream.payload.eq(octet)
+        yield stream.valid.eq(1)
+        yield
+    yield stream.valid.eq(0)
+
+
+def _test_receive(stream, packets, max_stall=0, seed=0):
+    # Checks that exactly `packets` come out, stalling now and then.
+    rng = random.Random(seed)
+    received = []
+    packet = bytearray()
+    while len(received) < len(packets):
+        if max_stall and rng.randrange(8) == 0:
+            yield stream.ready.eq(0)
+            for _ in range(rng.randrange(max_stall)):
+                yield
+        yield sim.Settle()
+        if (yield stream.valid):
+            packet.append((yield stream.payload))
+            if (yield stream.last):
+                received.append(bytes(packet))
+                packet = bytearray()
+        yield stream.ready.eq(1)
+        yield
+    yield stream.ready.eq(0)
+    assert received == packets
+    # And nothing more.
+    for _ in range(64):
+        yield
+        assert not (yield stream.valid)
+
+
+def _test_encoded(stream, packets, crc):
+    # Checks the encoder output byte for byte, and that it came out at a
+    # byte per cycle.
+    expected = b"".join(slip_encode(packet, crc) for packet in packets)
+    yield stream.ready.eq(1)
+    received = bytearray()
+    cycles = 0
+    while len(received) < len(expected):
+        yield sim.Settle()
+        if received or (yield stream.valid):
+            cycles += 1
+        if (yield stream.valid):
+            received.append((yield stream.payload))
+        yield
+    assert bytes(received) == expected
+    assert cycles == len(expected), (cycles, len(expected))
+
+
+def _test_bad_frames(dut, crc):
+    # Good frames mixed with every kind of bad one, and empty ones.
+    packets = _test_packets(seed=21, count=4)
+    frames = [slip_encode(packet, crc) for packet in packets]
+    corrupted = bytearray(frames[1])
+    corrupted[0] ^= 0x01
+    stream = (bytes([END]) + frames[0] +
+              # A flipped bit, and a frame too short to hold a CRC
+              bytes(corrupted) + bytes([0x42, END]) +
+              frames[2] +
+              # Noise, a bad escape sequence and a trailing escape
+              bytes([0x55, ESC, 0x00, 0x66, END, 0x77, ESC, END, END, END]) +
+              frames[3])
+    yield from _test_send_bytes(dut.sink, stream)
+    for _ in range(64):
+        yield
+    assert (yield dut.bad_frames) == 4
+    assert (yield dut.dropped_frames) == 0
+
+
+def _test_overflow(dut, crc):
+    # Frames that do not fit in the buffer are dropped whole.
+    short = _test_packets(seed=22, count=3, max_length=4)
+    stream = (slip_encode(short[0], crc) +
+              slip_encode(bytes(range(64)), crc) +
+              slip_encode(short[1], crc) +
+              slip_encode(short[2], crc))
+    yield from _test_send_bytes(dut.sink, stream)
+    for _ in range(16):
+        yield
+    assert (yield dut.dropped_frames) == 1
+    assert (yield dut.bad_frames) == 0
+    yield dut.error_clear.eq(1)
+    yield
+    yield dut.error_clear.eq(0)
+    yield
+    assert (yield dut.dropped_frames) == 0
+
+
+def _test_echo(tx, decoder, octets, bad_frames):
+    yield from _test_fifo_tx_monitor(tx, 4, list(octets))
+    assert (yield decoder.bad_frames) == bad_frames
+    assert (yield decoder.dropped_frames) == 0
+
+
+class _PacketEchoTest(Elaboratable):
+    def __init__(self, baud_rate=3000000, crc="crc16"):
+        self.baud_rate = baud_rate
+        self.crc = crc
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        serial = platform.request("uart")
+        leds = Cat([platform.request("led_r"), platform.request("led_g")])
+
+        m.submodules.uart = uart = UART(serial, clk_freq=12e6, baud_rate=self.baud_rate,
+                                        tx_fifo_depth=512)
+        m.submodules.decoder = decoder = SLIPDecoder(crc=self.crc)
+        m.submodules.encoder = encoder = SLIPEncoder(crc=self.crc)
+        m.d.comb += [
+            *uart.rx.connect(decoder.sink),
+            *decoder.source.connect(encoder.sink),
+            *encoder.source.connect(uart.tx),
+            leds.eq(Cat(decoder.bad_frames != 0, decoder.dropped_frames != 0))
+        ]
+
+        return m
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-s", action="store_true", help="Simulate SLIP framing (for debugging).")
+    parser.add_argument("-b", type=int, default=3000000, help="Baud rate (default 3000000)")
+    parser.add_argument("-c", choices=["none", *CRC_KINDS], default="crc16",
+                        help="CRC to append to every frame (default crc16)")
+    args = parser.parse_args()
+
+    if args.s:
+        for crc in (None, "crc16", "crc32"):
+            # Encode and decode again at a byte per cycle, with a consumer
+            # that stalls now and then.
+            encoder = SLIPEncoder(crc=crc)
+            decoder = SLIPDecoder(crc=crc)
+            m = Module()
+            m.submodules.encoder = encoder
+            m.submodules.decoder = decoder
+            m.d.comb += encoder.source.connect(decoder.sink)
+            s = sim.Simulator(m)
+            s.add_clock(1.0 / 12e6)
+
+            packets = _test_packets(seed=20, count=32)
+            s.add_sync_process(_proc_wrapper(_test_send(encoder.sink, packets)))
+            s.add_sync_process(_proc_wrapper(
+                _test_receive(decoder.source, packets, max_stall=16)))
+            with s.write_vcd("slip.vcd", "slip.gtkw",
+                             traces=[encoder.sink.payload, encoder.source.payload,
+                                     decoder.source.payload, decoder.source.last]):
+                s.run()
+
+            # The encoder on its own, against the software model.
+            dut = SLIPEncoder(crc=crc)
+            s = sim.Simulator(dut)
+            s.add_clock(1.0 / 12e6)
+            s.add_sync_process(_proc_wrapper(_test_send(dut.sink, packets)))
+            s.add_sync_process(_proc_wrapper(_test_encoded(dut.source, packets, crc)))
+            s.run()
+
+            # Bad frames are counted, and the good ones around them survive.
+            if crc is not None:
+                dut = SLIPDecoder(crc=crc)
+                s = sim.Simulator(dut)
+                s.add_clock(1.0 / 12e6)
+                good = _test_packets(seed=21, count=4)
+                s.add_sync_process(_proc_wrapper(_test_bad_frames(dut, crc)))
+                s.add_sync_process(_proc_wrapper(
+                    _test_receive(dut.source, [good[0], good[2], good[3]])))
+                s.run()
+
+            # Frames that overflow the buffer are dropped.
+            dut = SLIPDecoder(crc=crc, depth=32)
+            s = sim.Simulator(dut)
+            s.add_clock(1.0 / 12e6)
+            short = _test_packets(seed=22, count=3, max_length=4)
+            s.add_sync_process(_proc_wrapper(_test_overflow(dut, crc)))
+            s.add_sync_process(_proc_wrapper(_test_receive(dut.source, short)))
+            s.run()
+
+        # Packets echoed through the UART at 3 Mbaud, with corrupted frames
+        # in between that must not come back.
+        pads = _TestPads()
+
+        m = Module()
+        m.submodules.uart = uart = UART(pads, clk_freq=12000000, baud_rate=3000000,
+                                        tx_fifo_depth=64)
+        m.submodules.decoder = decoder = SLIPDecoder(crc="crc16")
+        m.submodules.encoder = encoder = SLIPEncoder(crc="crc16")
+        m.d.comb += [
+            *uart.rx.connect(decoder.sink),
+            *decoder.source.connect(encoder.sink),
+            *encoder.source.connect(uart.tx)
+        ]
+        s = sim.Simulator(m)
+        s.add_clock(1.0 / 12e6)
+
+        packets = _test_packets(seed=23, count=16)
+        octets = b""
+        for n, packet in enumerate(packets):
+            octets += slip_encode(packet, "crc16")
+            if n % 4 == 0:
+                octets += slip_encode(packet, "crc16")[1:]
+        echo = b"".join(slip_encode(packet, "crc16") for packet in packets)
+        s.add_sync_process(_proc_wrapper(_test_fifo_rx(pads.rx, 4, list(octets))))
+        s.add_sync_process(_proc_wrapper(_test_echo(pads.tx, decoder, echo, bad_frames=4)))
+        with s.write_vcd("slip_uart.vcd", "slip_uart.gtkw",
+                         traces=[pads.rx, pads.tx, decoder.bad_frames]):
+            s.run()
+    else:
+        plat = ICEBreakerPlatform()
+        crc = None if args.c == "none" else args.c
+        plat.build(_PacketEchoTest(baud_rate=args.b, crc=crc), do_program=True)
@@ -1,123 +1,592 @@
 #!/usr/bin/env python3
 
+import random
 from argparse import ArgumentParser
 from ctypes import ArgumentError
 from amaranth import *
 from amaranth.build import *
 from amaranth import sim
 from amaranth_boards.icebreaker import *
-
-
-def _divisor(freq_in, freq_out, max_ppm=None):
-    divisor = freq_in // freq_out
-    if divisor <= 0:
+from amaranth_boards.resources import UARTResource
+
+# Import the PLL and stream helpers
+import sys
+import os
+if __package__:
+    from ..common.pll import PLL
+    from ..common.stream import Stream, StreamFIFO, StreamPacker, StreamUnpacker
+else:
+    sys.path.append(os.path.dirname(__file__) + '/..')
+    from common.pll import PLL
+    from common.stream import Stream, StreamFIFO, StreamPacker, StreamUnpacker
+
+
+def _nco(freq_in, freq_out, max_ppm=None):
+    """Settings for a phase accumulator that overflows at `freq_out`.
+
+    Returns `(width, increment, freq, ppm)`: adding `increment` to a `width`
+    bit accumulator every `freq_in` clock carries out at `freq` on average,
+    `ppm` parts per million off the requested `freq_out`. The narrowest
+    accumulator within `max_ppm` is picked, so integer ratios end up with a
+    plain power of two counter.
+    """
+    if freq_out > freq_in:
         raise ArgumentError("Output frequency is too high.")
 
-    ppm = 100000 * ((freq_in / divisor) - freq_out) / freq_out
-    if max_ppm is not None and ppm > max_ppm:
-        raise ArgumentError("Output frequency deviation is too high.")
+    for width in range(1, 33):
+        increment = round(freq_out * 2**width / freq_in)
+        if increment == 0:
+            continue
+        freq = increment * freq_in / 2**width
+        ppm = 1e6 * (freq - freq_out) / freq_out
+        if max_ppm is None or abs(ppm) <= max_ppm:
+            return width, increment, freq, ppm
 
-    return divisor
+    raise ArgumentError("Output frequency deviation is too high.")
 
 
 class UART(Elaboratable):
-    def __init__(self, serial, clk_freq, baud_rate):
-        self.rx_data = Signal(8)
-        self.rx_ready = Signal()
-        self.rx_ack = Signal()
+    """UART with optional receive and transmit FIFOs, 8N1 by default.
+
+    Received bytes come out of the `rx` stream and bytes to send go into the
+    `tx` stream (see `common/stream.py`), so the UART can be connected
+    straight to FIFOs, packetizers or another UART. The transmitter accepts
+    the next byte while it is still sending the stop bit of the previous one,
+    so a `tx` stream that stays valid keeps the line busy with no idle time
+    between frames.
+
+    Frames carry `data_bits` (5 to 9) data bits and, with `parity` set to
+    "even", "odd", "mark" or "space", a parity bit. Received frames with the
+    wrong parity are dropped and counted in `rx_parity_errors`. Mark and
+    space parity give the 9th bit address flag of multi-drop buses, as does
+    `data_bits=9`.
+
+    With 8 data bits, `word_width` can be set to 16 or 32 to move whole
+    words through `rx` and `tx`: each word is packed from (or split into)
+    consecutive bytes, least significant byte first unless `big_endian` is
+    set. The FIFOs, their levels and flow control still count bytes.
+
+    With `rx_fifo_depth`/`tx_fifo_depth` left at 0 the UART has a single byte
+    holding register per direction. A non-zero depth inserts a `StreamFIFO`
+    between the shifter and the stream, which yosys maps to iCE40 block RAM.
+
+    Receive errors do not stop the receiver. A frame that completes while
+    the holding register is still full is dropped and counted in
+    `rx_overruns`. A frame with a low stop bit is counted in
+    `rx_framing_errors`, or in `rx_breaks` if the line was low for the whole
+    frame, and the receiver then waits for the line to go high before it
+    looks for the next start bit. `rx_error` pulses once for every error.
+    The counters are `error_counter_width` bits wide, stop at their maximum
+    and are cleared by `rx_error_clear`.
+
+    `rx_level`/`tx_level` report the FIFO fill level and
+    `rx_almost_full`/`tx_almost_full` are asserted once the level reaches
+    `rx_almost_full_level`/`tx_almost_full_level` (default: 3/4 of the depth).
+
+    With `flow_control` set, `serial` also needs `rts` and `cts` lines,
+    which are active low like on the FTDI parts. `rts` is deasserted while
+    `rx_almost_full` is (or, without a receive FIFO, while the holding
+    register is full). The threshold should leave room for the bytes the
+    host still has in flight when it notices. The transmitter does not
+    start a new frame while `cts` is deasserted, but always finishes the
+    current one.
+
+    By default the receiver samples each bit once, in the middle of the bit.
+    Setting `rx_oversampling` (typically 8 or 16) selects a receiver that
+    samples the synchronized line that many times per bit, majority-votes the
+    three samples around the bit center and realigns its bit timing on every
+    falling edge. It tolerates more baud rate error and line noise, at the
+    cost of a few more LUTs and a clock of at least `rx_oversampling` times
+    the baud rate. `rx_strobe` then pulses once per decided bit.
+
+    Bit timing comes from phase accumulators rather than integer dividers, so
+    any baud rate up to a quarter of `clk_freq` is generated within `max_ppm`
+    on average, with at most one clock cycle of jitter per bit.
+    `actual_baud_rate` and `baud_ppm` report what was achieved.
+
+    With `runtime_baud` set, the baud rate is instead set by the `divisor`
+    register: clock cycles per bit in units of 1/8 cycle, starting out at
+    `divisor_for(baud_rate)`. It is loaded from `divisor_w_data` when
+    `divisor_w_en` is high, which should happen between frames, and is
+    sized for rates down to `min_baud_rate`.
+
+    `autobaud` adds runtime baud rate detection on top of that. After reset,
+    when `autobaud_start` is pulsed and after a break, the receiver waits for
+    the host to send 0x55 and times the 8 bit periods from its start bit to
+    its last data bit, which gives the divisor directly. That byte is not
+    passed on, and `autobaud_busy` is high until it is over. The host should
+    send it after at least a frame of idle line. The oversampling receiver
+    can not be combined with either mode.
+    """
+
+    def __init__(self, serial, clk_freq, baud_rate,
+                 rx_fifo_depth=0, tx_fifo_depth=0,
+                 rx_almost_full_level=None, tx_almost_full_level=None,
+                 rx_oversampling=None, max_ppm=1000, error_counter_width=16,
+                 flow_control=False, runtime_baud=False, autobaud=False,
+                 min_baud_rate=300, data_bits=8, parity=None, word_width=None,
+                 big_endian=False):
+        self.rx_fifo_depth = rx_fifo_depth
+        self.tx_fifo_depth = tx_fifo_depth
+        if rx_almost_full_level is None:
+            rx_almost_full_level = rx_fifo_depth * 3 // 4
+        if tx_almost_full_level is None:
+            tx_almost_full_level = tx_fifo_depth * 3 // 4
+        self.rx_almost_full_level = rx_almost_full_level
+        self.tx_almost_full_level = tx_almost_full_level
+
+        if not 5 <= data_bits <= 9:
+            raise ArgumentError("Frames need 5 to 9 data bits.")
+        if parity not in (None, "even", "odd", "mark", "space"):
+            raise ArgumentError("Unknown parity {!r}.".format(parity))
+        if word_width is None:
+            word_width = data_bits
+        if word_width != data_bits and (data_bits != 8 or word_width % 8):
+            raise ArgumentError("Words have to be made of whole bytes.")
+        self.data_bits = data_bits
+        self.parity = parity
+        self.word_width = word_width
+        self.big_endian = big_endian
+
+        self.rx = Stream(word_width, name="rx")
         self.rx_error = Signal()
+        self.rx_framing_errors = Signal(error_counter_width)
+        self.rx_overruns = Signal(error_counter_width)
+        self.rx_breaks = Signal(error_counter_width)
+        self.rx_parity_errors = Signal(error_counter_width)
+        self.rx_error_clear = Signal()
         self.rx_strobe = Signal()
         self.rx_bitno = None
         self.rx_fsm = None
 
-        self.tx_data = Signal(8)
-        self.tx_ready = Signal()
-        self.tx_ack = Signal()
+        self.tx = Stream(word_width, name="tx")
         self.tx_strobe = Signal()
         self.tx_bitno = None
         self.tx_latch = None
         self.tx_fsm = None
 
-        self.serial = serial
+        self.rx_level = Signal(range(rx_fifo_depth + 1))
+        self.rx_almost_full = Signal()
+        self.tx_level = Signal(range(tx_fifo_depth + 1))
+        self.tx_almost_full = Signal()
 
-        self.divisor = _divisor(
-            freq_in=clk_freq, freq_out=baud_rate, max_ppm=50000)
+        self.serial = serial
+        self.flow_control = flow_control
+
+        if baud_rate * 4 > clk_freq:
+            raise ArgumentError("Baud rate is too high.")
+        self.clk_freq = clk_freq
+        self.runtime_baud = runtime_baud or autobaud
+        self.autobaud = autobaud
+        if self.runtime_baud:
+            if rx_oversampling:
+                raise ArgumentError("Oversampling needs a fixed baud rate.")
+            if autobaud and data_bits < 8:
+                raise ArgumentError("Auto-baud needs 8 or 9 data bits.")
+            divisor = self.divisor_for(baud_rate)
+            self.actual_baud_rate = 8 * clk_freq / divisor
+            self.baud_ppm = 1e6 * (self.actual_baud_rate - baud_rate) / baud_rate
+        else:
+            self.baud_width, self.baud_inc, self.actual_baud_rate, self.baud_ppm = _nco(
+                freq_in=clk_freq, freq_out=baud_rate, max_ppm=max_ppm)
+            divisor = 0
+
+        self.divisor = Signal(range(self.divisor_for(min_baud_rate) + 1), reset=divisor)
+        self.divisor_w_data = Signal.like(self.divisor, reset=0)
+        self.divisor_w_en = Signal()
+        self.autobaud_start = Signal()
+        self.autobaud_busy = Signal()
+        self.autobaud_fsm = None
+
+        self.rx_oversampling = rx_oversampling
+        if rx_oversampling:
+            if rx_oversampling < 4:
+                raise ArgumentError("Oversampling needs at least 4 samples per bit.")
+            self.rx_os_width, self.rx_os_inc, _, _ = _nco(
+                freq_in=clk_freq, freq_out=baud_rate * rx_oversampling,
+                max_ppm=max_ppm)
+
+    def divisor_for(self, baud_rate):
+        """`divisor` value for `baud_rate` with `runtime_baud`."""
+        return round(8 * self.clk_freq / baud_rate)
+
+    def _parity_bit(self, data):
+        if self.parity == "even":
+            return data.xor()
+        elif self.parity == "odd":
+            return ~data.xor()
+        else:
+            return C(self.parity == "mark", 1)
 
     def elaborate(self, _platform: Platform) -> Module:
         m = Module()
 
-        # RX
+        if self.runtime_baud:
+            with m.If(self.divisor_w_en):
+                m.d.sync += self.divisor.eq(self.divisor_w_data)
+
+        # FIFOs and word packing
+        #
+        # The shifters below only ever talk to the rx_shifter and tx_shifter
+        # streams. Without FIFOs and packing these are the user interface.
+
+        rx_shifter = Stream(self.data_bits, name="rx_shifter")
+        rx_hold = rx_shifter.payload
+        rx_full = rx_shifter.valid
+        rx_done = rx_shifter.ready
+
+        rx_frames = Stream(self.data_bits, name="rx_frames")
+        if self.rx_fifo_depth:
+            m.submodules.rx_fifo = rx_fifo = StreamFIFO(
+                width=self.data_bits, depth=self.rx_fifo_depth)
+            m.d.comb += [
+                *rx_shifter.connect(rx_fifo.sink),
+                *rx_fifo.source.connect(rx_frames),
+                self.rx_level.eq(rx_fifo.level),
+                self.rx_almost_full.eq(
+                    rx_fifo.level >= self.rx_almost_full_level)
+            ]
+        else:
+            m.d.comb += rx_shifter.connect(rx_frames)
+
+        if self.word_width != self.data_bits:
+            m.submodules.rx_packer = rx_packer = StreamPacker(
+                width=8, count=self.word_width // 8, big_endian=self.big_endian)
+            m.d.comb += [
+                *rx_frames.connect(rx_packer.sink),
+                *rx_packer.source.connect(self.rx)
+            ]
+        else:
+            m.d.comb += rx_frames.connect(self.rx)
+
+        tx_frames = Stream(self.data_bits, name="tx_frames")
+        if self.word_width != self.data_bits:
+            m.submodules.tx_unpacker = tx_unpacker = StreamUnpacker(
+                width=8, count=self.word_width // 8, big_endian=self.big_endian)
+            m.d.comb += [
+                *self.tx.connect(tx_unpacker.sink),
+                *tx_unpacker.source.connect(tx_frames)
+            ]
+        else:
+            m.d.comb += self.tx.connect(tx_frames)
+
+        tx_shifter = Stream(self.data_bits, name="tx_shifter")
+        tx_data = tx_shifter.payload
+        tx_valid = tx_shifter.valid
+        tx_done = tx_shifter.ready
+
+        if self.tx_fifo_depth:
+            m.submodules.tx_fifo = tx_fifo = StreamFIFO(
+                width=self.data_bits, depth=self.tx_fifo_depth)
+            m.d.comb += [
+                *tx_frames.connect(tx_fifo.sink),
+                *tx_fifo.source.connect(tx_shifter),
+                self.tx_level.eq(tx_fifo.level),
+                self.tx_almost_full.eq(
+                    tx_fifo.level >= self.tx_almost_full_level)
+            ]
+        else:
+            m.d.comb += tx_frames.connect(tx_shifter)
 
-        rx_counter = Signal(range(self.divisor))
-        m.d.comb += self.rx_strobe.eq(rx_counter == 0)
-        with m.If(rx_counter == 0):
-            m.d.sync += rx_counter.eq(self.divisor - 1)
-        with m.Else():
-            m.d.sync += rx_counter.eq(rx_counter - 1)
+        # RX
 
-        self.rx_bitno = rx_bitno = Signal(3)
+        if self.rx_oversampling:
+            # The line is synchronized, then sampled `rx_oversampling` times
+            # per bit. rx_phase counts those samples within the current bit,
+            # with the bit edge at phase 0, and the bit value is the majority
+            # of the three samples around the bit center.
+            rx_sync = Signal(2, reset=0b11)
+            rx_line = rx_sync[1]
+            m.d.sync += rx_sync.eq(Cat(self.serial.rx, rx_sync[0]))
+
+            rx_acc = Signal(self.rx_os_width)
+            rx_acc_next = Signal(self.rx_os_width + 1)
+            rx_os_strobe = Signal()
+            m.d.comb += [
+                rx_acc_next.eq(rx_acc + self.rx_os_inc),
+                rx_os_strobe.eq(rx_acc_next[-1])
+            ]
+            m.d.sync += rx_acc.eq(rx_acc_next[:-1])
+
+            center = self.rx_oversampling // 2
+            rx_phase = Signal(range(self.rx_oversampling))
+            rx_samples = Signal(2, reset=0b11)
+            rx_votes = Signal(2)
+            rx_bit = Signal()
+            rx_prev_bit = Signal(reset=1)
+
+            # A single low sample is noise; a start bit or a falling edge
+            # between bits needs two in a row.
+            rx_start = rx_os_strobe & ~rx_samples[0] & ~rx_line
+            rx_fall = rx_start & rx_samples[1]
+
+            with m.If(rx_os_strobe):
+                m.d.sync += rx_samples.eq(Cat(rx_line, rx_samples[0]))
+                with m.If(rx_phase == self.rx_oversampling - 1):
+                    m.d.sync += rx_phase.eq(0)
+                with m.Else():
+                    m.d.sync += rx_phase.eq(rx_phase + 1)
+                # Resynchronize to every falling edge that shows up near the
+                # expected bit boundary after a 1 bit, so baud rate error
+                # does not add up over the frame.
+                with m.If(rx_fall & rx_prev_bit &
+                          ((rx_phase < self.rx_oversampling // 4) |
+                           (rx_phase >= self.rx_oversampling -
+                            self.rx_oversampling // 4))):
+                    m.d.sync += rx_phase.eq(2)
+                with m.If((rx_phase == center - 1) | (rx_phase == center)):
+                    m.d.sync += rx_votes.eq(Cat(rx_line, rx_votes[0]))
+
+            m.d.comb += [
+                self.rx_strobe.eq(rx_os_strobe & (rx_phase == center + 1)),
+                rx_bit.eq((rx_votes[0] & rx_votes[1]) |
+                          (rx_votes[0] & rx_line) |
+                          (rx_votes[1] & rx_line))
+            ]
+            with m.If(self.rx_strobe):
+                m.d.sync += rx_prev_bit.eq(rx_bit)
+        else:
+            rx_line = self.serial.rx
+
+            if self.runtime_baud:
+                # The accumulator counts in 1/8 cycles and wraps at the
+                # divisor.
+                rx_acc = Signal(len(self.divisor))
+                rx_acc_next = Signal(len(self.divisor) + 1)
+                m.d.comb += [
+                    rx_acc_next.eq(rx_acc + 8),
+                    self.rx_strobe.eq(rx_acc_next >= self.divisor)
+                ]
+                with m.If(self.rx_strobe):
+                    m.d.sync += rx_acc.eq(rx_acc_next - self.divisor)
+                with m.Else():
+                    m.d.sync += rx_acc.eq(rx_acc_next)
+                rx_acc_center = (self.divisor >> 1) + 8
+            else:
+                rx_acc = Signal(self.baud_width)
+                rx_acc_next = Signal(self.baud_width + 1)
+                m.d.comb += [
+                    rx_acc_next.eq(rx_acc + self.baud_inc),
+                    self.rx_strobe.eq(rx_acc_next[-1])
+                ]
+                m.d.sync += rx_acc.eq(rx_acc_next[:-1])
+                rx_acc_center = ((2**(self.baud_width - 1) + self.baud_inc) %
+                                 2**self.baud_width)
+
+            rx_bit = rx_line
+            rx_start = ~rx_line
+
+        # The byte moves from rx_shreg to the rx_hold register at the stop
+        # bit, so the user has a whole frame to take it.
+        rx_shreg = Signal(self.data_bits)
+        with m.If(rx_done):
+            m.d.sync += rx_full.eq(0)
+
+        rx_parity_bit = Signal()
+        rx_parity_ok = Signal()
+        if self.parity:
+            m.d.comb += rx_parity_ok.eq(rx_parity_bit == self._parity_bit(rx_shreg))
+        else:
+            m.d.comb += rx_parity_ok.eq(1)
+
+        rx_overrun = Signal()
+        rx_framing_error = Signal()
+        rx_break = Signal()
+        rx_parity_error = Signal()
+
+        self.rx_bitno = rx_bitno = Signal(range(self.data_bits))
         with m.FSM(reset="IDLE") as self.rx_fsm:
             with m.State("IDLE"):
-                with m.If(~self.serial.rx):
-                    m.d.sync += rx_counter.eq(self.divisor // 2)
+                with m.If(rx_start & ~self.autobaud_busy):
+                    if self.rx_oversampling:
+                        # This is the second sample of the start bit.
+                        m.d.sync += rx_phase.eq(2)
+                    else:
+                        # Next strobe in the middle of the start bit: half a
+                        # bit after the edge, which was up to a cycle ago.
+                        m.d.sync += rx_acc.eq(rx_acc_center)
                     m.next = "START"
 
             with m.State("START"):
                 with m.If(self.rx_strobe):
-                    m.next = "DATA"
+                    if self.rx_oversampling:
+                        # Glitch on an idle line, not a start bit.
+                        with m.If(rx_bit):
+                            m.next = "IDLE"
+                        with m.Else():
+                            m.next = "DATA"
+                    else:
+                        m.next = "DATA"
 
             with m.State("DATA"):
                 with m.If(self.rx_strobe):
                     m.d.sync += [
-                        self.rx_data.eq(
-                            Cat(self.rx_data[1:8], self.serial.rx)),
+                        rx_shreg.eq(Cat(rx_shreg[1:], rx_bit)),
                         rx_bitno.eq(rx_bitno + 1)
                     ]
-                    with m.If(rx_bitno == 7):
+                    with m.If(rx_bitno == self.data_bits - 1):
+                        m.d.sync += rx_bitno.eq(0)
+                        m.next = "PARITY" if self.parity else "STOP"
+
+            if self.parity:
+                with m.State("PARITY"):
+                    with m.If(self.rx_strobe):
+                        m.d.sync += rx_parity_bit.eq(rx_bit)
                         m.next = "STOP"
 
             with m.State("STOP"):
                 with m.If(self.rx_strobe):
-                    with m.If(~self.serial.rx):
-                        m.next = "ERROR"
+                    with m.If(rx_bit):
+                        m.next = "IDLE"
+                        with m.If(~rx_parity_ok):
+                            m.d.comb += rx_parity_error.eq(1)
+                        with m.Elif(~rx_full | rx_done):
+                            m.d.sync += [
+                                rx_hold.eq(rx_shreg),
+                                rx_full.eq(1)
+                            ]
+                        with m.Else():
+                            m.d.comb += rx_overrun.eq(1)
+                    with m.Elif((rx_shreg == 0) & ~rx_parity_bit):
+                        m.d.comb += rx_break.eq(1)
+                        m.next = "RECOVER"
                     with m.Else():
-                        m.next = "FULL"
+                        m.d.comb += rx_framing_error.eq(1)
+                        m.next = "RECOVER"
 
-            with m.State("FULL"):
-                m.d.comb += self.rx_ready.eq(1)
-                with m.If(self.rx_ack):
+            with m.State("RECOVER"):
+                # Do not take the rest of a broken frame, or a break, for
+                # start bits.
+                with m.If(self.rx_strobe & rx_bit):
                     m.next = "IDLE"
-                with m.Elif(~self.serial.rx):
-                    m.next = "ERROR"
 
-            with m.State("ERROR"):
-                m.d.comb += self.rx_error.eq(1)
+        m.d.comb += self.rx_error.eq(rx_overrun | rx_framing_error | rx_break |
+                                     rx_parity_error)
+        for event, counter in [(rx_overrun, self.rx_overruns),
+                               (rx_framing_error, self.rx_framing_errors),
+                               (rx_break, self.rx_breaks),
+                               (rx_parity_error, self.rx_parity_errors)]:
+            with m.If(self.rx_error_clear):
+                m.d.sync += counter.eq(0)
+            with m.Elif(event & ~counter.all()):
+                m.d.sync += counter.eq(counter + 1)
+
+        # Auto-baud
+
+        if self.autobaud:
+            # The line is timed from the first to the fifth falling edge of
+            # 0x55, and the first two bits have to take about a quarter of
+            # that, or it was not 0x55 and the search starts over.
+            ab_sync = Signal(3, reset=0b111)
+            ab_fall = Signal()
+            m.d.sync += ab_sync.eq(Cat(self.serial.rx, ab_sync[:2]))
+            m.d.comb += ab_fall.eq(ab_sync[2] & ~ab_sync[1])
+
+            ab_count = Signal.like(self.divisor, reset=0)
+            ab_first = Signal.like(self.divisor, reset=0)
+            ab_edges = Signal(2)
+            ab_valid = Signal()
+            m.d.comb += ab_valid.eq(
+                (ab_count >= 31) &
+                ((ab_first << 2) >= ab_count - (ab_count >> 3)) &
+                ((ab_first << 2) <= ab_count + (ab_count >> 3)))
+
+            with m.FSM(reset="WAIT_IDLE") as self.autobaud_fsm:
+                with m.State("WAIT_IDLE"):
+                    m.d.comb += self.autobaud_busy.eq(1)
+                    with m.If(ab_sync[1]):
+                        m.next = "HUNT"
+
+                with m.State("HUNT"):
+                    m.d.comb += self.autobaud_busy.eq(1)
+                    with m.If(ab_fall):
+                        m.d.sync += [
+                            ab_count.eq(1),
+                            ab_edges.eq(0)
+                        ]
+                        m.next = "MEASURE"
+
+                with m.State("MEASURE"):
+                    m.d.comb += self.autobaud_busy.eq(1)
+                    m.d.sync += ab_count.eq(ab_count + 1)
+                    with m.If(ab_count.all()):
+                        m.next = "WAIT_IDLE"
+                    with m.Elif(ab_fall):
+                        m.d.sync += ab_edges.eq(ab_edges + 1)
+                        with m.If(ab_edges == 0):
+                            m.d.sync += ab_first.eq(ab_count)
+                        with m.If(ab_edges == 3):
+                            with m.If(ab_valid):
+                                m.d.sync += self.divisor.eq(ab_count)
+                                m.next = "SETTLE"
+                            with m.Else():
+                                m.next = "WAIT_IDLE"
+
+                with m.State("SETTLE"):
+                    # Let the last data bit of 0x55 pass.
+                    m.d.comb += self.autobaud_busy.eq(1)
+                    with m.If(ab_sync[1]):
+                        m.next = "DONE"
+
+                with m.State("DONE"):
+                    with m.If(self.autobaud_start | rx_break):
+                        m.next = "WAIT_IDLE"
+
+        # Flow control
+
+        tx_cts = Signal()
+        if self.flow_control:
+            if self.rx_fifo_depth:
+                m.d.sync += self.serial.rts.eq(self.rx_almost_full)
+            else:
+                m.d.sync += self.serial.rts.eq(rx_full)
+
+            tx_cts_sync = Signal(2, reset=0b11)
+            m.d.sync += tx_cts_sync.eq(Cat(self.serial.cts, tx_cts_sync[0]))
+            m.d.comb += tx_cts.eq(~tx_cts_sync[1])
+        else:
+            m.d.comb += tx_cts.eq(1)
 
         # TX
 
-        tx_counter = Signal(range(self.divisor))
-        m.d.comb += self.tx_strobe.eq(tx_counter == 0)
-        with m.If(tx_counter == 0):
-            m.d.sync += tx_counter.eq(self.divisor - 1)
-        with m.Else():
-            m.d.sync += tx_counter.eq(tx_counter - 1)
+        if self.runtime_baud:
+            tx_acc = Signal(len(self.divisor))
+            tx_acc_next = Signal(len(self.divisor) + 1)
+            m.d.comb += [
+                tx_acc_next.eq(tx_acc + 8),
+                self.tx_strobe.eq(tx_acc_next >= self.divisor)
+            ]
+            with m.If(self.tx_strobe):
+                m.d.sync += tx_acc.eq(tx_acc_next - self.divisor)
+            with m.Else():
+                m.d.sync += tx_acc.eq(tx_acc_next)
+        else:
+            tx_acc = Signal(self.baud_width)
+            tx_acc_next = Signal(self.baud_width + 1)
+            m.d.comb += [
+                tx_acc_next.eq(tx_acc + self.baud_inc),
+                self.tx_strobe.eq(tx_acc_next[-1])
+            ]
+            m.d.sync += tx_acc.eq(tx_acc_next[:-1])
 
-        self.tx_bitno = tx_bitno = Signal(3)
-        self.tx_latch = tx_latch = Signal(8)
+        self.tx_bitno = tx_bitno = Signal(range(self.data_bits))
+        self.tx_latch = tx_latch = Signal(self.data_bits)
+        tx_parity_bit = Signal()
         with m.FSM(reset="IDLE") as self.tx_fsm:
             with m.State("IDLE"):
-                m.d.comb += self.tx_ack.eq(1)
-                with m.If(self.tx_ready):
-                    m.d.sync += [
-                        tx_counter.eq(self.divisor - 1),
-                        tx_latch.eq(self.tx_data)
-                    ]
+                m.d.comb += tx_done.eq(1)
+                with m.If(tx_valid):
+                    # tx_acc keeps running, so the start bit goes out on the
+                    # strobe that ends the previous stop bit.
+                    m.d.sync += tx_latch.eq(tx_data)
+                    if self.parity:
+                        m.d.sync += tx_parity_bit.eq(self._parity_bit(tx_data))
                     m.next = "START"
                 with m.Else():
                     m.d.sync += self.serial.tx.eq(1)
 
             with m.State("START"):
-                with m.If(self.tx_strobe):
+                with m.If(self.tx_strobe & tx_cts):
                     m.d.sync += self.serial.tx.eq(0)
                     m.next = "DATA"
 
@@ -125,10 +594,17 @@ class UART(Elaboratable):
                 with m.If(self.tx_strobe):
                     m.d.sync += [
                         self.serial.tx.eq(tx_latch[0]),
-                        tx_latch.eq(Cat(tx_latch[1:8], 0)),
+                        tx_latch.eq(Cat(tx_latch[1:], 0)),
                         tx_bitno.eq(tx_bitno + 1)
                     ]
-                    with m.If(self.tx_bitno == 7):
+                    with m.If(self.tx_bitno == self.data_bits - 1):
+                        m.d.sync += tx_bitno.eq(0)
+                        m.next = "PARITY" if self.parity else "STOP"
+
+            if self.parity:
+                with m.State("PARITY"):
+                    with m.If(self.tx_strobe):
+                        m.d.sync += self.serial.tx.eq(tx_parity_bit)
                         m.next = "STOP"
 
             with m.State("STOP"):
@@ -141,8 +617,12 @@ class UART(Elaboratable):
 
 class _TestPads(Elaboratable):
     def __init__(self):
+        # Only holds the lines the tests drive, nothing to elaborate.
+        self._MustUse__silence = True
         self.rx = Signal(reset=1)
         self.tx = Signal()
+        self.rts = Signal()
+        self.cts = Signal()
 
     def elaborate(self, _platform: Platform) -> Module:
         m = Module()
@@ -163,12 +643,12 @@ def _test_rx(rx, dut):
     def S():
         yield from B(0)
         assert (yield dut.rx_error) == 0
-        assert (yield dut.rx_ready) == 0
+        assert (yield dut.rx.valid) == 0
 
     def D(bit):
         yield from B(bit)
         assert (yield dut.rx_error) == 0
-        assert (yield dut.rx_ready) == 0
+        assert (yield dut.rx.valid) == 0
 
     def E():
         yield from B(1)
@@ -182,23 +662,18 @@ def _test_rx(rx, dut):
 
     def A(octet):
         yield from T()
-        assert (yield dut.rx_data) == octet
-        yield dut.rx_ack.eq(1)
-        while (yield dut.rx_ready) == 1:
+        assert (yield dut.rx.payload) == octet
+        yield dut.rx.ready.eq(1)
+        while (yield dut.rx.valid) == 1:
             yield
-        yield dut.rx_ack.eq(0)
+        yield dut.rx.ready.eq(0)
 
-    def F():
+    def F(counter, count):
+        # The error is counted, and once the line is back high the receiver
+        # takes the next frame without being reset.
+        yield from B(1)
         yield from T()
-        assert (yield dut.rx_error) == 1
-        yield rx.eq(1)
-        yield ResetSignal("sync").eq(1)
-        yield
-        yield
-        yield ResetSignal("sync").eq(0)
-        yield
-        yield
-        assert (yield dut.rx_error) == 0
+        assert (yield counter) == count
 
     # bit patterns
     yield from O([1, 0, 1, 0, 1, 0, 1, 0])
@@ -216,13 +691,36 @@ def _test_rx(rx, dut):
     yield from S()
     for bit in [1, 1, 1, 1, 1, 1, 1, 1]:
         yield from D(bit)
-    yield from S()
-    yield from F()
+    yield from B(0)
+    yield from F(dut.rx_framing_errors, 1)
+    yield from O([0, 0, 1, 1, 1, 1, 0, 0])
+    yield from A(0x3C)
 
-    # overflow error
+    # break
+    for _ in range(20):
+        yield from B(0)
+    yield from F(dut.rx_breaks, 1)
+    assert (yield dut.rx_framing_errors) == 1
+    yield from O([1, 0, 1, 0, 1, 0, 1, 0])
+    yield from A(0x55)
+
+    # overflow error, the byte that was already received is kept
     yield from O([1, 1, 1, 1, 1, 1, 1, 1])
-    yield from B(0)
-    yield from F()
+    for bit in [0, 0, 0, 0, 0, 0, 0, 0, 0, 1]:
+        yield from B(bit)
+        assert (yield dut.rx.valid) == 1
+    yield from F(dut.rx_overruns, 1)
+    yield from A(0xFF)
+    yield from O([1, 1, 0, 0, 0, 0, 1, 1])
+    yield from A(0xC3)
+
+    yield dut.rx_error_clear.eq(1)
+    yield
+    yield dut.rx_error_clear.eq(0)
+    yield
+    assert (yield dut.rx_framing_errors) == 0
+    assert (yield dut.rx_breaks) == 0
+    assert (yield dut.rx_overruns) == 0
 
 
 def _test_tx(tx, dut):
@@ -242,22 +740,22 @@ def _test_tx(tx, dut):
 
     def S(octet):
         assert (yield tx) == 1
-        assert (yield dut.tx_ack) == 1
-        yield dut.tx_data.eq(octet)
-        yield dut.tx_ready.eq(1)
+        assert (yield dut.tx.ready) == 1
+        yield dut.tx.payload.eq(octet)
+        yield dut.tx.valid.eq(1)
         while (yield tx) == 1:
             yield
-        yield dut.tx_ready.eq(0)
+        yield dut.tx.valid.eq(0)
         assert (yield tx) == 0
-        assert (yield dut.tx_ack) == 0
+        assert (yield dut.tx.ready) == 0
         yield from Th()
 
     def D(bit):
-        assert (yield dut.tx_ack) == 0
+        assert (yield dut.tx.ready) == 0
         yield from B(bit)
 
     def E():
-        assert (yield dut.tx_ack) == 0
+        assert (yield dut.tx.ready) == 0
         yield from B(1)
         yield from Th()
 
@@ -273,8 +771,211 @@ def _test_tx(tx, dut):
     yield from O(0x00, [0, 0, 0, 0, 0, 0, 0, 0])
 
 def _test(rx, tx, dut):
-    yield from _test_rx(pads.rx, dut)
-    yield from _test_tx(pads.tx, dut)
+    yield from _test_rx(rx, dut)
+    yield from _test_tx(tx, dut)
+
+
+def _frame(octet, data_bits=8, parity=None):
+    # Line levels of a whole frame, start to stop bit.
+    bits = [(octet >> i) & 1 for i in range(data_bits)]
+    parity_bit = {
+        None: [],
+        "even": [sum(bits) & 1],
+        "odd": [~sum(bits) & 1],
+        "mark": [1],
+        "space": [0],
+    }[parity]
+    return [0, *bits, *parity_bit, 1]
+
+
+def _test_fifo_rx(rx, clk_per_bit, octets, data_bits=8, parity=None, bad_parity=()):
+    # Frames are sent back-to-back, the next start bit immediately follows
+    # the previous stop bit. `clk_per_bit` does not have to be an integer.
+    # The frames with their index in `bad_parity` get the wrong parity bit.
+    time = 0.0
+    for n, octet in enumerate(octets):
+        bits = _frame(octet, data_bits, parity)
+        if n in bad_parity:
+            bits[-2] ^= 1
+        for bit in bits:
+            cycles = round(time + clk_per_bit) - round(time)
+            time += clk_per_bit
+            yield rx.eq(bit)
+            for _ in range(cycles):
+                yield
+
+
+def _test_fifo_rx_consumer(dut, octets, max_stall):
+    # The consumer stalls for a random number of cycles before each ack,
+    # often for several bit times. It is only faster than the line on average.
+    rng = random.Random(0)
+    for octet in octets:
+        for _ in range(rng.randrange(max_stall)):
+            assert (yield dut.rx_error) == 0
+            yield
+        while (yield dut.rx.valid) == 0:
+            assert (yield dut.rx_error) == 0
+            yield
+        assert (yield dut.rx.payload) == octet
+        yield dut.rx.ready.eq(1)
+        yield
+        yield dut.rx.ready.eq(0)
+        yield
+
+
+def _test_oversampling_rx(rx, clk_per_bit, skew, octets):
+    # Frames are sent back-to-back with the bit period off by `skew`, and
+    # every bit has a one cycle glitch somewhere around its center, where the
+    # receiver takes its samples.
+    rng = random.Random(2)
+    period = clk_per_bit * (1 + skew)
+    time = 0.0
+    for octet in octets:
+        for bit in [0, *((octet >> i) & 1 for i in range(8)), 1]:
+            cycles = round(time + period) - round(time)
+            time += period
+            glitch = rng.randrange(cycles * 3 // 8, cycles * 5 // 8 + 1)
+            for cycle in range(cycles):
+                yield rx.eq(bit ^ (cycle == glitch))
+                yield
+    yield rx.eq(1)
+
+
+def _test_fifo_tx(dut, octets):
+    for octet in octets:
+        while (yield dut.tx.ready) == 0:
+            yield
+        yield dut.tx.payload.eq(octet)
+        yield dut.tx.valid.eq(1)
+        yield
+        yield dut.tx.valid.eq(0)
+        yield
+
+
+def _test_fifo_tx_monitor(tx, clk_per_bit, octets, back_to_back_after=None,
+                          data_bits=8, parity=None):
+    # The line only idles high once the UART is out of reset.
+    while (yield tx) == 0:
+        yield
+    frame_bits = len(_frame(0, data_bits, parity))
+    cycle = 0
+    last_start = None
+    for i, octet in enumerate(octets):
+        while (yield tx) == 1:
+            yield
+            cycle += 1
+        # From frame `back_to_back_after` on, every start bit has to follow
+        # the previous one by exactly one frame time, give or take the one
+        # cycle of jitter of the baud rate generator.
+        if back_to_back_after is not None and i > back_to_back_after:
+            assert abs(cycle - last_start - frame_bits * clk_per_bit) < 1, \
+                "idle time before frame {}".format(i)
+        last_start = cycle
+        # Sample every bit in its middle, as timed from the start bit edge.
+        bits = []
+        elapsed = 0
+        for bit in range(frame_bits):
+            while elapsed < round((bit + 0.5) * clk_per_bit):
+                yield
+                elapsed += 1
+                cycle += 1
+            bits.append((yield tx))
+        assert bits == _frame(octet, data_bits, parity)
+
+
+def _test_no_rx_errors(dut):
+    yield sim.Passive()
+    while True:
+        assert (yield dut.rx_error) == 0
+        yield
+
+
+def _test_flow_control_rx(rx, rts, clk_per_bit, octets):
+    # Like _test_fifo_rx, but the host checks RTS before every frame. The
+    # frame it has already started always goes out in full.
+    time = 0.0
+    for octet in octets:
+        while (yield rts) == 1:
+            yield
+            time = round(time) + 1
+        for bit in [0, *((octet >> i) & 1 for i in range(8)), 1]:
+            cycles = round(time + clk_per_bit) - round(time)
+            time += clk_per_bit
+            yield rx.eq(bit)
+            for _ in range(cycles):
+                yield
+
+
+def _test_cts(cts, tx, clk_per_bit, max_hold):
+    # Deasserts CTS at random, and checks that no start bit goes out once
+    # the UART had time to see that.
+    yield sim.Passive()
+    rng = random.Random(5)
+    value = 0
+    hold = 0
+    deasserted = 0
+    skip = 0
+    prev_line = 1
+    while True:
+        if hold == 0:
+            value = rng.randrange(2)
+            hold = rng.randrange(1, max_hold)
+            yield cts.eq(value)
+        hold -= 1
+        yield
+        deasserted = deasserted + 1 if value else 0
+        line = yield tx
+        if skip:
+            # Falling edges inside a frame are not start bits.
+            skip -= 1
+        elif prev_line and not line:
+            assert deasserted < 4, "start bit while CTS is deasserted"
+            skip = int(9.5 * clk_per_bit)
+        prev_line = line
+
+
+def _test_autobaud_rx(rx, clk_per_bit, octets):
+    # Idle line, then 0x55 for the auto-baud detection and the payload.
+    for _ in range(16):
+        yield
+    yield from _test_fifo_rx(rx, clk_per_bit, [0x55, *octets])
+
+
+def _test_divisor_rx(rx, dut, clk_per_bit, octets, new_baud_rate, new_octets):
+    # Sends `octets`, waits for them to be looped back, then switches both
+    # ends of the link over to `new_baud_rate` and sends `new_octets`.
+    yield from _test_fifo_rx(rx, clk_per_bit, octets)
+    for _ in range(round(12 * clk_per_bit)):
+        yield
+    yield dut.divisor_w_data.eq(dut.divisor_for(new_baud_rate))
+    yield dut.divisor_w_en.eq(1)
+    yield
+    yield dut.divisor_w_en.eq(0)
+    yield
+    yield from _test_fifo_rx(rx, dut.clk_freq / new_baud_rate, new_octets)
+
+
+def _test_divisor_monitor(tx, dut, clk_per_bit, octets, new_baud_rate, new_octets):
+    yield from _test_fifo_tx_monitor(tx, clk_per_bit, octets)
+    yield from _test_fifo_tx_monitor(tx, dut.clk_freq / new_baud_rate, new_octets)
+
+
+def _test_parity_monitor(tx, dut, clk_per_bit, octets, data_bits, parity, parity_errors):
+    yield from _test_fifo_tx_monitor(tx, clk_per_bit, octets,
+                                     data_bits=data_bits, parity=parity)
+    assert (yield dut.rx_parity_errors) == parity_errors
+    assert (yield dut.rx_framing_errors) == 0
+
+
+def _test_words(dut, words):
+    # Checks the words coming out of the rx stream as they are taken.
+    yield sim.Passive()
+    for word in words:
+        while not ((yield dut.rx.valid) and (yield dut.rx.ready)):
+            yield
+        assert (yield dut.rx.payload) == word
+        yield
+
 
 def _proc_wrapper(process):
     def wrapper():
@@ -282,41 +983,46 @@ def _proc_wrapper(process):
     return wrapper
 
 class _LoopbackTest(Elaboratable):
-    def __init__(self):
-        self.empty = Signal(reset=1)
+    def __init__(self, baud_rate=3000000, pll_freq=None, flow_control=False,
+                 autobaud=False):
         self.data = Signal(8)
-        self.rx_strobe = Signal()
-        self.tx_strobe = Signal()
         self.uart = None
+        self.baud_rate = baud_rate
+        self.flow_control = flow_control
+        self.autobaud = autobaud
+
+        # Without a PLL the design runs from the 12 MHz oscillator.
+        if pll_freq is not None:
+            self.pll = PLL(freq_out=pll_freq)
+            self.clk_freq = self.pll.freq_out
+        else:
+            self.pll = None
+            self.clk_freq = 12e6
 
     def elaborate(self, platform: Platform) -> Module:
         m = Module()
 
-        serial = platform.request("uart")
+        if self.pll is not None:
+            m.submodules.pll = self.pll
+
+        # The FTDI channel only has RX/TX wired up, flow control needs the
+        # second UART from __main__.
+        serial = platform.request("uart", 1 if self.flow_control else 0)
         leds = Cat([platform.request("led_r"), platform.request("led_g")])
         debug = platform.request("debug")
 
-        self.uart = UART(serial, clk_freq=12000000, baud_rate=115200)
+        self.uart = UART(serial, clk_freq=self.clk_freq, baud_rate=self.baud_rate,
+                         rx_fifo_depth=512, tx_fifo_depth=512,
+                         flow_control=self.flow_control, autobaud=self.autobaud)
         m.submodules.uart = self.uart
 
-        m.d.comb += [
-            self.rx_strobe.eq(self.uart.rx_ready & self.empty),
-            self.tx_strobe.eq(self.uart.tx_ack & ~self.empty),
-            self.uart.rx_ack.eq(self.rx_strobe),
-            self.uart.tx_data.eq(self.data),
-            self.uart.tx_ready.eq(self.tx_strobe)
-        ]
+        m.d.comb += self.uart.rx.connect(self.uart.tx)
 
-        with m.If(self.rx_strobe):
-            m.d.sync += [
-                self.data.eq(self.uart.rx_data),
-                self.empty.eq(0)
-            ]
-        with m.If(self.tx_strobe):
-            m.d.sync += self.empty.eq(1)
+        with m.If(self.uart.rx.transfer()):
+            m.d.sync += self.data.eq(self.uart.rx.payload)
 
         m.d.comb += [
-            leds.eq(self.uart.rx_data[0:2]),
+            leds.eq(self.data[0:2]),
             debug.eq(Cat(
                 serial.rx,
                 serial.tx,
@@ -330,7 +1036,11 @@ class _LoopbackTest(Elaboratable):
 
 if __name__ == "__main__":
     parser = ArgumentParser()
-    parser.add_argument("-s", action="store_true", help="Simulate Rotary Encoder (for debugging).")
+    parser.add_argument("-s", action="store_true", help="Simulate UART (for debugging).")
+    parser.add_argument("-b", type=int, default=3000000, help="Baud rate (default 3000000)")
+    parser.add_argument("-f", type=float, help="Run from the PLL at this frequency in MHz (default: 12 MHz oscillator)")
+    parser.add_argument("-a", action="store_true", help="Detect the baud rate from a 0x55 sent by the host, starting out at the -b rate")
+    parser.add_argument("-c", action="store_true", help="Use RTS/CTS flow control, with a serial adapter on PMOD1B (1: RX, 2: TX, 3: RTS, 4: CTS)")
     args = parser.parse_args()
 
     if args.s:
@@ -343,6 +1053,204 @@ if __name__ == "__main__":
         s.add_sync_process(_proc_wrapper(_test(pads.rx, pads.tx, dut)))
         with s.write_vcd("uart.vcd", "uart.gtkw", traces=[pads.tx, pads.rx]):
             s.run()
+
+        # Stream 4 KiB through both FIFOs with a consumer that regularly
+        # stalls for longer than a frame.
+        pads = _TestPads()
+
+        dut = UART(pads, clk_freq=4800, baud_rate=1200,
+                   rx_fifo_depth=64, tx_fifo_depth=64)
+        s = sim.Simulator(dut)
+        s.add_clock(1.0 / 12e6)
+
+        rng = random.Random(1)
+        rx_octets = [rng.randrange(256) for _ in range(4096)]
+        tx_octets = [rng.randrange(256) for _ in range(4096)]
+        s.add_sync_process(_proc_wrapper(_test_fifo_rx(pads.rx, 4, rx_octets)))
+        s.add_sync_process(_proc_wrapper(
+            _test_fifo_rx_consumer(dut, rx_octets, max_stall=64)))
+        s.add_sync_process(_proc_wrapper(_test_fifo_tx(dut, tx_octets)))
+        s.add_sync_process(_proc_wrapper(
+            _test_fifo_tx_monitor(pads.tx, 4, tx_octets)))
+        with s.write_vcd("uart_fifo.vcd", "uart_fifo.gtkw",
+                         traces=[pads.tx, pads.rx, dut.rx_level, dut.tx_level]):
+            s.run()
+
+        # Loop bytes back through both FIFOs at rates the FTDI bridge
+        # supports from the 12 MHz clock, including 921600 baud which is not
+        # an integer divisor. The rx stream is connected straight to the tx
+        # stream, and the host sends 1% fast, so the transmitter soon has a
+        # backlog and has to run at line rate with no idle time between
+        # frames.
+        for baud_rate in (3000000, 1000000, 921600):
+            pads = _TestPads()
+
+            dut = UART(pads, clk_freq=12000000, baud_rate=baud_rate,
+                       rx_fifo_depth=64, tx_fifo_depth=64)
+            m = Module()
+            m.submodules.uart = dut
+            m.d.comb += dut.rx.connect(dut.tx)
+            s = sim.Simulator(m)
+            s.add_clock(1.0 / 12e6)
+
+            rng = random.Random(4)
+            octets = [rng.randrange(256) for _ in range(512)]
+            s.add_sync_process(_proc_wrapper(
+                _test_fifo_rx(pads.rx, 0.99 * 12e6 / baud_rate, octets)))
+            s.add_sync_process(_proc_wrapper(_test_no_rx_errors(dut)))
+            s.add_sync_process(_proc_wrapper(
+                _test_fifo_tx_monitor(pads.tx, 12e6 / dut.actual_baud_rate, octets,
+                                      back_to_back_after=16)))
+            with s.write_vcd("uart_loopback.vcd", "uart_loopback.gtkw",
+                             traces=[pads.tx, pads.rx, dut.rx_level, dut.tx_level]):
+                s.run()
+
+        # A consumer that often stalls for dozens of frames, and a host that
+        # honors RTS, must not overrun a small receive FIFO. On the transmit
+        # side, CTS comes and goes at random.
+        pads = _TestPads()
+
+        dut = UART(pads, clk_freq=12000000, baud_rate=3000000,
+                   rx_fifo_depth=16, tx_fifo_depth=16, flow_control=True)
+        s = sim.Simulator(dut)
+        s.add_clock(1.0 / 12e6)
+
+        rng = random.Random(6)
+        rx_octets = [rng.randrange(256) for _ in range(256)]
+        tx_octets = [rng.randrange(256) for _ in range(256)]
+        s.add_sync_process(_proc_wrapper(
+            _test_flow_control_rx(pads.rx, pads.rts, 4, rx_octets)))
+        s.add_sync_process(_proc_wrapper(
+            _test_fifo_rx_consumer(dut, rx_octets, max_stall=800)))
+        s.add_sync_process(_proc_wrapper(_test_no_rx_errors(dut)))
+        s.add_sync_process(_proc_wrapper(_test_fifo_tx(dut, tx_octets)))
+        s.add_sync_process(_proc_wrapper(
+            _test_fifo_tx_monitor(pads.tx, 4, tx_octets)))
+        s.add_sync_process(_proc_wrapper(_test_cts(pads.cts, pads.tx, 4, max_hold=200)))
+        with s.write_vcd("uart_flow_control.vcd", "uart_flow_control.gtkw",
+                         traces=[pads.rx, pads.rts, pads.tx, pads.cts, dut.rx_level]):
+            s.run()
+
+        # Auto-baud from the 115200 default to rates both well below and
+        # well above it, and loop the bytes back at the detected rate.
+        for baud_rate in (19200, 115200, 460800, 1000000, 2000000):
+            pads = _TestPads()
+
+            dut = UART(pads, clk_freq=12000000, baud_rate=115200, autobaud=True)
+            m = Module()
+            m.submodules.uart = dut
+            m.d.comb += dut.rx.connect(dut.tx)
+            s = sim.Simulator(m)
+            s.add_clock(1.0 / 12e6)
+
+            rng = random.Random(7)
+            octets = [rng.randrange(256) for _ in range(8)]
+            s.add_sync_process(_proc_wrapper(
+                _test_autobaud_rx(pads.rx, 12e6 / baud_rate, octets)))
+            s.add_sync_process(_proc_wrapper(_test_no_rx_errors(dut)))
+            s.add_sync_process(_proc_wrapper(
+                _test_fifo_tx_monitor(pads.tx, 12e6 / baud_rate, octets)))
+            with s.write_vcd("uart_autobaud.vcd", "uart_autobaud.gtkw",
+                             traces=[pads.rx, pads.tx, dut.autobaud_busy, dut.divisor]):
+                s.run()
+
+        # Renegotiate from 115200 to 1000000 baud through the divisor register.
+        pads = _TestPads()
+
+        dut = UART(pads, clk_freq=12000000, baud_rate=115200, runtime_baud=True)
+        m = Module()
+        m.submodules.uart = dut
+        m.d.comb += dut.rx.connect(dut.tx)
+        s = sim.Simulator(m)
+        s.add_clock(1.0 / 12e6)
+
+        rng = random.Random(8)
+        octets = [rng.randrange(256) for _ in range(8)]
+        new_octets = [rng.randrange(256) for _ in range(32)]
+        s.add_sync_process(_proc_wrapper(_test_divisor_rx(
+            pads.rx, dut, 12e6 / 115200, octets, 1000000, new_octets)))
+        s.add_sync_process(_proc_wrapper(_test_no_rx_errors(dut)))
+        s.add_sync_process(_proc_wrapper(_test_divisor_monitor(
+            pads.tx, dut, 12e6 / 115200, octets, 1000000, new_octets)))
+        with s.write_vcd("uart_divisor.vcd", "uart_divisor.gtkw",
+                         traces=[pads.rx, pads.tx, dut.divisor]):
+            s.run()
+
+        # Loop 32 bit words back in both byte orders, checking how the bytes
+        # were packed on the way.
+        for big_endian in (False, True):
+            pads = _TestPads()
+
+            dut = UART(pads, clk_freq=12000000, baud_rate=3000000,
+                       rx_fifo_depth=16, tx_fifo_depth=16,
+                       word_width=32, big_endian=big_endian)
+            m = Module()
+            m.submodules.uart = dut
+            m.d.comb += dut.rx.connect(dut.tx)
+            s = sim.Simulator(m)
+            s.add_clock(1.0 / 12e6)
+
+            rng = random.Random(9)
+            octets = [rng.randrange(256) for _ in range(256)]
+            words = [int.from_bytes(bytes(octets[i:i + 4]),
+                                    "big" if big_endian else "little")
+                     for i in range(0, len(octets), 4)]
+            s.add_sync_process(_proc_wrapper(_test_fifo_rx(pads.rx, 4, octets)))
+            s.add_sync_process(_proc_wrapper(_test_words(dut, words)))
+            s.add_sync_process(_proc_wrapper(_test_no_rx_errors(dut)))
+            s.add_sync_process(_proc_wrapper(
+                _test_fifo_tx_monitor(pads.tx, 4, octets, back_to_back_after=16)))
+            with s.write_vcd("uart_words.vcd", "uart_words.gtkw",
+                             traces=[pads.rx, pads.tx, dut.rx.payload]):
+                s.run()
+
+        # Loop frames back with parity and 9 data bits. With parity, every
+        # fifth frame has the wrong parity bit and has to be dropped.
+        for data_bits, parity in ((8, "even"), (8, "odd"), (9, None), (8, "mark"),
+                                  (8, "space"), (7, "even")):
+            pads = _TestPads()
+
+            dut = UART(pads, clk_freq=12000000, baud_rate=1000000,
+                       rx_fifo_depth=16, tx_fifo_depth=16,
+                       data_bits=data_bits, parity=parity)
+            m = Module()
+            m.submodules.uart = dut
+            m.d.comb += dut.rx.connect(dut.tx)
+            s = sim.Simulator(m)
+            s.add_clock(1.0 / 12e6)
+
+            rng = random.Random(10)
+            octets = [rng.randrange(2**data_bits) for _ in range(64)]
+            bad_parity = range(0, len(octets), 5) if parity else ()
+            good = [octet for n, octet in enumerate(octets) if n not in bad_parity]
+            s.add_sync_process(_proc_wrapper(_test_fifo_rx(
+                pads.rx, 12, octets, data_bits, parity, bad_parity)))
+            s.add_sync_process(_proc_wrapper(_test_parity_monitor(
+                pads.tx, dut, 12, good, data_bits, parity, len(bad_parity))))
+            with s.write_vcd("uart_parity.vcd", "uart_parity.gtkw",
+                             traces=[pads.rx, pads.tx, dut.rx_parity_errors]):
+                s.run()
+
+        # Receive glitchy frames from transmitters running 3% slow and 3%
+        # fast with the 8x and 16x oversampling receivers.
+        for oversampling in (8, 16):
+            for skew in (0.03, -0.03):
+                pads = _TestPads()
+
+                dut = UART(pads, clk_freq=2400 * oversampling, baud_rate=1200,
+                           rx_oversampling=oversampling)
+                s = sim.Simulator(dut)
+                s.add_clock(1.0 / 12e6)
+
+                rng = random.Random(3)
+                rx_octets = [rng.randrange(256) for _ in range(256)]
+                s.add_sync_process(_proc_wrapper(_test_oversampling_rx(
+                    pads.rx, 2 * oversampling, skew, rx_octets)))
+                s.add_sync_process(_proc_wrapper(
+                    _test_fifo_rx_consumer(dut, rx_octets, max_stall=1)))
+                with s.write_vcd("uart_oversampling.vcd", "uart_oversampling.gtkw",
+                                 traces=[pads.rx, dut.rx_strobe, dut.rx.payload]):
+                    s.run()
     else:
         plat = ICEBreakerPlatform()
 
@@ -355,4 +1263,13 @@ if __name__ == "__main__":
                                       conn=("pmod", 0)), Attrs(IO_STANDARD="SB_LVCMOS"))
         ])
 
-        plat.build(_LoopbackTest(), do_program=True)
+        # The RTS/CTS serial port is the DTE side, RTS is an output.
+        plat.add_resources([
+            UARTResource(1, rx="1", tx="2", rts="3", cts="4", role="dte",
+                         conn=("pmod", 1), attrs=Attrs(IO_STANDARD="SB_LVCMOS", PULLUP=1))
+        ])
+
+        pll_freq = args.f * 1e6 if args.f is not None else None
+        plat.build(_LoopbackTest(baud_rate=args.b, pll_freq=pll_freq, flow_control=args.c,
+                                autobaud=args.a),
+                   do_program=True)
@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+
+import random
+from argparse import ArgumentParser
+from ctypes import ArgumentError
+from amaranth import *
+from amaranth.build import *
+from amaranth import sim
+from amaranth_boards.icebreaker import *
+from amaranth_boards.resources import UARTResource
+
+# Import the UART and stream helpers
+import sys
+import os
+if __package__:
+    from .uart import (UART, _nco, _TestPads, _frame, _test_fifo_rx, _test_fifo_tx_monitor,
+                       _proc_wrapper)
+    from ..common.stream import Stream
+else:
+    sys.path.append(os.path.dirname(__file__) + '/..')
+    from uart import (UART, _nco, _TestPads, _frame, _test_fifo_rx, _test_fifo_tx_monitor,
+                      _proc_wrapper)
+    from common.stream import Stream
+
+
+def _max_channels(clk_freq, baud_rate, oversampling):
+    # How many channels the arbiter can scan while one holds its byte, two
+    # bits less a tick.
+    return int((2 * oversampling - 1) * clk_freq / (baud_rate * oversampling))
+
+
+class UARTArray(Elaboratable):
+    """A bank of 8N1 UARTs that all run at the same baud rate.
+
+    `ports` is a list of objects with `rx` and `tx` lines, like the `serial`
+    argument of `UART`. All channels share one baud rate generator: it ticks
+    `oversampling` times per bit, every receiver takes its own bit timing
+    from those ticks, and all transmitters shift on every `oversampling`th
+    tick. Per channel that leaves little more than the shift registers and
+    two bit counters, so a dozen channels fit an UP5K with room to spare.
+
+    Everything received comes out of the `rx` stream, and everything to send
+    goes into the `tx` stream, with the payload laid out as
+    `Cat(data[8], channel[8])`. The channels are scanned round robin for
+    received bytes, one per cycle. Each channel holds one received byte; if
+    the next frame starts shifting in before the byte was taken, it is lost
+    and counted in `rx_overruns`. Bad stop bits are counted in
+    `rx_framing_errors`. Both counters are shared by all channels, and
+    count every event, also when several channels have one in the same
+    cycle.
+
+    With frames back to back, a channel holds its byte for only two bits
+    (less a tick), from the stop bit to the first data bit of the next
+    frame, so the scan has to come round within that: there can be no
+    more channels than clock cycles in that time.
+
+    A byte on `tx` waits until its channel is done sending the previous one,
+    which holds up the bytes behind it for other channels. Bytes for
+    channels that do not exist are dropped.
+    """
+
+    def __init__(self, ports, clk_freq, baud_rate, oversampling=8, max_ppm=1000,
+                 error_counter_width=16):
+        if oversampling < 4 or oversampling & (oversampling - 1):
+            raise ArgumentError("Oversampling has to be a power of 2, at least 4.")
+        if baud_rate * oversampling > clk_freq:
+            raise ArgumentError("Baud rate is too high.")
+        if not 1 <= len(ports) <= 256:
+            raise ArgumentError("Between 1 and 256 channels are supported.")
+        if len(ports) > _max_channels(clk_freq, baud_rate, oversampling):
+            raise ArgumentError("Too many channels to scan them all within two bits.")
+
+        self.ports = ports
+        self.oversampling = oversampling
+
+        self.tick_width, self.tick_inc, tick_freq, self.baud_ppm = _nco(
+            freq_in=clk_freq, freq_out=baud_rate * oversampling, max_ppm=max_ppm)
+        self.actual_baud_rate = tick_freq / oversampling
+
+        self.rx = Stream(16, name="rx")
+        self.tx = Stream(16, name="tx")
+        self.rx_framing_errors = Signal(error_counter_width)
+        self.rx_overruns = Signal(error_counter_width)
+        self.rx_error_clear = Signal()
+
+    def elaborate(self, _platform: Platform) -> Module:
+        m = Module()
+
+        oversampling = self.oversampling
+        channels = len(self.ports)
+
+        # Baud rate generator
+
+        tick_acc = Signal(self.tick_width)
+        tick_acc_next = Signal(self.tick_width + 1)
+        tick = Signal()
+        m.d.comb += [
+            tick_acc_next.eq(tick_acc + self.tick_inc),
+            tick.eq(tick_acc_next[-1])
+        ]
+        m.d.sync += tick_acc.eq(tick_acc_next[:-1])
+
+        tx_phase = Signal(range(oversampling))
+        tx_strobe = Signal()
+        m.d.comb += tx_strobe.eq(tick & tx_phase.all())
+        with m.If(tick):
+            m.d.sync += tx_phase.eq(tx_phase + 1)
+
+        # Channels
+
+        scan = Signal(range(channels))
+        grant = Signal()
+        rx_valids = []
+        rx_shregs = []
+        tx_busys = []
+        framing_errors = []
+        overruns = []
+
+        tx_data = self.tx.payload[:8]
+        tx_channel = self.tx.payload[8:]
+
+        for n, port in enumerate(self.ports):
+            # RX
+            #
+            # rx_count is 0 while idle, then counts the bits of the frame
+            # down from 10 (start) to 1 (stop). Bits are sampled when
+            # rx_phase comes round to the middle of the bit.
+            rx_sync = Signal(2, reset=0b11, name="rx{}_sync".format(n))
+            rx_line = rx_sync[1]
+            m.d.sync += rx_sync.eq(Cat(port.rx, rx_sync[0]))
+
+            rx_phase = Signal(range(oversampling), name="rx{}_phase".format(n))
+            rx_count = Signal(4, name="rx{}_count".format(n))
+            rx_shreg = Signal(8, name="rx{}_shreg".format(n))
+            rx_valid = Signal(name="rx{}_valid".format(n))
+            framing_error = Signal(name="rx{}_framing_error".format(n))
+            overrun = Signal(name="rx{}_overrun".format(n))
+
+            with m.If(grant & (scan == n)):
+                m.d.sync += rx_valid.eq(0)
+
+            with m.If(tick):
+                m.d.sync += rx_phase.eq(rx_phase + 1)
+                with m.If(rx_count == 0):
+                    with m.If(~rx_line):
+                        m.d.sync += [
+                            rx_phase.eq(1),
+                            rx_count.eq(10)
+                        ]
+                with m.Elif(rx_phase == oversampling // 2):
+                    m.d.sync += rx_count.eq(rx_count - 1)
+                    with m.If(rx_count == 10):
+                        # Glitch on an idle line, not a start bit.
+                        with m.If(rx_line):
+                            m.d.sync += rx_count.eq(0)
+                    with m.Elif(rx_count == 1):
+                        with m.If(rx_line):
+                            m.d.sync += rx_valid.eq(1)
+                        with m.Else():
+                            m.d.comb += framing_error.eq(1)
+                    with m.Else():
+                        m.d.sync += rx_shreg.eq(Cat(rx_shreg[1:], rx_line))
+                        # Unless the byte is being taken right now.
+                        with m.If((rx_count == 9) & rx_valid & ~(grant & (scan == n))):
+                            m.d.sync += rx_valid.eq(0)
+                            m.d.comb += overrun.eq(1)
+
+            # TX
+            #
+            # The start bit and data go into tx_shreg, and ones shift in
+            # behind them for the stop bit and the idle line.
+            tx_shreg = Signal(9, name="tx{}_shreg".format(n))
+            tx_count = Signal(4, name="tx{}_count".format(n))
+            tx_line = Signal(reset=1, name="tx{}_line".format(n))
+            tx_busy = Signal(name="tx{}_busy".format(n))
+            m.d.comb += [
+                port.tx.eq(tx_line),
+                tx_busy.eq(tx_count != 0)
+            ]
+
+            with m.If(self.tx.transfer() & (tx_channel == n)):
+                m.d.sync += [
+                    tx_shreg.eq(Cat(C(0, 1), tx_data)),
+                    tx_count.eq(10)
+                ]
+            with m.Elif(tx_strobe & tx_busy):
+                m.d.sync += [
+                    tx_line.eq(tx_shreg[0]),
+                    tx_shreg.eq(Cat(tx_shreg[1:], C(1, 1))),
+                    tx_count.eq(tx_count - 1)
+                ]
+
+            rx_valids.append(rx_valid)
+            rx_shregs.append(rx_shreg)
+            tx_busys.append(tx_busy)
+            framing_errors.append(framing_error)
+            overruns.append(overrun)
+
+        # Arbiter
+        #
+        # Looks at one channel per cycle, so every channel gets its turn
+        # within `len(ports)` cycles, which __init__ made sure is less than
+        # the time a channel holds its byte.
+
+        with m.If(scan == channels - 1):
+            m.d.sync += scan.eq(0)
+        with m.Else():
+            m.d.sync += scan.eq(scan + 1)
+
+        m.d.comb += grant.eq(Array(rx_valids)[scan] & (~self.rx.valid | self.rx.ready))
+        with m.If(self.rx.transfer()):
+            m.d.sync += self.rx.valid.eq(0)
+        with m.If(grant):
+            m.d.sync += [
+                self.rx.payload.eq(Cat(Array(rx_shregs)[scan], scan)),
+                self.rx.valid.eq(1)
+            ]
+
+        m.d.comb += self.tx.ready.eq(
+            (tx_channel >= channels) | ~Array(tx_busys)[tx_channel])
+
+        # Error counters
+
+        for events, counter in [(framing_errors, self.rx_framing_errors),
+                                (overruns, self.rx_overruns)]:
+            with m.If(self.rx_error_clear):
+                m.d.sync += counter.eq(0)
+            with m.Else():
+                # Several channels can have one in the same cycle, as they
+                # all sample on the same ticks.
+                total = Signal(range(2**len(counter) + channels))
+                m.d.comb += total.eq(counter + _count(events))
+                m.d.sync += counter.eq(Mux(total >= 2**len(counter), 2**len(counter) - 1, total))
+
+        return m
+
+
+def _count(bits):
+    # How many of `bits` are set, with a balanced tree of adders.
+    if len(bits) == 1:
+        return bits[0]
+    return _count(bits[:len(bits) // 2]) + _count(bits[len(bits) // 2:])
+
+
+def _test_delayed(delay, process):
+    for _ in range(delay):
+        yield
+    yield from process
+
+
+def _test_host_rx(dut, octets, max_stall):
+    # Collects the bytes of every channel, stalling now and then.
+    rng = random.Random(11)
+    received = [[] for _ in octets]
+    while sum(map(len, received)) < sum(map(len, octets)):
+        if rng.randrange(4) == 0:
+            yield dut.rx.ready.eq(0)
+            for _ in range(rng.randrange(max_stall)):
+                yield
+        # Whatever is valid now is taken on the next clock edge.
+        yield sim.Settle()
+        if (yield dut.rx.valid):
+            payload = yield dut.rx.payload
+            received[payload >> 8].append(payload & 0xff)
+        yield dut.rx.ready.eq(1)
+        yield
+    yield dut.rx.ready.eq(0)
+    assert received == octets
+    assert (yield dut.rx_framing_errors) == 0
+    assert (yield dut.rx_overruns) == 0
+
+
+def _test_host_tx(dut, octets):
+    # Sends the bytes for all channels interleaved at random.
+    rng = random.Random(12)
+    queues = [list(channel_octets) for channel_octets in octets]
+    while any(queues):
+        channel = rng.choice([n for n, queue in enumerate(queues) if queue])
+        yield dut.tx.payload.eq((channel << 8) | queues[channel].pop(0))
+        yield dut.tx.valid.eq(1)
+        yield sim.Settle()
+        while not (yield dut.tx.ready):
+            yield
+            yield sim.Settle()
+        yield
+        yield dut.tx.valid.eq(0)
+
+
+def _test_grant_overrun(dut, release, octets, cycles):
+    # Holds up the first of `octets`, so the second waits in its channel,
+    # then takes everything from `release` on. Released in the cycle the
+    # third frame shifts in its first data bit, the second byte still gets
+    # out and must not count as an overrun; any later, it is lost and must.
+    # Returns how many bytes were lost.
+    received = []
+    for cycle in range(cycles):
+        yield dut.rx.ready.eq(cycle >= release)
+        yield sim.Settle()
+        if cycle >= release and (yield dut.rx.valid):
+            received.append((yield dut.rx.payload) & 0xff)
+        yield
+    lost = len(octets) - len(received)
+    assert received == octets[:1] + octets[1 + lost:], (release, received)
+    assert (yield dut.rx_overruns) == lost, (release, lost)
+    return lost
+
+
+def _test_simultaneous_errors(dut, ports, clk_per_bit):
+    # The same frames arrive on every channel at once, while the host takes
+    # nothing. First one with a bad stop bit, then three good ones: the
+    # first byte goes out to the stream, and the second frame overruns the
+    # bytes of the other channels, the third those of all of them, all in
+    # the same cycle.
+    frames = [_frame(0x5a)[:-1] + [0], [1], _frame(0x12), _frame(0x34), _frame(0x56)]
+    for bit in [bit for frame in frames for bit in frame] + [1]:
+        for port in ports:
+            yield port.rx.eq(bit)
+        for _ in range(clk_per_bit):
+            yield
+    assert (yield dut.rx_framing_errors) == len(ports)
+    assert (yield dut.rx_overruns) == 2 * len(ports) - 1
+
+
+class _ArrayTest(Elaboratable):
+    def __init__(self, channels=8, baud_rate=115200, host_baud_rate=3000000):
+        self.channels = channels
+        self.baud_rate = baud_rate
+        self.host_baud_rate = host_baud_rate
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        serial = platform.request("uart")
+        ports = [platform.request("uart", n + 1) for n in range(self.channels)]
+
+        # Every byte from or to a channel goes over the host link as the
+        # channel number followed by the byte.
+        m.submodules.host = host = UART(serial, clk_freq=12e6, baud_rate=self.host_baud_rate,
+                                        rx_fifo_depth=512, tx_fifo_depth=512,
+                                        word_width=16, big_endian=True)
+        m.submodules.array = array = UARTArray(ports, clk_freq=12e6, baud_rate=self.baud_rate)
+        m.d.comb += [
+            *host.rx.connect(array.tx),
+            *array.rx.connect(host.tx)
+        ]
+
+        return m
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-s", action="store_true", help="Simulate UART array (for debugging).")
+    parser.add_argument("-n", type=int, default=8, help="Number of channels, up to 12 (default 8)")
+    parser.add_argument("-b", type=int, default=115200, help="Channel baud rate (default 115200)")
+    args = parser.parse_args()
+
+    if args.s:
+        # Four channels, each receiving from a transmitter that is a bit
+        # off in its own direction and starts at its own time, while the
+        # host stalls now and then and sends to all of them.
+        ports = [_TestPads() for _ in range(4)]
+
+        dut = UARTArray(ports, clk_freq=12000000, baud_rate=375000)
+        s = sim.Simulator(dut)
+        s.add_clock(1.0 / 12e6)
+
+        rng = random.Random(13)
+        rx_octets = [[rng.randrange(256) for _ in range(64)] for _ in ports]
+        tx_octets = [[rng.randrange(256) for _ in range(64)] for _ in ports]
+        for n, (port, skew) in enumerate(zip(ports, (-0.02, -0.01, 0.01, 0.02))):
+            s.add_sync_process(_proc_wrapper(_test_delayed(
+                rng.randrange(320),
+                _test_fifo_rx(port.rx, 32 * (1 + skew), rx_octets[n]))))
+            s.add_sync_process(_proc_wrapper(_test_fifo_tx_monitor(
+                port.tx, 12e6 / dut.actual_baud_rate, tx_octets[n])))
+        s.add_sync_process(_proc_wrapper(_test_host_rx(dut, rx_octets, max_stall=64)))
+        s.add_sync_process(_proc_wrapper(_test_host_tx(dut, tx_octets)))
+        with s.write_vcd("uart_array.vcd", "uart_array.gtkw",
+                         traces=[port.rx for port in ports] + [port.tx for port in ports]):
+            s.run()
+
+        # Taking a byte just as the next frame overruns it, in every cycle
+        # around the first data bit of the third frame. Some have to be in
+        # time and some too late, or the cycle in between was missed.
+        outcomes = set()
+        port = _TestPads()
+        for release in range(680, 700):
+            dut = UARTArray([port], clk_freq=12000000, baud_rate=375000)
+            s = sim.Simulator(dut)
+            s.add_clock(1.0 / 12e6)
+            octets = [0x11, 0x22, 0x33]
+            lost = []
+
+            def host_proc():
+                lost.append((yield from _test_grant_overrun(dut, release, octets, 1200)))
+
+            s.add_sync_process(_proc_wrapper(_test_fifo_rx(port.rx, 32, octets)))
+            s.add_sync_process(host_proc)
+            s.run()
+            outcomes.add(lost[0])
+        assert outcomes == {0, 1}, outcomes
+
+        # Errors on several channels in the same cycle.
+        ports = [_TestPads() for _ in range(3)]
+        dut = UARTArray(ports, clk_freq=12000000, baud_rate=375000)
+        s = sim.Simulator(dut)
+        s.add_clock(1.0 / 12e6)
+        s.add_sync_process(_proc_wrapper(_test_simultaneous_errors(dut, ports, 32)))
+        s.run()
+
+        # The scan has to come round within two bits.
+        assert _max_channels(12e6, 12e6 / 8, 8) == 15
+        Fragment.get(UARTArray([port] * 15, clk_freq=12e6, baud_rate=12e6 / 8), None)
+    else:
+        plat = ICEBreakerPlatform()
+
+        # Channel n has its RX on pin 1 to 4 and its TX on pin 7 to 10 of
+        # PMOD1A for channels 0 to 3, PMOD1B for 4 to 7 and PMOD2 for 8 to 11.
+        plat.add_resources([
+            UARTResource(n + 1, rx=str(n % 4 + 1), tx=str(n % 4 + 7),
+                         conn=("pmod", n // 4), attrs=Attrs(IO_STANDARD="SB_LVCMOS", PULLUP=1))
+            for n in range(args.n)
+        ])
+
+        plat.build(_ArrayTest(channels=args.n, baud_rate=args.b), do_program=True)
@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+
+import random
+import socket
+import threading
+from argparse import ArgumentParser
+from amaranth import *
+from amaranth.build import *
+from amaranth import sim
+from amaranth_boards.icebreaker import *
+
+# Import the UART, the host client and the bus helpers
+import sys
+import os
+if __package__:
+    from .uart import UART, _TestPads, _frame, _proc_wrapper
+    from .bridge_client import BridgeClient, CMD_WRITE, CMD_READ, CMD_FIXED
+    from ..common.stream import Stream, StreamUnpacker
+    from ..common.wishbone import WishboneBus, CSRBank
+    from ..common.perf import PerfCounters
+else:
+    sys.path.append(os.path.dirname(__file__) + '/..')
+    from uart import UART, _TestPads, _frame, _proc_wrapper
+    from bridge_client import BridgeClient, CMD_WRITE, CMD_READ, CMD_FIXED
+    from common.stream import Stream, StreamUnpacker
+    from common.wishbone import WishboneBus, CSRBank
+    from common.perf import PerfCounters
+
+
+class UARTBridge(Elaboratable):
+    """Wishbone initiator controlled by commands from a byte stream.
+
+    Connect `sink` and `source` to the `rx` and `tx` streams of a `UART`,
+    and `bus` to the registers. The protocol is described in
+    `bridge_client.py`, which also has the host side.
+
+    Reads are pipelined: the next word is fetched while the one before is
+    still being sent, and one more can wait behind it, so a burst read goes
+    out with no gaps as long as the bus answers within a couple of frames.
+    Write bursts take a bus access per word after its four bytes came in,
+    which keeps up with any baud rate the UART does.
+
+    A command that stops halfway is dropped after `timeout` cycles without a
+    byte, so the host can always get back in step by waiting. Unknown
+    command bytes are skipped.
+    """
+
+    def __init__(self, addr_width=30, timeout=2**20):
+        self.timeout = timeout
+
+        self.sink = Stream(8, name="sink")
+        self.source = Stream(8, name="source")
+        self.bus = WishboneBus(addr_width, name="bus")
+
+    def elaborate(self, _platform: Platform) -> Module:
+        m = Module()
+
+        cmd = Signal(3)
+        count = Signal(8)
+        address = Signal(32)
+        data = Signal(32)
+        byte = Signal(2)
+        fixed = Signal()
+        m.d.comb += [
+            fixed.eq((cmd & CMD_FIXED) != 0),
+            self.bus.adr.eq(address),
+            self.bus.dat_w.eq(data)
+        ]
+
+        # Read data goes out a word at a time through the unpacker, with
+        # one more word held in `word`.
+        word = Stream(32, name="word")
+        m.submodules.unpacker = unpacker = StreamUnpacker(8, 4, big_endian=True)
+        m.d.comb += [
+            *word.connect(unpacker.sink),
+            *unpacker.source.connect(self.source)
+        ]
+        with m.If(word.transfer()):
+            m.d.sync += word.valid.eq(0)
+
+        # Drops a command that stalls halfway.
+        timer = Signal(range(self.timeout + 1))
+        timed_out = Signal()
+        m.d.comb += timed_out.eq(timer == self.timeout)
+        with m.If(self.sink.transfer()):
+            m.d.sync += timer.eq(0)
+        with m.Elif(~timed_out):
+            m.d.sync += timer.eq(timer + 1)
+
+        def next_address():
+            with m.If(~fixed):
+                m.d.sync += address.eq(address + 1)
+
+        with m.FSM(reset="CMD"):
+            with m.State("CMD"):
+                m.d.comb += self.sink.ready.eq(1)
+                with m.If(self.sink.valid):
+                    m.d.sync += cmd.eq(self.sink.payload)
+                    with m.Switch(self.sink.payload):
+                        with m.Case(CMD_WRITE, CMD_WRITE | CMD_FIXED,
+                                    CMD_READ, CMD_READ | CMD_FIXED):
+                            m.next = "COUNT"
+
+            with m.State("COUNT"):
+                m.d.comb += self.sink.ready.eq(1)
+                with m.If(self.sink.valid):
+                    m.d.sync += [
+                        count.eq(self.sink.payload),
+                        byte.eq(0)
+                    ]
+                    m.next = "ADDRESS"
+                with m.Elif(timed_out):
+                    m.next = "CMD"
+
+            with m.State("ADDRESS"):
+                m.d.comb += self.sink.ready.eq(1)
+                with m.If(self.sink.valid):
+                    m.d.sync += [
+                        address.eq(Cat(self.sink.payload, address[:-8])),
+                        byte.eq(byte + 1)
+                    ]
+                    with m.If(byte == 3):
+                        with m.If((cmd & CMD_WRITE) != 0):
+                            m.next = "WRITE_DATA"
+                        with m.Else():
+                            m.next = "READ"
+                with m.Elif(timed_out):
+                    m.next = "CMD"
+
+            with m.State("WRITE_DATA"):
+                m.d.comb += self.sink.ready.eq(1)
+                with m.If(self.sink.valid):
+                    m.d.sync += [
+                        data.eq(Cat(self.sink.payload, data[:-8])),
+                        byte.eq(byte + 1)
+                    ]
+                    with m.If(byte == 3):
+                        m.next = "WRITE"
+                with m.Elif(timed_out):
+                    m.next = "CMD"
+
+            with m.State("WRITE"):
+                m.d.comb += [
+                    self.bus.cyc.eq(1),
+                    self.bus.stb.eq(1),
+                    self.bus.we.eq(1)
+                ]
+                with m.If(self.bus.ack):
+                    next_address()
+                    m.d.sync += count.eq(count - 1)
+                    with m.If(count == 0):
+                        m.next = "CMD"
+                    with m.Else():
+                        m.next = "WRITE_DATA"
+
+            with m.State("READ"):
+                # `word` only empties when the unpacker takes it, so once
+                # an access started it stays requested until the ack.
+                m.d.comb += [
+                    self.bus.cyc.eq(~word.valid),
+                    self.bus.stb.eq(~word.valid)
+                ]
+                with m.If(self.bus.ack):
+                    next_address()
+                    m.d.sync += [
+                        word.payload.eq(self.bus.dat_r),
+                        word.valid.eq(1),
+                        count.eq(count - 1)
+                    ]
+                    with m.If(count == 0):
+                        m.next = "CMD"
+
+        return m
+
+
+class _TestMemory(Elaboratable):
+    """Wishbone RAM that answers after `latency` wait states."""
+
+    def __init__(self, depth=256, latency=0):
+        self.depth = depth
+        self.latency = latency
+
+        self.bus = WishboneBus((depth - 1).bit_length(), name="mem")
+        self.memory = Memory(width=32, depth=depth)
+
+    def elaborate(self, _platform: Platform) -> Module:
+        m = Module()
+
+        m.submodules.rdport = rdport = self.memory.read_port(transparent=False)
+        m.submodules.wrport = wrport = self.memory.write_port()
+        bus = self.bus
+
+        wait = Signal(range(self.latency + 1))
+        access = Signal()
+        m.d.comb += [
+            access.eq(bus.cyc & bus.stb & ~bus.ack & (wait == self.latency)),
+            rdport.addr.eq(bus.adr),
+            bus.dat_r.eq(rdport.data),
+            wrport.addr.eq(bus.adr),
+            wrport.data.eq(bus.dat_w),
+            wrport.en.eq(access & bus.we)
+        ]
+        m.d.sync += bus.ack.eq(access)
+        with m.If(bus.cyc & bus.stb & ~bus.ack & ~access):
+            m.d.sync += wait.eq(wait + 1)
+        with m.Else():
+            m.d.sync += wait.eq(0)
+
+        return m
+
+
+def _test_socket_rx(rx, clk_per_bit, conn, done):
+    # Stands in for the host's serial adapter: sends whatever the client
+    # wrote to the socket on the line, until the client is done.
+    conn.setblocking(False)
+    while not done.is_set():
+        try:
+            octets = conn.recv(4096)
+        except BlockingIOError:
+            octets = b""
+        if not octets:
+            # Nothing to send for a frame time.
+            for _ in range(round(10 * clk_per_bit)):
+                yield
+            continue
+        cycle = 0
+        for octet in octets:
+            for bit in _frame(octet, 8, None):
+                yield rx.eq(bit)
+                target = cycle + clk_per_bit
+                while cycle < target:
+                    yield
+                    cycle += 1
+
+
+def _test_socket_tx(tx, clk_per_bit, conn, starts):
+    # Decodes the line and passes the bytes on to the client, noting the
+    # cycle every frame started at in `starts`.
+    yield sim.Passive()
+    cycle = 0
+    while not (yield tx):
+        yield
+        cycle += 1
+    while True:
+        while (yield tx):
+            yield
+            cycle += 1
+        starts.append(cycle)
+        bits = []
+        for n in range(10):
+            target = (n + 0.5) * clk_per_bit
+            while cycle - starts[-1] < target:
+                yield
+                cycle += 1
+            bits.append((yield tx))
+        assert bits[0] == 0 and bits[9] == 1
+        conn.sendall(bytes([sum(bit << n for n, bit in enumerate(bits[1:9]))]))
+
+
+def _test_client(client, memory_depth):
+    # What a host program would do, from the host's side of the socket.
+    rng = random.Random(14)
+
+    # Burst write the whole memory, and read it back in one go.
+    values = [rng.randrange(2**32) for _ in range(memory_depth)]
+    client.write(0, values)
+    assert client.read(0, memory_depth) == values
+
+    # Single accesses, some of them batched into one round trip.
+    client.write(5, [0x12345678])
+    assert client.read(5) == [0x12345678]
+    with client.batch() as batch:
+        batch.write(7, [1, 2, 3])
+        first = batch.read(6, 5)
+        batch.write(8, [0xdeadbeef])
+        second = batch.read(8)
+    assert first.values == [values[6], 1, 2, 3, values[10]]
+    values[5:11] = [0x12345678, values[6], 1, 0xdeadbeef, 3, values[10]]
+    assert second.values == [0xdeadbeef]
+
+    # Fixed address bursts, the last write wins.
+    client.write(3, [10, 11, 12], fixed=True)
+    values[3] = 12
+    assert client.read(3, 4, fixed=True) == [12] * 4
+
+    # Unknown command bytes are skipped.
+    client.port.write(bytes([0x00, 0xff, 0x80]))
+    client.port.flush()
+    assert client.read(0, memory_depth) == values
+
+
+def _test_timeout(dut, timeout):
+    # Half a read command, then a full one after the timeout.
+    for octet in [CMD_READ, 0, 0, 0] + [None] * (timeout + 8) + [CMD_READ, 1, 0, 0, 0, 0]:
+        if octet is None:
+            yield
+            continue
+        yield dut.sink.payload.eq(octet)
+        yield dut.sink.valid.eq(1)
+        yield
+        yield dut.sink.valid.eq(0)
+
+    received = []
+    for _ in range(64):
+        yield sim.Settle()
+        if (yield dut.source.valid):
+            received.append((yield dut.source.payload))
+        yield dut.source.ready.eq(1)
+        yield
+    assert bytes(received) == b"\x00\x00\x00\x00\x00\x00\x00\x01", received
+
+
+class _BridgeTest(Elaboratable):
+    def __init__(self, baud_rate=115200):
+        self.baud_rate = baud_rate
+
+    def elaborate(self, platform: Platform) -> Module:
+        m = Module()
+
+        serial = platform.request("uart")
+        leds = Cat([platform.request("led_r"), platform.request("led_g")])
+        button = platform.request("button")
+
+        m.submodules.uart = uart = UART(serial, clk_freq=12e6, baud_rate=self.baud_rate,
+                                        rx_fifo_depth=512, tx_fifo_depth=512)
+        m.submodules.bridge = bridge = UARTBridge(timeout=int(0.1 * 12e6))
+        m.submodules.csr = csr = CSRBank()
+        m.d.comb += [
+            *uart.rx.connect(bridge.sink),
+            *bridge.source.connect(uart.tx),
+            *bridge.bus.connect(csr.bus)
+        ]
+
+        # 0: scratch, 1: LEDs, 2: button, 3 and 4: UART error counters,
+        # then the performance counters from 5 on: perf_control,
+        # perf_cycles, rx_bytes, tx_bytes, tx_stalls, button_presses,
+        # rx_gap_min, rx_gap_max, reply_latency_min, reply_latency_max.
+        csr.add("scratch")
+        m.d.comb += leds.eq(csr.add("leds", width=2))
+        m.d.comb += csr.add("button", width=1, access="r").eq(button)
+        m.d.comb += [
+            csr.add("rx_framing_errors", width=16, access="r").eq(uart.rx_framing_errors),
+            csr.add("rx_overruns", width=16, access="r").eq(uart.rx_overruns)
+        ]
+
+        m.submodules.perf = perf = PerfCounters(csr)
+        button_last = Signal()
+        m.d.sync += button_last.eq(button)
+        m.d.comb += [
+            perf.add_event("rx_bytes").eq(uart.rx.transfer()),
+            perf.add_event("tx_bytes").eq(uart.tx.transfer()),
+            perf.add_event("tx_stalls").eq(uart.tx.valid & ~uart.tx.ready),
+            perf.add_event("button_presses").eq(button & ~button_last),
+            perf.add_interval("rx_gap").eq(uart.rx.transfer())
+        ]
+        # From the last byte of a command to the first byte of the reply
+        reply_start, reply_stop = perf.add_latency("reply_latency")
+        m.d.comb += [
+            reply_start.eq(uart.rx.transfer()),
+            reply_stop.eq(uart.tx.transfer())
+        ]
+
+        return m
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("-s", action="store_true", help="Simulate bridge (for debugging).")
+    parser.add_argument("-b", type=int, default=115200, help="Baud rate (default 115200)")
+    args = parser.parse_args()
+
+    if args.s:
+        # A command that stops halfway is dropped after the timeout.
+        dut = UARTBridge(timeout=100)
+        m = Module()
+        m.submodules.bridge = dut
+        m.submodules.memory = memory = _TestMemory(depth=4)
+        m.d.comb += dut.bus.connect(memory.bus)
+        memory.memory.init = [0, 1, 2, 3]
+        s = sim.Simulator(m)
+        s.add_clock(1.0 / 12e6)
+        s.add_sync_process(_proc_wrapper(_test_timeout(dut, 100)))
+        with s.write_vcd("uart_bridge_timeout.vcd", "uart_bridge_timeout.gtkw",
+                         traces=[dut.sink.payload, dut.sink.valid, dut.source.payload]):
+            s.run()
+
+        # Run BridgeClient against the simulated design, with a socket pair
+        # standing in for the serial port. The simulator runs in a thread
+        # that moves bytes between the socket and the UART lines. The memory
+        # takes longer to answer than a frame takes to send, and there is
+        # no transmit FIFO, so burst reads only keep up by fetching ahead.
+        pads = _TestPads()
+        clk_per_bit = 4
+
+        uart = UART(pads, clk_freq=12000000, baud_rate=3000000, rx_fifo_depth=16)
+        dut = UARTBridge()
+        m = Module()
+        m.submodules.uart = uart
+        m.submodules.bridge = dut
+        m.submodules.memory = memory = _TestMemory(depth=64, latency=60)
+        m.d.comb += [
+            *uart.rx.connect(dut.sink),
+            *dut.source.connect(uart.tx),
+            *dut.bus.connect(memory.bus)
+        ]
+        s = sim.Simulator(m)
+        s.add_clock(1.0 / 12e6)
+
+        host, device = socket.socketpair()
+        host.settimeout(60)
+        done = threading.Event()
+        starts = []
+        s.add_sync_process(_proc_wrapper(
+            _test_socket_rx(pads.rx, clk_per_bit, device, done)))
+        s.add_sync_process(_proc_wrapper(
+            _test_socket_tx(pads.tx, clk_per_bit, device, starts)))
+
+        errors = []
+
+        def run():
+            try:
+                with s.write_vcd("uart_bridge.vcd", "uart_bridge.gtkw",
+                                 traces=[pads.rx, pads.tx, dut.bus.adr, dut.bus.ack]):
+                    s.run()
+            except Exception as e:
+                errors.append(e)
+                host.shutdown(socket.SHUT_RDWR)
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        try:
+            _test_client(BridgeClient(host.makefile("rwb")), memory_depth=64)
+        finally:
+            done.set()
+            thread.join()
+        if errors:
+            raise errors[0]
+
+        # The last reply was a 64 word burst read, which has to go out at
+        # line rate.
+        gaps = [b - a for a, b in zip(starts[-256:], starts[-255:])]
+        assert max(gaps) == 10 * clk_per_bit, max(gaps)
+    else:
+        plat = ICEBreakerPlatform()
+        plat.build(_BridgeTest(baud_rate=args.b), do_program=True)